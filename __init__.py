@@ -1,2 +1,5 @@
 from .base import permission_index, Moderator, ModPerm, Permission, mub_base_namespace, MUBController
+from .base import BlockedModToken, ModSession, revocation_filter, check_revoked_token, init_jwt
+from .base import password_hasher, sign_in_limiter, metrics, async_db, ModRole, audit_log
+from .base import replica_router, grant_sweeper
 from .super import mub_super_namespace, mub_cli_blueprint
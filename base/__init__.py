@@ -1,5 +1,13 @@
+from ._mub_async import async_db
+from ._mub_hashing import password_hasher, sign_in_limiter
+from ._mub_metrics import metrics
+from ._mub_replica import replica_router
 from ._mub_restx import MUBController
+from ._mub_sweeper import grant_sweeper
+from .audit_db import AuditEntry, audit_log
 from .moderators_db import Moderator, ModPerm
 from .moderators_rst import controller as mub_base_namespace
 from .permissions import permission_index
 from .permissions_db import Section, Permission
+from .roles_db import ModRole
+from .sessions_db import BlockedModToken, ModSession, revocation_filter, check_revoked_token, init_jwt
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from inspect import isawaitable
+from typing import Any, TYPE_CHECKING
+
+from sqlalchemy import Select
+from sqlalchemy.engine import URL
+from sqlalchemy.pool import NullPool
+
+if TYPE_CHECKING:  # sqlalchemy.ext.asyncio needs greenlet, which is only required once async_db is configured
+    from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+
+async def resolve(result: Any) -> Any:
+    return await result if isawaitable(result) else result
+
+
+class AsyncDatabase:
+    """
+    Optional async SQLAlchemy session for `async def` views, configured separately from the synchronous `common.db`.
+    All async lookups inside one :meth:`scope` share a session, which is committed when the scope exits cleanly
+    """
+
+    def __init__(self):
+        self.engine: AsyncEngine | None = None
+        self.session_maker: async_sessionmaker[AsyncSession] | None = None
+        self._session: ContextVar[AsyncSession | None] = ContextVar("mub_async_session", default=None)
+
+    def configure(self, url: str | URL, **engine_options) -> None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+        # flask runs every async view in its own event loop, pooled connections can't outlive it
+        engine_options.setdefault("poolclass", NullPool)
+        self.engine = create_async_engine(url, **engine_options)
+        self.session_maker = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    @property
+    def session(self) -> AsyncSession:
+        session = self._session.get()
+        if session is None:
+            raise RuntimeError("No async session is active, use async_db.scope()")
+        return session
+
+    @asynccontextmanager
+    async def scope(self) -> AsyncIterator[AsyncSession]:
+        if (session := self._session.get()) is not None:
+            yield session
+            return
+        if self.session_maker is None:
+            raise RuntimeError("Async database is not configured, call async_db.configure()")
+
+        async with self.session_maker() as session:
+            token = self._session.set(session)
+            try:
+                yield session
+                await session.commit()
+            except BaseException:
+                await session.rollback()
+                raise
+            finally:
+                self._session.reset(token)
+
+    async def get_first(self, stmt: Select) -> Any | None:
+        return (await self.session.execute(stmt)).scalars().first()
+
+    async def get_all(self, stmt: Select) -> list[Any]:
+        return (await self.session.execute(stmt)).scalars().all()
+
+
+async_db: AsyncDatabase = AsyncDatabase()
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from collections.abc import Hashable
+from hashlib import blake2b
+from math import ceil, log
+from threading import Lock
+from time import monotonic
+from typing import Generic, TypeVar
+
+k = TypeVar("k", bound=Hashable)
+v = TypeVar("v")
+
+
+class LRUCache(Generic[k, v]):
+    """
+    Bounded in-process cache with least-recently-used eviction and an optional time-to-live.
+    Entries are only shared between threads of one worker, so the ttl bounds the staleness between workers
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float | None = 60.0, enabled: bool = True):
+        self.max_size: int = max_size
+        self.ttl: float | None = ttl
+        self.enabled: bool = enabled
+        self.hits: int = 0
+        self.misses: int = 0
+        self._entries: OrderedDict[k, tuple[float | None, v]] = OrderedDict()
+        self._lock: Lock = Lock()
+
+    def configure(self, max_size: int | None = None, ttl: float | None = None, enabled: bool = True) -> None:
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+            if ttl is not None:
+                self.ttl = ttl
+            self.enabled = enabled
+            self._entries.clear()
+
+    def get(self, key: k, default: v | None = None) -> v | None:
+        if not self.enabled:
+            return default
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry[0] is not None and entry[0] < monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: k, value: v, ttl: float | None = None) -> v:
+        if not self.enabled:
+            return value
+        if ttl is None or (self.ttl is not None and self.ttl < ttl):
+            ttl = self.ttl
+        with self._lock:
+            self._entries[key] = (None if ttl is None else monotonic() + ttl), value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key: k) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int | float | None]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries),
+                "max_size": self.max_size, "ttl": self.ttl}
+
+
+class BloomFilter:
+    """
+    Fixed-size probabilistic set of strings: membership tests can give false positives, never false negatives
+    """
+
+    def __init__(self, capacity: int = 100_000, error_rate: float = 0.01):
+        self.capacity: int = capacity
+        self.size: int = ceil(-capacity * log(error_rate) / log(2) ** 2)
+        self.hash_count: int = max(1, round(self.size / capacity * log(2)))
+        self.count: int = 0
+        self._bits: bytearray = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def saturated(self) -> bool:
+        return self.count >= self.capacity
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from itertools import repeat
+from threading import BoundedSemaphore, Lock
+from time import monotonic, perf_counter
+
+from passlib.handlers.pbkdf2 import pbkdf2_sha256
+
+from ._mub_metrics import metrics, hashing_duration
+
+
+class HashingSaturated(Exception):
+    pass
+
+
+def _get_handler(rounds: int | None):
+    if rounds is None:
+        return pbkdf2_sha256
+    return pbkdf2_sha256.using(rounds=rounds, min_desired_rounds=rounds)
+
+
+def _hash(password: str, rounds: int | None) -> str:
+    return _get_handler(rounds).hash(password)
+
+
+def _verify(password: str, hashed: str) -> bool:
+    return pbkdf2_sha256.verify(password, hashed)
+
+
+class PasswordHasher:
+    """
+    Runs pbkdf2 hashing in a bounded process pool, so that bursts of sign-ins can't pin every request worker.
+    When more than `max_pending` operations are queued, raises :class:`HashingSaturated` instead of waiting
+    """
+
+    def __init__(self, rounds: int | None = None):
+        self.rounds: int | None = rounds
+        self.max_pending: int = 0
+        self.timeout: float | None = None
+        self._executor: ProcessPoolExecutor | None = None
+        self._semaphore: BoundedSemaphore | None = None
+
+    def configure(self, rounds: int | None = None, max_workers: int | None = None,
+                  max_pending: int = 32, timeout: float | None = 30.0, use_pool: bool = True) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self.rounds = rounds
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = ProcessPoolExecutor(max_workers) if use_pool else None
+        self._semaphore = BoundedSemaphore(max_pending) if use_pool else None
+
+    def _submit(self, function, *args):
+        if not metrics.enabled:
+            return self._run(function, *args)
+        start = perf_counter()
+        try:
+            return self._run(function, *args)
+        finally:
+            metrics.observe(hashing_duration, perf_counter() - start, function.__name__.lstrip("_"))
+
+    def _run(self, function, *args):
+        if self._executor is None:
+            return function(*args)
+        semaphore = self._semaphore
+        if not semaphore.acquire(blocking=False):
+            raise HashingSaturated()
+        try:
+            future = self._executor.submit(function, *args)
+        except BaseException:
+            semaphore.release()
+            raise
+        # the slot is held until the operation is done, so timed out operations still count as pending
+        future.add_done_callback(lambda _: semaphore.release())
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise HashingSaturated()
+
+    def hash(self, password: str) -> str:
+        return self._submit(_hash, password, self.rounds)
+
+    def hash_many(self, passwords: list[str], executor: Executor | None = None) -> list[str]:
+        if executor is None:
+            return [_hash(password, self.rounds) for password in passwords]
+        return list(executor.map(_hash, passwords, repeat(self.rounds), chunksize=max(1, len(passwords) // 64)))
+
+    def verify(self, password: str, hashed: str) -> bool:
+        return self._submit(_verify, password, hashed)
+
+    def needs_update(self, hashed: str) -> bool:
+        return self.rounds is not None and _get_handler(self.rounds).needs_update(hashed)
+
+
+class AttemptLimiter:
+    """
+    In-memory sliding-window limiter of failed attempts per key (username, ip, ...), local to a worker
+    """
+
+    def __init__(self, max_attempts: int = 10, window: float = 300.0, max_keys: int = 100_000,
+                 enabled: bool = False):
+        self.max_attempts: int = max_attempts
+        self.window: float = window
+        self.max_keys: int = max_keys
+        self.enabled: bool = enabled
+        self._attempts: OrderedDict[str, deque[float]] = OrderedDict()
+        self._lock: Lock = Lock()
+
+    def configure(self, max_attempts: int | None = None, window: float | None = None,
+                  enabled: bool = True) -> None:
+        with self._lock:
+            if max_attempts is not None:
+                self.max_attempts = max_attempts
+            if window is not None:
+                self.window = window
+            self.enabled = enabled
+            self._attempts.clear()
+
+    def _get_recent(self, key: str, now: float) -> deque[float] | None:
+        attempts = self._attempts.get(key, None)
+        if attempts is not None:
+            while len(attempts) != 0 and attempts[0] < now - self.window:
+                attempts.popleft()
+        return attempts
+
+    def allows(self, *keys: str) -> bool:
+        if not self.enabled:
+            return True
+        now = monotonic()
+        with self._lock:
+            return all(len(self._get_recent(key, now) or ()) < self.max_attempts for key in keys)
+
+    def record(self, *keys: str) -> None:
+        if not self.enabled:
+            return
+        now = monotonic()
+        with self._lock:
+            for key in keys:
+                attempts = self._get_recent(key, now)
+                if attempts is None:
+                    attempts = self._attempts[key] = deque()
+                attempts.append(now)
+                self._attempts.move_to_end(key)
+            while len(self._attempts) > self.max_keys:
+                self._attempts.popitem(last=False)
+
+    def reset(self, *keys: str) -> None:
+        with self._lock:
+            for key in keys:
+                self._attempts.pop(key, None)
+
+
+password_hasher: PasswordHasher = PasswordHasher()
+sign_in_limiter: AttemptLimiter = AttemptLimiter()
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS: tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS: tuple[float, ...] = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    labels = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if len(labels) != 0 else ""
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets: tuple[float, ...] = buckets
+        self.counts: list[int] = [0] * (len(buckets) + 1)
+        self.sum: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...],
+                 buckets: tuple[float, ...] | None = None):
+        self.name: str = name
+        self.description: str = description
+        self.label_names: tuple[str, ...] = label_names
+        self.buckets: tuple[float, ...] | None = buckets
+        self.values: dict[tuple[str, ...], float | Histogram] = {}
+
+    @property
+    def kind(self) -> str:
+        return "counter" if self.buckets is None else "histogram"
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self.values.items():
+            if self.buckets is None:
+                lines.append(f"{self.name}{format_labels(self.label_names, labels)} {value}")
+                continue
+
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets + (float("inf"),), value.counts):
+                cumulative += bucket_count
+                le = "+Inf" if bucket == float("inf") else repr(float(bucket))
+                bucket_labels = format_labels(self.label_names, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {value.sum}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    In-process metrics of one worker, rendered in the Prometheus text format.
+    Disabled by default: every hook checks `enabled` first, and SQL listeners are only attached by :meth:`enable`
+    """
+
+    def __init__(self):
+        self.enabled: bool = False
+        self.metrics: list[Metric] = []
+        self._lock: Lock = Lock()
+
+    def counter(self, name: str, description: str, *label_names: str) -> Metric:
+        self.metrics.append(metric := Metric(name, description, label_names))
+        return metric
+
+    def histogram(self, name: str, description: str, *label_names: str,
+                  buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Metric:
+        self.metrics.append(metric := Metric(name, description, label_names, buckets))
+        return metric
+
+    def inc(self, metric: Metric, *labels: str, amount: float = 1) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            metric.values[labels] = metric.values.get(labels, 0) + amount
+
+    def observe(self, metric: Metric, value: float, *labels: str) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = metric.values.get(labels, None)
+            if histogram is None:
+                histogram = metric.values[labels] = Histogram(metric.buckets)
+            histogram.observe(value)
+
+    def enable(self) -> None:
+        if not self.enabled:
+            event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+        self.enabled = True
+
+    def disable(self) -> None:
+        if self.enabled:
+            event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+            event.remove(Engine, "after_cursor_execute", after_cursor_execute)
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self._lock:
+            for metric in self.metrics:
+                metric.values.clear()
+
+    def render(self) -> str:
+        with self._lock:
+            return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+metrics: MetricsRegistry = MetricsRegistry()
+
+request_duration = metrics.histogram(
+    "mub_request_duration_seconds", "Latency of MUB endpoints", "endpoint", "method", "status")
+request_statements = metrics.histogram(
+    "mub_request_sql_statements", "SQL statements per MUB request", "endpoint", buckets=COUNT_BUCKETS)
+sql_statements = metrics.counter("mub_sql_statements_total", "SQL statements run by MUB endpoints", "endpoint")
+sql_duration = metrics.counter("mub_sql_duration_seconds_total", "Time spent in SQL by MUB endpoints", "endpoint")
+permission_check_duration = metrics.histogram(
+    "mub_permission_check_duration_seconds", "Latency of permission checks", "permission")
+permission_checks = metrics.counter("mub_permission_checks_total", "Permission check outcomes", "permission", "result")
+sign_ins = metrics.counter("mub_sign_ins_total", "Sign-in attempts by outcome", "result")
+hashing_duration = metrics.histogram(
+    "mub_password_hashing_duration_seconds", "Latency of password hashing", "operation")
+
+
+def before_cursor_execute(_conn, _cursor, _statement, _parameters, context, _executemany) -> None:
+    # kept on the execution context, so statements that fail (and never reach after_cursor_execute) leave nothing behind
+    if context is not None and has_request_context() and "mub_sql" in g:
+        context.mub_statement_start = perf_counter()
+
+
+def after_cursor_execute(_conn, _cursor, _statement, _parameters, context, _executemany) -> None:
+    started = getattr(context, "mub_statement_start", None)
+    if started is None or not has_request_context() or "mub_sql" not in g:
+        return
+    g.mub_sql[0] += 1
+    g.mub_sql[1] += perf_counter() - started
+
+
+def start_request() -> None:
+    g.mub_sql = [0, 0.0]
+
+
+def finish_request(endpoint: str, method: str, status: int, elapsed: float) -> None:
+    statements, duration = g.pop("mub_sql", (0, 0.0))
+    metrics.observe(request_duration, elapsed, endpoint, method, str(status))
+    metrics.observe(request_statements, statements, endpoint)
+    metrics.inc(sql_statements, endpoint, amount=statements)
+    metrics.inc(sql_duration, endpoint, amount=duration)
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, ORMExecuteState
+
+from common import db
+
+
+class ReplicaRouter:
+    """
+    Sends ORM selects made inside :meth:`reading` to a replica bind (a key of `SQLALCHEMY_BINDS`).
+    Reads fall back to the primary once the session has written anything,
+    and for moderators (or the whole catalog) changed during the last `sticky` seconds in this process
+    """
+
+    def __init__(self):
+        self.bind_key: str | None = None
+        self.sticky: float = 5.0
+        self._reading: ContextVar[bool] = ContextVar("mub_replica_reading", default=False)
+        self._stuck: dict[int, float] = {}
+        self._stuck_all: float = 0.0
+        self._lock: Lock = Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.bind_key is not None
+
+    def configure(self, bind_key: str = "mub-replica", sticky: float = 5.0) -> None:
+        self.bind_key = bind_key
+        self.sticky = sticky
+
+    def disable(self) -> None:
+        self.bind_key = None
+
+    @contextmanager
+    def reading(self) -> Iterator[None]:
+        token = self._reading.set(True)
+        try:
+            yield
+        finally:
+            self._reading.reset(token)
+
+    def stick(self, moderator_id: int | None = None) -> None:
+        if not self.enabled:
+            return
+        deadline = monotonic() + self.sticky
+        with self._lock:
+            if moderator_id is None:
+                self._stuck_all = deadline
+                self._stuck.clear()
+                return
+            if len(self._stuck) > 10_000:
+                now = monotonic()
+                self._stuck = {key: value for key, value in self._stuck.items() if value > now}
+            self._stuck[moderator_id] = deadline
+
+    def is_stuck(self, moderator_id: int | None = None) -> bool:
+        now = monotonic()
+        if self._stuck_all > now:
+            return True
+        return moderator_id is not None and self._stuck.get(moderator_id, 0.0) > now
+
+    def route(self, state: ORMExecuteState) -> None:
+        session = state.session
+        if not state.is_select:
+            session.info["mub_wrote"] = True
+        elif self.enabled and self._reading.get() and not session.info.get("mub_wrote", False) \
+                and not state.execution_options.get("mub_primary", False) \
+                and not self.is_stuck(state.execution_options.get("mub_moderator", None)):
+            state.bind_arguments["bind"] = db.engines[self.bind_key]
+
+
+replica_router: ReplicaRouter = ReplicaRouter()
+
+
+def about_moderator(stmt, moderator_id: int | None):
+    """ Marks a select as reading one moderator's state, so it follows that moderator's read-your-writes window """
+    return stmt.execution_options(mub_moderator=moderator_id)
+
+
+def on_primary(stmt):
+    """ Marks a select that must not see replication lag, e.g. a check of a session that was just started """
+    return stmt.execution_options(mub_primary=True)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def route_read(state: ORMExecuteState) -> None:
+    replica_router.route(state)
+
+
+@event.listens_for(Session, "after_flush")
+def mark_written(session: Session, _flush_context) -> None:
+    session.info["mub_wrote"] = True
@@ -1,27 +1,237 @@
-from typing import Type
+from collections.abc import Callable
+from functools import wraps
+from hashlib import sha1
+from inspect import iscoroutinefunction
+from time import perf_counter
+from typing import Type, Any
 
+from flask import Response, request, json, current_app, make_response
 from flask_fullstack import UserRole
+from flask_jwt_extended import verify_jwt_in_request
+from flask_restx.fields import List as ListField, Nested, String as StringField
+from flask_restx.marshalling import marshal
 
 from common import ResourceController
-from .permissions import permission_index, PermissionInt
+from ._mub_async import async_db, resolve
+from ._mub_hashing import HashingSaturated
+from ._mub_metrics import metrics, start_request, finish_request
+from ._mub_replica import replica_router
+from ._mub_sql import encode_cursor, decode_cursor
+from .moderators_db import Moderator
+from .permissions import permission_index, PermissionInt, PermissionExpression
 
 
 class MUBController(ResourceController):
-    def __init__(self, name: str, *, no_prefix: bool = False, path: str = None, **kwargs):
+    def __init__(self, name: str, *, no_prefix: bool = False, path: str = None, read_replica: bool = False,
+                 **kwargs):
         if no_prefix:
             super().__init__(name, path=path, **kwargs)
         elif path is None:
             super().__init__("mub-" + name, path=f"/mub/{name}/", **kwargs)
         else:
             super().__init__("mub-" + name, path="/mub/" + path.lstrip("/"), **kwargs)
+        self.errorhandler(HashingSaturated)(self.handle_hashing_saturated)
+        self.decorators.append(self.instrument)
+        if read_replica:
+            self.decorators.append(self.read_from_replica)
+        self.decorators.append(self.refresh_catalog)
+
+    @staticmethod
+    def instrument(view):
+        @wraps(view)
+        def instrument_inner(*args, **kwargs):
+            if not metrics.enabled:
+                return view(*args, **kwargs)
+
+            start_request()
+            status, start = 500, perf_counter()
+            try:
+                response = make_response(view(*args, **kwargs))  # views can return (body, status) tuples
+                status = response.status_code
+                return response
+            except HashingSaturated:
+                status = 503
+                raise
+            except Exception as error:
+                status = getattr(error, "code", None) or 500
+                raise
+            finally:
+                finish_request(request.endpoint, request.method, status, perf_counter() - start)
+
+        return instrument_inner
+
+    @staticmethod
+    def refresh_catalog(view):
+        @wraps(view)
+        def refresh_catalog_inner(*args, **kwargs):
+            permission_index.refresh()
+            return view(*args, **kwargs)
+
+        return refresh_catalog_inner
+
+    @staticmethod
+    def read_from_replica(view):
+        @wraps(view)
+        def read_from_replica_inner(*args, **kwargs):
+            if request.method not in ("GET", "HEAD") or not replica_router.enabled:
+                return view(*args, **kwargs)
+            with replica_router.reading():
+                return view(*args, **kwargs)
+
+        return read_from_replica_inner
+
+    def route(self, *urls, **kwargs):
+        route_wrapper = super().route(*urls, **kwargs)
+
+        def async_route_wrapper(resource):
+            for method in resource.methods or ():
+                view = getattr(resource, method.lower(), None)
+                if iscoroutinefunction(view):
+                    setattr(resource, method.lower(), self.run_async(view))
+            return route_wrapper(resource)
+
+        return async_route_wrapper
+
+    @staticmethod
+    def run_async(function):
+        @wraps(function)
+        def run_async_inner(*args, **kwargs):
+            return current_app.ensure_sync(function)(*args, **kwargs)
+
+        return run_async_inner
+
+    @staticmethod
+    def handle_hashing_saturated(_error: HashingSaturated):
+        return {"message": "Server is busy, try again later"}, 503
 
     def jwt_authorizer(self, role: Type[UserRole], auth_name: str = "mub", *, result_field_name: str = None,
                        optional: bool = False, check_only: bool = False):
         return super().jwt_authorizer(role, auth_name, result_field_name=result_field_name,
                                       optional=optional, check_only=check_only)
 
+    def jwt_authorizer_async(self, role: Type[UserRole], auth_name: str = "mub", *, result_field_name: str = None,
+                             optional: bool = False, check_only: bool = False):
+        """
+        Same as :meth:`jwt_authorizer` for `async def` views: the role is looked up with `find_by_identity_async`
+        inside an :class:`AsyncDatabase` scope, which stays open for the decorated view
+        """
+        auth_errors = self.auth_errors + [role.unauthorized_error]
+        if result_field_name is None:
+            result_field_name = role.__name__.lower()
+
+        def authorizer_wrapper(function):
+            @self.doc_aborts(*auth_errors)
+            @wraps(function)
+            async def authorizer_inner(*args, **kwargs):
+                verify_jwt_in_request(optional=optional)
+                async with async_db.scope():
+                    if (jwt := self._get_identity()) is None or (identity := jwt.get(auth_name, None)) is None:
+                        if optional:
+                            kwargs[role.__name__.lower()] = None
+                            return await resolve(function(*args, **kwargs))
+                        self.abort(*role.unauthorized_error)
+
+                    result = await role.find_by_identity_async(identity)
+                    if result is None:
+                        self.abort(*role.unauthorized_error)
+
+                    if not check_only:
+                        kwargs[result_field_name] = result
+                    return await resolve(function(*args, **kwargs))
+
+            return authorizer_inner
+
+        return authorizer_wrapper
+
+    def add_authorization(self, response, auth_agent: UserRole, auth_name: str = None) -> None:
+        if auth_name == "mub" and permission_index.token_claims and isinstance(auth_agent, Moderator):
+            auth_agent = permission_index.issue_claims(auth_agent)
+        super().add_authorization(response, auth_agent, auth_name)
+
     def require_permission(self, permission: PermissionInt, use_moderator: bool = True, optional: bool = False):
         return permission_index.require_permission(self, permission, use_moderator, optional)
 
     def require_permissions(self, *permissions: PermissionInt, use_moderator: bool = True, optional: bool = False):
         return permission_index.require_permissions(self, *permissions, use_moderator=use_moderator, optional=optional)
+
+    def require(self, expression: PermissionExpression, use_moderator: bool = True, optional: bool = False):
+        return permission_index.require(self, expression, use_moderator, optional)
+
+    def require_permission_async(self, permission: PermissionInt, use_moderator: bool = True,
+                                 optional: bool = False):
+        return permission_index.require_permission_async(self, permission, use_moderator, optional)
+
+    def require_permissions_async(self, *permissions: PermissionInt, use_moderator: bool = True,
+                                  optional: bool = False):
+        return permission_index.require_permissions_async(self, *permissions, use_moderator=use_moderator,
+                                                          optional=optional)
+
+    def require_async(self, expression: PermissionExpression, use_moderator: bool = True, optional: bool = False):
+        return permission_index.require_async(self, expression, use_moderator, optional)
+
+    def cursor_lister(self, per_request: int, marshal_model, cursor_key: Callable[[Any], tuple],
+                      cursor_types: tuple[type, ...] = (str, int)):
+        name = getattr(marshal_model, "name", None) or marshal_model.__name__
+        model = self.models.get(name, None) or self.model(model=marshal_model)
+        response = self.model(f"Cursor{name}", {
+            "results": ListField(Nested(model), max_items=per_request),
+            "next-cursor": StringField,
+        })
+
+        def cursor_lister_wrapper(function):
+            @self.doc_abort(400, "Invalid cursor")
+            @self.response(200, f"Max size of results: {per_request}", response)
+            @wraps(function)
+            def cursor_lister_inner(*args, **kwargs):
+                cursor = kwargs.pop("cursor", None)
+                if cursor is not None and (cursor := decode_cursor(cursor, cursor_types)) is None:
+                    self.abort(400, "Invalid cursor")
+
+                kwargs["cursor"] = cursor
+                kwargs["limit"] = per_request + 1
+                result_list = function(*args, **kwargs)
+
+                next_cursor = None
+                if len(result_list) > per_request:
+                    result_list = result_list[:per_request]
+                    next_cursor = encode_cursor(cursor_key(result_list[-1]))
+
+                result_list = [marshal_model.convert(result, **kwargs) for result in result_list]
+                return {"results": marshal(result_list, model, skip_none=True), "next-cursor": next_cursor}
+
+            return cursor_lister_inner
+
+        return cursor_lister_wrapper
+
+    def catalog_cached(self, marshal_model, as_list: bool = False):
+        """
+        Caches the serialized response of a permission catalog endpoint until `permission_index.version` changes.
+        Responses carry a strong ETag, so repeated requests with If-None-Match get a 304 without any work
+        """
+        name = getattr(marshal_model, "name", None) or marshal_model.__name__
+        model = self.models.get(name, None) or self.model(model=marshal_model)
+        cached: list[tuple[int, str, bytes]] = []
+
+        def catalog_cached_wrapper(function):
+            @self.response(200, "Success", [model] if as_list else model)
+            @self.response(304, "Not Modified")
+            @wraps(function)
+            def catalog_cached_inner(*args, **kwargs):
+                version = permission_index.version
+                if len(cached) == 0 or cached[0][0] != version:
+                    result = function(*args, **kwargs)
+                    if as_list:
+                        result = [marshal_model.convert(entry) for entry in result]
+                    else:
+                        result = marshal_model.convert(result)
+                    body = json.dumps(marshal(result, model, skip_none=True)).encode("utf-8")
+                    cached[:] = [(version, sha1(body).hexdigest(), body)]
+
+                _, etag, body = cached[0]
+                response = Response(body, mimetype="application/json")
+                response.set_etag(etag)
+                return response.make_conditional(request)
+
+            return catalog_cached_inner
+
+        return catalog_cached_wrapper
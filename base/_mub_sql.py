@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as BinasciiError
+from importlib import import_module
+from json import dumps, loads
+
+from sqlalchemy import Table, insert, inspect, select, delete
+from sqlalchemy.sql import ColumnElement
+
+from common import db, Base
+
+IGNORE_CONFLICT_DIALECTS: tuple[str, ...] = ("postgresql", "sqlite")
+IGNORE_PREFIX_DIALECTS: tuple[str, ...] = ("mysql", "mariadb")
+
+
+def insert_ignore(model: type[Base], rows: list[dict]) -> None:
+    if len(rows) == 0:
+        return
+
+    dialect: str = db.session.get_bind().dialect.name
+    if dialect in IGNORE_CONFLICT_DIALECTS:
+        stmt = import_module(f"sqlalchemy.dialects.{dialect}").insert(model.__table__).on_conflict_do_nothing()
+    elif dialect in IGNORE_PREFIX_DIALECTS:
+        stmt = insert(model.__table__).prefix_with("IGNORE")
+    else:
+        keys = [column.key for column in inspect(model).primary_key]
+        rows = [row for row in rows if db.session.get(model, tuple(row[key] for key in keys)) is None]
+        if len(rows) == 0:
+            return
+        stmt = insert(model.__table__)
+    db.session.execute(stmt, rows)
+
+
+def upsert(model: type[Base], rows: list[dict], columns: list[str]) -> None:
+    """ Inserts rows, setting `columns` from the new row where one with the same primary key exists """
+    if len(rows) == 0:
+        return
+
+    dialect: str = db.session.get_bind().dialect.name
+    if dialect in IGNORE_CONFLICT_DIALECTS:
+        stmt = import_module(f"sqlalchemy.dialects.{dialect}").insert(model.__table__)
+        keys = [column.key for column in inspect(model).primary_key]
+        stmt = stmt.on_conflict_do_update(index_elements=keys, set_={key: stmt.excluded[key] for key in columns})
+    elif dialect in IGNORE_PREFIX_DIALECTS:
+        stmt = import_module("sqlalchemy.dialects.mysql").insert(model.__table__)
+        stmt = stmt.on_duplicate_key_update({key: stmt.inserted[key] for key in columns})
+    else:
+        keys = [column.key for column in inspect(model).primary_key]
+        for row in rows:
+            entry = db.session.get(model, tuple(row[key] for key in keys))
+            if entry is None:
+                db.session.add(model(**row))
+            else:
+                for key in columns:
+                    setattr(entry, key, row[key])
+        return
+    db.session.execute(stmt, rows)
+
+
+def delete_dependents(table: Table, condition: ColumnElement[bool]) -> None:
+    for dependent in table.metadata.sorted_tables:
+        for key in dependent.foreign_keys:
+            if key.column.table is table and key.ondelete == "CASCADE":
+                dependent_condition = key.parent.in_(select(key.column).where(condition))
+                delete_dependents(dependent, dependent_condition)
+                db.session.execute(delete(dependent).where(dependent_condition))
+
+
+def delete_cascading(model: type[Base], condition: ColumnElement[bool]) -> int:
+    """
+    Deletes rows matching `condition` in one statement, without loading them.
+    Dependents are deleted explicitly first (one statement per table) on every dialect:
+    SQLite ignores ON DELETE CASCADE unless foreign keys are enabled on every connection,
+    and schemas created before the foreign keys got ON DELETE CASCADE don't have it at all
+    """
+    table = model.__table__
+    delete_dependents(table, condition)
+    return db.session.execute(delete(table).where(condition)).rowcount
+
+
+def encode_cursor(key: tuple) -> str:
+    return urlsafe_b64encode(dumps(list(key), separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str, types: tuple[type, ...] = (str, int)) -> tuple | None:
+    """ Returns None unless the cursor is a list with elements of exactly `types` (so no bools for ints) """
+    try:
+        key = loads(urlsafe_b64decode(cursor.encode("ascii")))
+    except (BinasciiError, UnicodeError, ValueError):
+        return None
+    if not isinstance(key, list) or len(key) != len(types):
+        return None
+    if any(type(value) is not value_type for value, value_type in zip(key, types)):
+        return None
+    return tuple(key)
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+from atexit import register as register_exit
+from threading import Thread, Event
+
+from flask import Flask
+
+from common import db
+from .moderators_db import ModPerm
+
+
+class GrantSweeper:
+    """
+    Background thread deleting lapsed time-limited grants every `interval` seconds,
+    one committed batch of up to `batch_size` rows at a time.
+    Checks already ignore expired grants, so sweeping only keeps the table and caches small
+    """
+
+    def __init__(self, interval: float = 60.0, batch_size: int = 1000):
+        self.interval: float = interval
+        self.batch_size: int = batch_size
+        self.app: Flask | None = None
+        self._stopped: Event = Event()
+        self._worker: Thread | None = None
+
+    def configure(self, app: Flask, interval: float | None = None, batch_size: int | None = None) -> None:
+        if interval is not None:
+            self.interval = interval
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.app = app
+
+        if self._worker is None:
+            self._stopped.clear()
+            self._worker = Thread(target=self.run, name="mub-grant-sweeper", daemon=True)
+            self._worker.start()
+            register_exit(self.stop)
+
+    def sweep(self) -> int:
+        swept = 0
+        while not self._stopped.is_set():
+            count = ModPerm.sweep_expired(self.batch_size)
+            db.session.commit()
+            swept += count
+            if count < self.batch_size:
+                break
+        return swept
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    self.sweep()
+                except Exception:  # the next round retries, expired grants are ignored by checks meanwhile
+                    db.session.rollback()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._worker is not None:
+            self._worker.join(self.interval + 5)
+            self._worker = None
+
+
+grant_sweeper: GrantSweeper = GrantSweeper()
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+from atexit import register as register_exit
+from datetime import datetime
+from json import dumps, loads
+from queue import Queue, Empty, Full
+from threading import Thread, Lock, Event
+from time import monotonic
+
+from flask import Flask
+from flask_fullstack import PydanticModel
+from sqlalchemy import Column, Index, select, insert, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, SessionTransaction
+from sqlalchemy.sql.sqltypes import Integer, String, DateTime, Text
+
+from common import Base, db
+from .sessions_db import utcnow
+
+
+class AuditEntry(Base):
+    __tablename__ = "mub-audit"
+    __table_args__ = (Index("ix_mub_audit_target_created", "target_type", "target_id", "created"),)
+
+    id = Column(Integer, primary_key=True)
+    created = Column(DateTime, nullable=False, default=utcnow, index=True)
+    actor_id = Column(Integer, nullable=True)  # not a foreign key: entries outlive deleted moderators
+    target_type = Column(String(20), nullable=False)
+    target_id = Column(Integer, nullable=True)
+    action = Column(String(40), nullable=False)
+    details = Column(Text, nullable=True)
+
+    IndexModel = PydanticModel.column_model(id, created, actor_id, target_type, target_id, action, details)
+
+    @classmethod
+    def search(cls, offset: int, limit: int, target_type: str | None = None,
+               target_id: int | None = None) -> list[AuditEntry]:
+        stmt = select(cls)
+        if target_type is not None:
+            stmt = stmt.filter_by(target_type=target_type)
+            if target_id is not None:
+                stmt = stmt.filter_by(target_id=target_id)
+        return db.get_paginated(stmt.order_by(cls.created.desc(), cls.id.desc()), offset, limit)
+
+
+class AuditLog:
+    """
+    Append-only audit log written outside of request transactions.
+    Entries are attached to the current session and handed to a background writer only after it commits.
+    The writer inserts them in batches of up to `batch_size` or every `flush_interval` seconds.
+    Entries that can't be inserted (or don't fit into the queue) are appended to `fallback_path` as JSON lines,
+    which can be loaded back with :meth:`replay`
+    """
+
+    def __init__(self, batch_size: int = 100, flush_interval: float = 1.0, max_pending: int = 10_000,
+                 fallback_path: str = "mub-audit-fallback.jsonl"):
+        self.batch_size: int = batch_size
+        self.flush_interval: float = flush_interval
+        self.fallback_path: str = fallback_path
+        self.enabled: bool = False
+        self.engine: Engine | None = None
+        self._queue: Queue[dict] = Queue(max_pending)
+        self._stopped: Event = Event()
+        self._fallback_lock: Lock = Lock()
+        self._worker: Thread | None = None
+
+    def configure(self, app: Flask, batch_size: int | None = None, flush_interval: float | None = None,
+                  fallback_path: str | None = None) -> None:
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if fallback_path is not None:
+            self.fallback_path = fallback_path
+        with app.app_context():
+            self.engine = db.engine
+
+        self.enabled = True
+        if self._worker is None:
+            self._stopped.clear()
+            self._worker = Thread(target=self.run, name="mub-audit", daemon=True)
+            self._worker.start()
+            register_exit(self.stop)
+
+    def record(self, action: str, target_type: str, target_id: int | None = None,
+               actor_id: int | None = None, **details) -> None:
+        if not self.enabled:
+            return
+        entry = {"created": utcnow(), "actor_id": actor_id, "target_type": target_type,
+                 "target_id": target_id, "action": action, "details": dumps(details) if details else None}
+        # kept with the transaction (or savepoint) recording it, so that rolling a savepoint back drops only its entries
+        session = db.session()
+        transaction = session.get_nested_transaction() or session.get_transaction()
+        session.info.setdefault("mub_audit", []).append((transaction, entry))
+
+    def enqueue(self, entries: list[dict]) -> None:
+        overflow = []
+        for entry in entries:
+            try:
+                self._queue.put_nowait(entry)
+            except Full:
+                overflow.append(entry)
+        if len(overflow) != 0:
+            self.write_fallback(overflow)
+
+    def run(self) -> None:
+        while not self._stopped.is_set() or not self._queue.empty():
+            batch = []
+            deadline = monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and (timeout := deadline - monotonic()) > 0:
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except Empty:
+                    break
+            if len(batch) != 0:
+                self.write(batch)
+
+    def write(self, batch: list[dict]) -> None:
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(insert(AuditEntry.__table__), batch)
+        except Exception:  # the log must not be lost because of the database, it can be replayed later
+            self.write_fallback(batch)
+
+    def write_fallback(self, entries: list[dict]) -> None:
+        with self._fallback_lock, open(self.fallback_path, "a", encoding="utf-8") as fallback:
+            for entry in entries:
+                fallback.write(dumps({**entry, "created": entry["created"].isoformat()}) + "\n")
+
+    def flush(self) -> None:
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+        for i in range(0, len(batch), self.batch_size):
+            self.write(batch[i:i + self.batch_size])
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._worker is not None:
+            self._worker.join(self.flush_interval + 5)
+            self._worker = None
+        self.flush()
+
+    def replay(self) -> int:
+        """ Inserts the fallback entries in a transaction of its own, the file is only emptied after it commits """
+        with self._fallback_lock:
+            try:
+                with open(self.fallback_path, encoding="utf-8") as fallback:
+                    entries = [loads(line) for line in fallback if line.strip()]
+            except FileNotFoundError:
+                return 0
+            for entry in entries:
+                entry["created"] = datetime.fromisoformat(entry["created"])
+            if len(entries) != 0:
+                with (self.engine or db.engine).begin() as connection:
+                    connection.execute(insert(AuditEntry.__table__), entries)
+            open(self.fallback_path, "w").close()
+        return len(entries)
+
+
+audit_log: AuditLog = AuditLog()
+
+
+def is_within(transaction: SessionTransaction | None, ancestor: SessionTransaction) -> bool:
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = transaction.parent
+    return False
+
+
+@event.listens_for(Session, "after_commit")
+def publish_audit_entries(session: Session) -> None:
+    if (entries := session.info.pop("mub_audit", None)) is not None:
+        audit_log.enqueue([entry for _, entry in entries])
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def discard_audit_entries(session: Session, previous_transaction: SessionTransaction) -> None:
+    if previous_transaction.parent is None:
+        session.info.pop("mub_audit", None)
+    elif (entries := session.info.get("mub_audit", None)) is not None:
+        session.info["mub_audit"] = [(transaction, entry) for transaction, entry in entries
+                                     if not is_within(transaction, previous_transaction)]
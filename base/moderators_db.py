@@ -1,14 +1,29 @@
 from __future__ import annotations
 
+from collections.abc import Iterator
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import groupby
+from typing import Any
+
+from flask import has_app_context
 from flask_fullstack import PydanticModel, Identifiable, UserRole, TypeEnum
-from passlib.handlers.pbkdf2 import pbkdf2_sha256
-from sqlalchemy import Column, ForeignKey, select, delete
-from sqlalchemy.orm import relationship
-from sqlalchemy.sql.functions import count
-from sqlalchemy.sql.sqltypes import Integer, String, Boolean, Enum
+from sqlalchemy import Column, ForeignKey, Index, select, delete, insert, update, event, inspect, and_, or_, true
+from sqlalchemy import case, null, tuple_
+from sqlalchemy.engine import Connection, Row
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, relationship, make_transient_to_detached, validates, selectinload, joinedload
+from sqlalchemy.sql.functions import count, min as sql_min
+from sqlalchemy.sql.sqltypes import Integer, String, Boolean, Enum, DateTime
 
 from common import db, Base
+from ._mub_async import async_db
+from ._mub_cache import LRUCache
+from ._mub_hashing import password_hasher
+from ._mub_replica import replica_router, about_moderator
+from ._mub_sql import insert_ignore, upsert, delete_cascading
 from .permissions_db import Permission, Section
+from .sessions_db import ModSession, BlockedModToken, utcnow  # BlockedModToken is re-exported for older imports
 
 
 class InterfaceMode(TypeEnum):
@@ -16,34 +31,91 @@ class InterfaceMode(TypeEnum):
     LIGHT = 1
 
 
+@dataclass(frozen=True)
+class ModeratorSnapshot:
+    columns: dict[str, Any]
+    permission_ids: frozenset[int]
+
+
+moderator_cache: LRUCache[int, ModeratorSnapshot] = LRUCache(enabled=False)
+payload_cache: LRUCache[int, tuple[tuple, dict[type, PydanticModel]]] = LRUCache(enabled=False)
+grants_cache: LRUCache[int, tuple[bool, frozenset[int]]] = LRUCache(max_size=65536, ttl=5.0, enabled=False)
+
+
+def get_expiry_ttl(expiries) -> float | None:
+    """ Cached permission state must not outlive the earliest time-limited grant it includes """
+    earliest = min((expiry for expiry in expiries if expiry is not None), default=None)
+    return None if earliest is None else max((earliest - utcnow()).total_seconds(), 0.0)
+
+
+def drop_moderator_state(moderator_id: int | None) -> None:
+    """ Drops cached state of one moderator, or of everyone for None """
+    if moderator_id is None:
+        moderator_cache.clear()
+        payload_cache.clear()
+        grants_cache.clear()
+    else:
+        moderator_cache.invalidate(moderator_id)
+        payload_cache.invalidate(moderator_id)
+        grants_cache.invalidate(moderator_id)
+    replica_router.stick(moderator_id)
+
+
+def invalidate_moderator_state(moderator_id: int | None) -> None:
+    """
+    Drops cached state right away and once more after the session commits:
+    a concurrent request could cache the state from before the commit in between
+    """
+    drop_moderator_state(moderator_id)
+    if has_app_context():
+        db.session.info.setdefault("mub_stale_moderators", set()).add(moderator_id)
+
+
+def clear_moderator_state() -> None:
+    invalidate_moderator_state(None)
+
+
+@event.listens_for(Session, "after_commit")
+def drop_committed_moderator_state(session: Session) -> None:
+    if (moderator_ids := session.info.pop("mub_stale_moderators", None)) is not None:
+        for moderator_id in [None] if None in moderator_ids else moderator_ids:
+            drop_moderator_state(moderator_id)
+
+
 class Moderator(Base, Identifiable, UserRole):
     __tablename__ = "mub-moderators"
 
     @staticmethod
     def generate_hash(password) -> str:
-        return pbkdf2_sha256.hash(password)
+        return password_hasher.hash(password)
 
     @staticmethod
     def verify_hash(password, hashed) -> bool:
-        return pbkdf2_sha256.verify(password, hashed)
+        return password_hasher.verify(password, hashed)
 
     id = Column(Integer, primary_key=True)
     username = Column(String(100), nullable=False, unique=True)
+    username_lower = Column(String(100), nullable=True, index=True)
     password = Column(String(100), nullable=False)
     super = Column(Boolean, nullable=False, default=False)
 
     mode = Column(Enum(InterfaceMode), nullable=False, default=InterfaceMode.DARK)
+    session_epoch = Column(Integer, nullable=False, default=0, server_default="0")
+    # bumped on every change to the moderator's grants, roles or super flag, outdates permission claims in tokens
+    grants_version = Column(Integer, nullable=False, default=0, server_default="0")
+    session_id = None
 
-    permissions = relationship("ModPerm", cascade="all, delete")
+    permissions = relationship("ModPerm", cascade="all, delete", passive_deletes=True)
+    sessions = relationship("ModSession", cascade="all, delete", passive_deletes=True)
+    roles = relationship("ModRoleAssignment", cascade="all, delete", passive_deletes=True)
 
     class SectionModel(PydanticModel.column_model(id)):
         sections: list[Section.FullModel]
 
         @classmethod
         def callback_convert(cls, callback, orm_object: Moderator, **context) -> None:
-            callback(sections=[Section.FullModel.convert(
-                section, permissions=orm_object.get_section_permissions(section))
-                for section in Section.get_all()])
+            callback(sections=[Section.FullModel.convert(section, permissions=permissions)
+                               for section, permissions in orm_object.get_sections_permissions()])
 
     class PermissionsModel(PydanticModel.column_model(id)):
         permissions: list[Permission.IndexModel]
@@ -64,78 +136,567 @@ class Moderator(Base, Identifiable, UserRole):
 
     @classmethod
     def find_by_id(cls, entry_id: int) -> Moderator | None:
-        return db.get_first(select(cls).filter_by(id=entry_id))
+        return db.get_first(about_moderator(select(cls).filter_by(id=entry_id), entry_id))
+
+    @classmethod
+    def find_by_identity(cls, identity: int | dict) -> Moderator | None:
+        if not isinstance(identity, dict):
+            identity = {"id": identity}
+        moderator = cls.find_live(identity.get("id", None), identity.get("session", None))
+        if moderator is None or moderator.session_epoch != identity.get("epoch", 0):
+            return None
+        moderator.session_id = identity.get("session", None)
+        return moderator
+
+    @classmethod
+    def find_live(cls, entry_id: int, session_id: str | None) -> Moderator | None:
+        """ Moderator, unless `session_id` has ended. Uncached, the session is checked in the same query """
+        if moderator_cache.enabled:
+            moderator = cls.find_cached(entry_id)
+            live = moderator is None or session_id is None or ModSession.is_live(session_id)
+            return moderator if live else None
+
+        stmt = select(cls, ModSession.live_column(session_id)).filter(cls.id == entry_id)
+        row = db.session.execute(about_moderator(stmt, entry_id)).first()
+        if row is None:
+            return None
+        if not row[1] and not ModSession.is_live(session_id):  # a replica can lag behind a new session
+            return None
+        return row[0]
+
+    @classmethod
+    def find_cached(cls, entry_id: int) -> Moderator | None:
+        if not moderator_cache.enabled:
+            return cls.find_by_id(entry_id)
+
+        snapshot = moderator_cache.get(entry_id)
+        if snapshot is None:
+            return cls.find_with_snapshot(entry_id)
+        return db.session.merge(cls.from_snapshot(snapshot), load=False)
+
+    @classmethod
+    def from_snapshot(cls, snapshot: ModeratorSnapshot) -> Moderator:
+        moderator = cls(**snapshot.columns)
+        make_transient_to_detached(moderator)
+        return moderator
+
+    @classmethod
+    def snapshot_stmt(cls, entry_id: int):
+        stmt = select(cls, ModPerm.permission_id, ModPerm.effective_expiry())
+        stmt = stmt.outerjoin(ModPerm, ModPerm.active_for(cls.id)).filter(cls.id == entry_id)
+        return about_moderator(stmt, entry_id)
+
+    @classmethod
+    def cache_snapshot(cls, entry_id: int, rows: list[Row]) -> Moderator | None:
+        if len(rows) == 0:
+            return None
+
+        moderator: Moderator = rows[0][0]
+        columns = {attr.key: getattr(moderator, attr.key) for attr in inspect(cls).column_attrs}
+        permission_ids = frozenset(row[1] for row in rows if row[1] is not None)
+        ttl = get_expiry_ttl(row[2] for row in rows)
+        moderator_cache.put(entry_id, ModeratorSnapshot(columns, permission_ids), ttl)
+        return moderator
 
     @classmethod
-    def find_by_identity(cls, identity: int) -> Moderator | None:
-        return cls.find_by_id(identity)
+    def find_with_snapshot(cls, entry_id: int) -> Moderator | None:
+        return cls.cache_snapshot(entry_id, db.session.execute(cls.snapshot_stmt(entry_id)).all())
+
+    @classmethod
+    def find_token_state(cls, entry_id: int, session_id: str | None = None) -> tuple[int, int] | None:
+        """ Session epoch and grants version, which token claims are checked against, or None for ended sessions """
+        if not moderator_cache.enabled:
+            stmt = select(cls.session_epoch, cls.grants_version, ModSession.live_column(session_id))
+            row = db.session.execute(about_moderator(stmt.filter_by(id=entry_id), entry_id)).first()
+            if row is None or (not row[2] and not ModSession.is_live(session_id)):
+                return None
+            return row[0], row[1]
+
+        if (snapshot := moderator_cache.get(entry_id)) is not None:
+            state = snapshot.columns["session_epoch"], snapshot.columns["grants_version"]
+        elif (moderator := cls.find_with_snapshot(entry_id)) is not None:
+            state = moderator.session_epoch, moderator.grants_version
+        else:
+            return None
+        return state if session_id is None or ModSession.is_live(session_id) else None
+
+    @classmethod
+    async def find_by_id_async(cls, entry_id: int) -> Moderator | None:
+        return await async_db.get_first(select(cls).filter_by(id=entry_id))
+
+    @classmethod
+    async def find_by_name_async(cls, username: str) -> Moderator | None:
+        return await async_db.get_first(select(cls).filter_by(username=username))
+
+    @classmethod
+    async def find_by_identity_async(cls, identity: int | dict) -> Moderator | None:
+        if not isinstance(identity, dict):
+            identity = {"id": identity}
+        moderator = await cls.find_live_async(identity.get("id", None), identity.get("session", None))
+        if moderator is None or moderator.session_epoch != identity.get("epoch", 0):
+            return None
+        moderator.session_id = identity.get("session", None)
+        return moderator
+
+    @classmethod
+    async def find_live_async(cls, entry_id: int, session_id: str | None) -> Moderator | None:
+        if moderator_cache.enabled:
+            moderator = await cls.find_cached_async(entry_id)
+            live = moderator is None or session_id is None or await ModSession.is_live_async(session_id)
+            return moderator if live else None
+
+        stmt = select(cls, ModSession.live_column(session_id)).filter(cls.id == entry_id)
+        row = (await async_db.session.execute(stmt)).first()
+        if row is None:
+            return None
+        if not row[1] and not await ModSession.is_live_async(session_id):
+            return None
+        return row[0]
+
+    @classmethod
+    async def find_cached_async(cls, entry_id: int) -> Moderator | None:
+        if not moderator_cache.enabled:
+            return await cls.find_by_id_async(entry_id)
+
+        snapshot = moderator_cache.get(entry_id)
+        if snapshot is None:
+            rows = (await async_db.session.execute(cls.snapshot_stmt(entry_id))).all()
+            return cls.cache_snapshot(entry_id, rows)
+        return await async_db.session.merge(cls.from_snapshot(snapshot), load=False)
+
+    @classmethod
+    async def find_token_state_async(cls, entry_id: int, session_id: str | None = None) -> tuple[int, int] | None:
+        if not moderator_cache.enabled:
+            stmt = select(cls.session_epoch, cls.grants_version, ModSession.live_column(session_id))
+            row = (await async_db.session.execute(stmt.filter_by(id=entry_id))).first()
+            if row is None or (not row[2] and not await ModSession.is_live_async(session_id)):
+                return None
+            return row[0], row[1]
+
+        if (snapshot := moderator_cache.get(entry_id)) is not None:
+            state = snapshot.columns["session_epoch"], snapshot.columns["grants_version"]
+        elif (moderator := await cls.find_cached_async(entry_id)) is not None:
+            state = moderator.session_epoch, moderator.grants_version
+        else:
+            return None
+        return state if session_id is None or await ModSession.is_live_async(session_id) else None
+
+    @classmethod
+    def find_by_ids(cls, entry_ids: list[int]) -> dict[int, Moderator]:
+        return {moderator.id: moderator for moderator in db.get_all(select(cls).filter(cls.id.in_(entry_ids)))}
 
     @classmethod
     def find_by_name(cls, username: str):
         return db.get_first(select(cls).filter_by(username=username))
 
     @classmethod
-    def search(cls, offset: int, limit: int, search: str | None = None,
-               exclude: int = None) -> list[Moderator]:
+    def find_grants(cls, entry_ids: list[int]) -> dict[int, tuple[bool, frozenset[int], float | None]]:
+        """
+        Super flags, granted permission ids and seconds until the earliest grant expires
+        of many moderators in one query, missing moderators are omitted
+        """
+        stmt = select(cls.id, cls.super, ModPerm.permission_id, ModPerm.effective_expiry())
+        stmt = stmt.outerjoin(ModPerm, ModPerm.active_for(cls.id)).filter(cls.id.in_(entry_ids))
+        rows = db.session.execute(stmt.order_by(cls.id)).all()
+        return {moderator_id: (group[0][1], frozenset(row[2] for row in group if row[2] is not None),
+                               get_expiry_ttl(row[3] for row in group))
+                for moderator_id, group in ((key, list(group)) for key, group in groupby(rows, lambda row: row[0]))}
+
+    @classmethod
+    def find_ids_by_names(cls, usernames: list[str]) -> dict[str, int]:
+        return dict(db.session.execute(select(cls.username, cls.id).filter(cls.username.in_(usernames))).all())
+
+    @classmethod
+    def bundle_register(cls, rows: list[dict]) -> dict[str, int] | None:
+        """
+        Inserts already hashed moderators in one statement, bypassing ORM events, and indexes them for search.
+        If any username is taken by then, nothing is inserted and None is returned
+        """
+        if len(rows) == 0:
+            return {}
+        for row in rows:
+            row["username_lower"] = row["username"].lower()
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(cls.__table__), rows)
+        except IntegrityError:
+            return None
+        created = cls.find_ids_by_names([row["username"] for row in rows])
+        ModeratorTrigram.bundle_reindex(db.session.connection(), {
+            created[row["username"]]: row["username_lower"] for row in rows if row["username"] in created
+        })
+        return created
+
+    @validates("username")
+    def validate_username(self, _key, username: str) -> str:
+        self.username_lower = username.lower()
+        return username
+
+    @classmethod
+    def search_stmt(cls, search: str | None = None, exclude: int = None, prefix: bool = False):
         stmt = select(cls)
         if exclude is not None:
             stmt = stmt.filter(cls.id != exclude)
-        if search is not None:
-            stmt = stmt.filter(cls.username.like(f"%{search}%"))
+        if search is None:
+            return stmt
+
+        search = search.lower()
+        if prefix:
+            return stmt.filter(cls.username_lower.startswith(search, autoescape=True))
+        if len(trigrams := get_trigrams(search)) != 0:
+            stmt = stmt.filter(cls.id.in_(ModeratorTrigram.select_matching(trigrams)))
+        return stmt.filter(cls.username_lower.contains(search, autoescape=True))
+
+    @classmethod
+    def load_permissions(cls):
+        return selectinload(cls.permissions).joinedload(ModPerm.permission)
+
+    @classmethod
+    def search(cls, offset: int, limit: int, search: str | None = None,
+               exclude: int = None, prefix: bool = False) -> list[Moderator]:
+        stmt = cls.search_stmt(search, exclude, prefix).options(cls.load_permissions())
         return db.get_paginated(stmt.order_by(cls.username), offset, limit)
 
+    @classmethod
+    def search_after(cls, cursor: tuple[str, int] | None, limit: int, search: str | None = None,
+                     exclude: int = None, prefix: bool = False) -> list[Moderator]:
+        stmt = cls.search_stmt(search, exclude, prefix)
+        if cursor is not None:
+            username, entry_id = cursor
+            stmt = stmt.filter(or_(cls.username > username, and_(cls.username == username, cls.id > entry_id)))
+        return db.get_all(stmt.options(cls.load_permissions()).order_by(cls.username, cls.id).limit(limit))
+
+    @classmethod
+    def iterate_all(cls, page_size: int, search: str | None = None) -> Iterator[Moderator]:
+        cursor = None
+        while len(moderators := cls.search_after(cursor, page_size, search)) != 0:
+            yield from moderators
+            cursor = moderators[-1].get_cursor()
+
+    @classmethod
+    def iterate_with_direct_grants(cls, batch_size: int) -> Iterator[tuple[Row, list[tuple[int, datetime | None]]]]:
+        """ Yields every moderator with its unexpired direct grants as (permission_id, expires_at), roles excluded """
+        now = utcnow()
+        stmt = select(cls.id, cls.username, cls.super, cls.mode, cls.password,
+                      ModPerm.permission_id, ModPerm.expires_at)
+        stmt = stmt.outerjoin(ModPerm, and_(ModPerm.moderator_id == cls.id, ModPerm.direct.is_(True),
+                                            or_(ModPerm.expires_at.is_(None), ModPerm.expires_at > now)))
+        stmt = stmt.order_by(cls.id).execution_options(yield_per=batch_size)
+        for _, rows in groupby(db.session.execute(stmt), key=lambda row: row[0]):
+            rows = list(rows)
+            yield rows[0], [(row[-2], row[-1]) for row in rows if row[-2] is not None]
+
+    def get_cursor(self) -> tuple[str, int]:
+        return self.username, self.id
+
+    @classmethod
+    def reindex_all(cls, batch_size: int = 1000) -> int:
+        total = 0
+        for moderator in db.session.execute(select(cls)).scalars().yield_per(batch_size):
+            moderator.username_lower = moderator.username.lower()
+            ModeratorTrigram.reindex(db.session.connection(), moderator.id, moderator.username_lower)
+            total += 1
+        return total
+
     def get_permissions(self) -> list[Permission]:
         if self.super:
             return Permission.get_all()
-        return db.get_all(select(Permission).join(ModPerm).filter(ModPerm.moderator_id == self.id))
+        if "permissions" not in inspect(self).unloaded:
+            now = utcnow()
+            return [mod_perm.permission for mod_perm in self.permissions if mod_perm.is_effective(now)]
+        return db.get_all(select(Permission).join(ModPerm).filter(ModPerm.moderator_id == self.id, ModPerm.is_active()))
 
     def get_section_permissions(self, section: Section) -> list[Permission]:
         if self.super:
             return section.permissions
         return ModPerm.find_by_mod_and_section(self.id, section.id)
 
+    def get_permission_ids(self) -> frozenset[int]:
+        if (snapshot := moderator_cache.get(self.id)) is not None:
+            return snapshot.permission_ids
+        stmt = select(ModPerm.permission_id).filter_by(moderator_id=self.id).filter(ModPerm.is_active())
+        return frozenset(db.get_all(about_moderator(stmt, self.id)))
+
+    def get_sections_permissions(self) -> list[tuple[Section, list[Permission]]]:
+        sections = Section.get_all_with_permissions()
+        if self.super:
+            return [(section, list(section.permissions)) for section in sections]
+        granted = self.get_permission_ids()
+        return [(section, [permission for permission in section.permissions if permission.id in granted])
+                for section in sections]
+
     def check_permissions(self, permission_ids: list[int]) -> bool:
-        stmt = select(count(ModPerm)).filter_by(moderator_id=self.id).filter(ModPerm.permission_id.in_(permission_ids))
-        return db.get_first(stmt) == len(permission_ids)
+        if (snapshot := moderator_cache.get(self.id)) is not None:
+            return snapshot.permission_ids.issuperset(permission_ids)
+        stmt = select(count(ModPerm)).filter_by(moderator_id=self.id)
+        stmt = stmt.filter(ModPerm.permission_id.in_(permission_ids), ModPerm.is_active())
+        return db.get_first(about_moderator(stmt, self.id)) == len(permission_ids)
+
+    async def get_permission_ids_async(self) -> frozenset[int]:
+        if (snapshot := moderator_cache.get(self.id)) is not None:
+            return snapshot.permission_ids
+        stmt = select(ModPerm.permission_id).filter_by(moderator_id=self.id).filter(ModPerm.is_active())
+        return frozenset(await async_db.get_all(stmt))
+
+    async def check_permissions_async(self, permission_ids: list[int]) -> bool:
+        if (snapshot := moderator_cache.get(self.id)) is not None:
+            return snapshot.permission_ids.issuperset(permission_ids)
+        stmt = select(count(ModPerm)).filter_by(moderator_id=self.id)
+        stmt = stmt.filter(ModPerm.permission_id.in_(permission_ids), ModPerm.is_active())
+        return await async_db.get_first(stmt) == len(permission_ids)
+
+    def find_grants_expiry(self) -> datetime | None:
+        stmt = select(sql_min(ModPerm.expires_at)).filter_by(moderator_id=self.id, role_count=0)
+        return db.get_first(stmt.filter(ModPerm.expires_at > utcnow()))
+
+    def verify_password(self, password: str) -> bool:
+        if not Moderator.verify_hash(password, self.password):
+            return False
+        if password_hasher.needs_update(self.password):
+            self.password = Moderator.generate_hash(password)
+        return True
+
+    def convert_cached(self, model: type[PydanticModel], catalog_version: int) -> PydanticModel:
+        state = (catalog_version, self.grants_version, self.mode, self.super, self.username)
+        cached = payload_cache.get(self.id)
+        if cached is None or cached[0] != state:
+            ttl = None  # the expiry costs a query, only worth it when the payload is actually cached
+            if payload_cache.enabled and not self.super:
+                ttl = get_expiry_ttl([self.find_grants_expiry()])
+            cached = payload_cache.put(self.id, (state, {}), ttl)
+        payload = cached[1].get(model, None)
+        if payload is None:
+            payload = cached[1][model] = model.convert(self)
+        return payload
+
+    def start_session(self) -> None:
+        self.session_id = ModSession.start(self.id, self.session_epoch).id
+
+    def expire_sessions(self) -> None:
+        self.session_epoch += 1
+        ModSession.delete_by_moderator(self.id)
+
+    @classmethod
+    def bundle_delete(cls, moderator_ids: list[int]) -> int:
+        """ Deletes moderators with their grants, sessions, roles and search index, without loading any of them """
+        if len(moderator_ids) == 0:
+            return 0
+        for moderator_id in moderator_ids:
+            invalidate_moderator_state(moderator_id)
+        return delete_cascading(cls, cls.id.in_(moderator_ids))
+
+    def delete(self) -> None:
+        Moderator.bundle_delete([self.id])
+        db.session.expunge(self)
 
     def get_identity(self):
-        return self.id
+        return {"id": self.id, "epoch": self.session_epoch, "session": self.session_id}
 
 
-class BlockedModToken(Base):  # TODO replace with full session control
-    __tablename__ = "blocked-mod-tokens"
+def bump_grants_version(condition) -> None:
+    """ Outdates token claims of moderators matching `condition` in every process, unlike the in-process caches """
+    db.session.execute(update(Moderator).where(condition).values(grants_version=Moderator.grants_version + 1))
+
+
+@event.listens_for(Moderator, "before_update")
+def bump_super_grants_version(_mapper, _connection, target: Moderator) -> None:
+    if inspect(target).attrs.super.history.has_changes():
+        target.grants_version = Moderator.grants_version + 1
+
+
+@event.listens_for(Moderator, "after_update")
+@event.listens_for(Moderator, "after_delete")
+def invalidate_moderator(_mapper, _connection, target: Moderator) -> None:
+    invalidate_moderator_state(target.id)
+
+
+def get_trigrams(text: str) -> set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class ModeratorTrigram(Base):
+    __tablename__ = "mub-moderator-trigrams"
+    __table_args__ = (Index("ix_mub_moderator_trigrams_trigram", "trigram", "moderator_id"),)
+
+    moderator_id = Column(Integer, ForeignKey("mub-moderators.id", ondelete="CASCADE"), primary_key=True)
+    trigram = Column(String(3), primary_key=True)
+
+    @classmethod
+    def select_matching(cls, trigrams: set[str]):
+        stmt = select(cls.moderator_id).filter(cls.trigram.in_(trigrams)).group_by(cls.moderator_id)
+        return stmt.having(count() == len(trigrams))
+
+    @classmethod
+    def bundle_reindex(cls, connection: Connection, usernames: dict[int, str]) -> None:
+        if len(usernames) == 0:
+            return
+        connection.execute(delete(cls).where(cls.moderator_id.in_(usernames.keys())))
+        rows = [{"moderator_id": moderator_id, "trigram": trigram}
+                for moderator_id, username_lower in usernames.items() for trigram in get_trigrams(username_lower)]
+        if len(rows) != 0:
+            connection.execute(insert(cls), rows)
+
+    @classmethod
+    def reindex(cls, connection: Connection, moderator_id: int, username_lower: str) -> None:
+        connection.execute(delete(cls).where(cls.moderator_id == moderator_id))
+        rows = [{"moderator_id": moderator_id, "trigram": trigram} for trigram in get_trigrams(username_lower)]
+        if len(rows) != 0:
+            connection.execute(insert(cls), rows)
 
-    id = Column(Integer, primary_key=True)
-    jti = Column(String(36), nullable=False)
+
+@event.listens_for(Moderator, "after_insert")
+@event.listens_for(Moderator, "after_update")
+def index_moderator(_mapper, connection: Connection, target: Moderator) -> None:
+    if inspect(target).attrs.username_lower.history.has_changes():
+        ModeratorTrigram.reindex(connection, target.id, target.username_lower)
+
+
+@event.listens_for(Moderator, "before_delete")
+def unindex_moderator(_mapper, connection: Connection, target: Moderator) -> None:
+    connection.execute(delete(ModeratorTrigram).where(ModeratorTrigram.moderator_id == target.id))
 
 
 class ModPerm(Base):
     __tablename__ = "mub-modperms"
 
-    moderator_id = Column(Integer, ForeignKey("mub-moderators.id"), primary_key=True)
-    permission_id = Column(Integer, ForeignKey("mub-permissions.id"), primary_key=True)
+    moderator_id = Column(Integer, ForeignKey("mub-moderators.id", ondelete="CASCADE"), primary_key=True)
+    permission_id = Column(Integer, ForeignKey("mub-permissions.id", ondelete="CASCADE"), primary_key=True)
     permission = relationship("Permission", foreign_keys=[permission_id])
 
+    # a row is the materialized effective grant: it exists while granted directly or by at least one role
+    direct = Column(Boolean, nullable=False, default=True, server_default=true())
+    role_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # the direct grant lapses at expires_at (naive UTC), rows are removed later by :meth:`sweep_expired`
+    expires_at = Column(DateTime, nullable=True, index=True)
+
+    @classmethod
+    def is_active(cls, now: datetime | None = None):
+        return or_(cls.expires_at.is_(None), cls.expires_at > (now or utcnow()), cls.role_count > 0)
+
+    @classmethod
+    def active_for(cls, moderator_id, now: datetime | None = None):
+        return and_(cls.moderator_id == moderator_id, cls.is_active(now))
+
+    @classmethod
+    def effective_expiry(cls):
+        return case((cls.role_count > 0, null()), else_=cls.expires_at)
+
+    def is_effective(self, now: datetime) -> bool:
+        return self.expires_at is None or self.expires_at > now or self.role_count > 0
+
     @classmethod
     def find_by_ids(cls, moderator_id: int, permission_id: int) -> ModPerm | None:
         return db.get_first(select(cls).filter_by(moderator_id=moderator_id, permission_id=permission_id))
 
     @classmethod
-    def create_unique(cls, moderator_id: int, permission_id: int) -> ModPerm | None:
-        if cls.find_by_ids(moderator_id, permission_id) is not None:
-            return None
-        return cls.create(moderator_id=moderator_id, permission_id=permission_id)
+    def create_unique(cls, moderator_id: int, permission_id: int, expires_at: datetime | None = None) -> ModPerm | None:
+        mod_perm = cls.find_by_ids(moderator_id, permission_id)
+        if mod_perm is not None:
+            if mod_perm.direct and mod_perm.expires_at == expires_at:
+                return None
+            invalidate_moderator_state(moderator_id)
+            bump_grants_version(Moderator.id == moderator_id)
+            mod_perm.direct = True
+            mod_perm.expires_at = expires_at
+            return mod_perm
+        invalidate_moderator_state(moderator_id)
+        bump_grants_version(Moderator.id == moderator_id)
+        return cls.create(moderator_id=moderator_id, permission_id=permission_id, expires_at=expires_at)
+
+    @classmethod
+    def find_granted_ids(cls, moderator_id: int, permission_ids: list[int]) -> set[int]:
+        stmt = select(cls.permission_id).filter_by(moderator_id=moderator_id).filter(cls.is_active())
+        return set(db.get_all(about_moderator(stmt.filter(cls.permission_id.in_(permission_ids)), moderator_id)))
+
+    @classmethod
+    async def find_by_ids_async(cls, moderator_id: int, permission_id: int) -> ModPerm | None:
+        return await async_db.get_first(select(cls).filter_by(moderator_id=moderator_id, permission_id=permission_id))
+
+    @classmethod
+    async def find_granted_ids_async(cls, moderator_id: int, permission_ids: list[int]) -> set[int]:
+        stmt = select(cls.permission_id).filter_by(moderator_id=moderator_id).filter(cls.is_active())
+        return set(await async_db.get_all(stmt.filter(cls.permission_id.in_(permission_ids))))
+
+    @classmethod
+    def bundle_create(cls, moderator_id: int, permission_ids: list[int], expires_at: datetime | None = None) -> None:
+        if len(permission_ids) == 0:
+            return
+        invalidate_moderator_state(moderator_id)
+        bump_grants_version(Moderator.id == moderator_id)
+        upsert(cls, [{"moderator_id": moderator_id, "permission_id": permission_id, "direct": True,
+                      "expires_at": expires_at} for permission_id in set(permission_ids)], ["direct", "expires_at"])
 
     @classmethod
     def delete_by_ids(cls, moderator_id: int, permission_id: int) -> bool:
+        invalidate_moderator_state(moderator_id)
         mod_perm = cls.find_by_ids(moderator_id, permission_id)
-        return mod_perm is not None and mod_perm.delete() is None
+        if mod_perm is None or not mod_perm.direct:
+            return False
+        bump_grants_version(Moderator.id == moderator_id)
+        if mod_perm.role_count != 0:
+            mod_perm.direct = False
+            mod_perm.expires_at = None
+            return True
+        return mod_perm.delete() is None
 
     @classmethod
     def bundle_delete(cls, moderator_id: int, permission_ids: list[int]) -> None:
-        db.session.execute(delete(cls).where(cls.moderator_id == moderator_id, cls.permission_id.in_(permission_ids)))
+        invalidate_moderator_state(moderator_id)
+        bump_grants_version(Moderator.id == moderator_id)
+        condition = and_(cls.moderator_id == moderator_id, cls.permission_id.in_(permission_ids))
+        db.session.execute(delete(cls).where(condition, cls.role_count == 0))
+        db.session.execute(update(cls).where(condition).values(direct=False, expires_at=None))
+
+    @classmethod
+    def bundle_revoke(cls, permission_ids: list[int]) -> None:
+        """ Revokes direct grants of permissions from every moderator, grants from roles are kept """
+        clear_moderator_state()
+        condition = and_(cls.permission_id.in_(permission_ids), cls.direct.is_(True))
+        bump_grants_version(Moderator.id.in_(select(cls.moderator_id).where(condition)))
+        db.session.execute(delete(cls).where(condition, cls.role_count == 0))
+        db.session.execute(update(cls).where(condition).values(direct=False, expires_at=None))
+
+    @classmethod
+    def sweep_expired(cls, batch_size: int = 1000) -> int:
+        """ Drops up to `batch_size` lapsed direct grants (found via the expires_at index), returns their count """
+        now = utcnow()
+        stmt = select(cls.moderator_id, cls.permission_id).filter(cls.expires_at <= now).limit(batch_size)
+        expired = [tuple(row) for row in db.session.execute(stmt).all()]
+        if len(expired) == 0:
+            return 0
+
+        condition = and_(tuple_(cls.moderator_id, cls.permission_id).in_(expired), cls.expires_at <= now)
+        moderator_ids = list({moderator_id for moderator_id, _ in expired})
+        bump_grants_version(Moderator.id.in_(moderator_ids))
+        db.session.execute(delete(cls).where(condition, cls.role_count == 0))
+        db.session.execute(update(cls).where(condition).values(direct=False, expires_at=None))
+        for moderator_id in moderator_ids:
+            invalidate_moderator_state(moderator_id)
+        return len(expired)
+
+    @classmethod
+    def delete_by_permissions(cls, permission_ids: list[int]) -> None:
+        clear_moderator_state()
+        condition = cls.permission_id.in_(permission_ids)
+        bump_grants_version(Moderator.id.in_(select(cls.moderator_id).where(condition)))
+        db.session.execute(delete(cls).where(condition))
+
+    @classmethod
+    def bundle_grant(cls, grants: dict[int, list[int]], expiries: dict[int, datetime | None] | None = None) -> None:
+        expiries = expiries or {}
+        for moderator_id in grants:
+            invalidate_moderator_state(moderator_id)
+        bump_grants_version(Moderator.id.in_(list(grants)))
+        insert_ignore(cls, [{"moderator_id": moderator_id, "permission_id": permission_id,
+                             "expires_at": expiries.get(moderator_id, None)}
+                            for moderator_id, permission_ids in grants.items() for permission_id in set(permission_ids)])
 
     @classmethod
     def find_by_mod_and_section(cls, moderator_id: int, section_id: int) -> list[Permission]:
         stmt = select(Permission).filter_by(section_id=section_id).join(cls).filter_by(moderator_id=moderator_id)
-        return db.get_all(stmt)
+        return db.get_all(about_moderator(stmt.filter(cls.is_active()), moderator_id))
+
+    @classmethod
+    async def find_by_mod_and_section_async(cls, moderator_id: int, section_id: int) -> list[Permission]:
+        stmt = select(Permission).filter_by(section_id=section_id).join(cls).filter_by(moderator_id=moderator_id)
+        return await async_db.get_all(stmt.filter(cls.is_active()))
@@ -1,13 +1,18 @@
 from __future__ import annotations
 
+from flask import request
 from flask_fullstack import RequestParser
-from flask_jwt_extended import get_jwt
+from flask_jwt_extended import get_jwt, get_jwt_identity
 from flask_restx import Resource
 
+from ._mub_hashing import sign_in_limiter
+from ._mub_metrics import metrics, sign_ins
 from ._mub_restx import MUBController
-from .moderators_db import Moderator, BlockedModToken, InterfaceMode
+from .moderators_db import Moderator, InterfaceMode
+from .permissions import permission_index
+from .sessions_db import BlockedModToken, ModSession
 
-controller = MUBController("base", path="")
+controller = MUBController("base", path="", read_replica=True)
 
 
 @controller.route("/sign-in/")
@@ -17,24 +22,52 @@ class SignInResource(Resource):
     parser.add_argument("password", type=str, required=True)
 
     @controller.doc_aborts(("200 ", "Moderator does not exist"), (" 200", "Wrong password"))
+    @controller.doc_abort(429, "Too many sign-in attempts")
+    @controller.doc_abort(503, "Server is busy, try again later")
     @controller.with_optional_jwt()
     @controller.argument_parser(parser)
     @controller.marshal_with_authorization(Moderator.SelfModel, auth_name="mub")
     def post(self, username: str, password: str):
+        attempt_keys = (f"username:{username}", f"ip:{request.remote_addr}")
+        if not sign_in_limiter.allows(*attempt_keys):
+            metrics.inc(sign_ins, "limited")
+            controller.abort(429, "Too many sign-in attempts")
+
         moderator = Moderator.find_by_name(username)
         if moderator is None:
+            sign_in_limiter.record(*attempt_keys)
+            metrics.inc(sign_ins, "unknown-moderator")
             return "Moderator does not exist"
 
-        if Moderator.verify_hash(password, moderator.password):
-            return moderator, moderator
+        if moderator.verify_password(password):
+            sign_in_limiter.reset(attempt_keys[0])
+            metrics.inc(sign_ins, "success")
+            moderator.start_session()
+            return moderator.convert_cached(Moderator.SelfModel, permission_index.version), moderator
+        sign_in_limiter.record(*attempt_keys)
+        metrics.inc(sign_ins, "wrong-password")
         return "Wrong password"
 
 
+@controller.route("/refresh/")
+class RefreshResource(Resource):
+    @controller.jwt_authorizer(Moderator)
+    @controller.marshal_with_authorization(Moderator.SelfModel, auth_name="mub")
+    def post(self, moderator: Moderator, **_):
+        if moderator.session_id is not None:
+            ModSession.extend(moderator.session_id)
+        return moderator.convert_cached(Moderator.SelfModel, permission_index.version), moderator
+
+
 @controller.route("/sign-out/")
 class SignOutResource(Resource):
     @controller.removes_authorization(auth_name="mub")
     def post(self):
-        BlockedModToken.create(jti=get_jwt()["jti"])
+        jwt = get_jwt()
+        BlockedModToken.block(jwt["jti"], jwt.get("exp", None))
+        identity = (get_jwt_identity() or {}).get("mub", None)
+        if isinstance(identity, dict) and identity.get("session", None) is not None:
+            ModSession.end(identity["session"])
         return True
 
 
@@ -43,7 +76,7 @@ class PermissionsResource(Resource):
     @controller.jwt_authorizer(Moderator)  # TODO pagination for permissions?
     @controller.marshal_with(Moderator.SelfModel)
     def get(self, moderator, **_):
-        return moderator
+        return moderator.convert_cached(Moderator.SelfModel, permission_index.version)
 
     parser = RequestParser()
     parser.add_argument("mode", required=False)
@@ -1,21 +1,189 @@
 from __future__ import annotations
 
+from abc import ABC, abstractmethod
+from collections.abc import Callable, Iterator
 from dataclasses import dataclass
+from datetime import timezone
 from functools import wraps
+from hashlib import sha1
+from threading import RLock
+from time import perf_counter, monotonic, time
 
-from flask_fullstack import get_or_pop
+from flask_fullstack import get_or_pop, UserRole
 
 from common import ResourceController
-from .moderators_db import Moderator, ModPerm
-from .permissions_db import Section, Permission
+from ._mub_async import resolve
+from ._mub_metrics import metrics, permission_check_duration, permission_checks
+from .moderators_db import Moderator, ModPerm, moderator_cache, payload_cache, grants_cache, clear_moderator_state
+from .permissions_db import Section, Permission, CatalogState
+from .roles_db import RolePerm
 
 
-class SectionInt(str):
-    pass
+class PermissionExpression(ABC):
+    """
+    Boolean expression over permissions, built with `&`, `|` and `~` from :class:`PermissionInt` and
+    :class:`SectionInt` (which stands for "any permission of the section").
+    Expressions are compiled into a single predicate over the moderator's permission bitmask
+    """
 
+    def __and__(self, other: PermissionExpression) -> PermissionExpression:
+        return AllOf(self, other)
 
-class PermissionInt(str):
-    pass
+    def __or__(self, other: PermissionExpression) -> PermissionExpression:
+        return AnyOf(self, other)
+
+    def __invert__(self) -> PermissionExpression:
+        return NotOf(self)
+
+    @abstractmethod
+    def describe(self) -> str:
+        pass
+
+    def leaves(self) -> Iterator[PermissionExpression]:
+        yield self
+
+    @abstractmethod
+    def compile(self, index: PermissionIndex) -> Callable[[int], bool]:
+        pass
+
+
+class SectionInt(str, PermissionExpression):
+    def describe(self) -> str:
+        return self + " *"
+
+    def compile(self, index: PermissionIndex) -> Callable[[int], bool]:
+        mask = index.get_section_mask(self)
+        return lambda granted: granted & mask != 0
+
+
+class PermissionInt(str, PermissionExpression):
+    def describe(self) -> str:
+        return self
+
+    def compile(self, index: PermissionIndex) -> Callable[[int], bool]:
+        mask = index.get_required_mask(self)
+        return lambda granted: granted & mask == mask
+
+
+class AllOf(PermissionExpression):
+    def __init__(self, *operands: PermissionExpression):
+        self.operands: tuple[PermissionExpression, ...] = tuple(
+            nested for operand in operands
+            for nested in (operand.operands if isinstance(operand, AllOf) else (operand,)))
+
+    def describe(self) -> str:
+        return "(" + " & ".join(operand.describe() for operand in self.operands) + ")"
+
+    def leaves(self) -> Iterator[PermissionExpression]:
+        for operand in self.operands:
+            yield from operand.leaves()
+
+    def compile(self, index: PermissionIndex) -> Callable[[int], bool]:
+        required = index.get_required_mask(*(op for op in self.operands if isinstance(op, PermissionInt)))
+        checks = [op.compile(index) for op in self.operands if not isinstance(op, PermissionInt)]
+        if len(checks) == 0:
+            return lambda granted: granted & required == required
+        return lambda granted: granted & required == required and all(check(granted) for check in checks)
+
+
+class AnyOf(PermissionExpression):
+    def __init__(self, *operands: PermissionExpression):
+        self.operands: tuple[PermissionExpression, ...] = tuple(
+            nested for operand in operands
+            for nested in (operand.operands if isinstance(operand, AnyOf) else (operand,)))
+
+    def describe(self) -> str:
+        return "(" + " | ".join(operand.describe() for operand in self.operands) + ")"
+
+    def leaves(self) -> Iterator[PermissionExpression]:
+        for operand in self.operands:
+            yield from operand.leaves()
+
+    def compile(self, index: PermissionIndex) -> Callable[[int], bool]:
+        # single permissions and section wildcards are all "any bit of" checks, so they merge into one mask
+        mask = index.get_required_mask(*(op for op in self.operands if isinstance(op, PermissionInt)))
+        for section in (op for op in self.operands if isinstance(op, SectionInt)):
+            mask |= index.get_section_mask(section)
+        checks = [op.compile(index) for op in self.operands if not isinstance(op, (PermissionInt, SectionInt))]
+        if len(checks) == 0:
+            return lambda granted: granted & mask != 0
+        return lambda granted: granted & mask != 0 or any(check(granted) for check in checks)
+
+
+class NotOf(PermissionExpression):
+    def __init__(self, operand: PermissionExpression):
+        self.operand: PermissionExpression = operand
+
+    def __invert__(self) -> PermissionExpression:
+        return self.operand
+
+    def describe(self) -> str:
+        return "~" + self.operand.describe()
+
+    def leaves(self) -> Iterator[PermissionExpression]:
+        yield from self.operand.leaves()
+
+    def compile(self, index: PermissionIndex) -> Callable[[int], bool]:
+        check = self.operand.compile(index)
+        return lambda granted: not check(granted)
+
+
+@dataclass
+class ModeratorClaims(UserRole):
+    id: int
+    super: bool
+    permissions: int
+    version: str
+    epoch: int = 0
+    session: str | None = None
+    until: float | None = None  # permissions are baked in only until the earliest time-limited grant expires
+    grants: int = 0  # claims are rejected once the moderator's grants_version moves past it
+
+    unauthorized_error = Moderator.unauthorized_error
+
+    @staticmethod
+    def is_claims(identity: int | dict) -> bool:
+        return permission_index.token_claims and isinstance(identity, dict) and "permissions" in identity
+
+    @classmethod
+    def from_identity(cls, identity: dict) -> ModeratorClaims:
+        return cls(identity["id"], identity["super"], identity["permissions"], identity["version"],
+                   identity.get("epoch", 0), identity.get("session", None), identity.get("until", None),
+                   identity.get("grants", 0))
+
+    @staticmethod
+    def is_outdated(identity: dict) -> bool:
+        return identity.get("until", None) is not None and identity["until"] <= time()
+
+    @classmethod
+    def find_by_identity(cls, identity: int | dict) -> ModeratorClaims | Moderator | None:
+        if not cls.is_claims(identity):
+            return Moderator.find_by_identity(identity)
+        if cls.is_outdated(identity):
+            return Moderator.find_by_identity(identity)
+        if not permission_index.accepts_fingerprint(identity.get("version", None)):
+            return None
+        state = Moderator.find_token_state(identity["id"], identity.get("session", None))
+        if state != (identity.get("epoch", 0), identity.get("grants", 0)):
+            return None
+        return cls.from_identity(identity)
+
+    @classmethod
+    async def find_by_identity_async(cls, identity: int | dict) -> ModeratorClaims | Moderator | None:
+        if not cls.is_claims(identity):
+            return await Moderator.find_by_identity_async(identity)
+        if cls.is_outdated(identity):
+            return await Moderator.find_by_identity_async(identity)
+        if not permission_index.accepts_fingerprint(identity.get("version", None)):
+            return None
+        state = await Moderator.find_token_state_async(identity["id"], identity.get("session", None))
+        if state != (identity.get("epoch", 0), identity.get("grants", 0)):
+            return None
+        return cls.from_identity(identity)
+
+    def get_identity(self) -> dict:
+        return {"id": self.id, "super": self.super, "permissions": self.permissions, "version": self.version,
+                "epoch": self.epoch, "session": self.session, "until": self.until, "grants": self.grants}
 
 
 @dataclass
@@ -23,54 +191,381 @@ class PermissionIndex:
     sections: dict[str, set[str]] = None
     sections_dict: dict[str, id] = None
     permission_dict: dict[str, int] = None
+    bit_dict: dict[int, int] = None
+    fingerprint: str = None
+    version: int = 0
+    stale_sections: dict[str, int] = None
+    stale_permissions: dict[str, int] = None
     initialized: bool = False
+    token_claims: bool = False
+    compiled: dict[PermissionExpression, Callable[[int], bool] | None] = None
+    compatible_fingerprints: set[str] = None
+    refresh_interval: float = 5.0
+    next_refresh: float = 0.0
 
     def __post_init__(self):
         self.sections = {}
+        self.compiled = {}
+        self.compatible_fingerprints = set()
+        self.lock = RLock()
 
     def add_section(self, name: str) -> SectionInt:
-        if self.initialized:
-            raise RuntimeError("Dynamically adding sections after initialization is not supported")
-        if name in self.sections:
-            raise KeyError(f"Section {name} is already created")
-        self.sections[name] = set()
+        """ After initialization, the section is also created in the database (inside an app context, not committed) """
+        with self.lock:
+            if name in self.sections:
+                raise KeyError(f"Section {name} is already created")
+            self.sections[name] = set()
+            if self.initialized:
+                self.extend_catalog([name])
         return SectionInt(name)
 
     def add_permission(self, section: SectionInt, name: str) -> PermissionInt:
-        if self.initialized:
-            raise RuntimeError("Dynamically adding permissions after initialization is not supported")
-        if section not in self.sections:
-            raise KeyError(f"Section {section} is not created")
-        if name in self.sections[section]:
-            raise KeyError(f"Permission {section} is already created")
-        self.sections[section].add(name)
+        """ After initialization, the permission is also created in the database (inside an app context, not committed) """
+        with self.lock:
+            if section not in self.sections:
+                raise KeyError(f"Section {section} is not created")
+            if name in self.sections[section]:
+                raise KeyError(f"Permission {section} is already created")
+            self.sections[section].add(name)
+            if self.initialized:
+                self.extend_catalog([section])
         return PermissionInt(section + " " + name)
 
-    def initialize(self):
+    def extend_catalog(self, section_names: list[str]) -> None:
+        missing_sections = [name for name in section_names if name not in self.sections_dict]
+        if len(missing_sections) != 0:
+            Section.bundle_create(missing_sections)
+            self.merge_catalog(Section.get_catalog_rows(missing_sections))
+
+        for section_name in section_names:
+            missing = [name for name in self.sections[section_name]
+                       if section_name + " " + name not in self.permission_dict]
+            if len(missing) != 0:
+                Permission.bundle_create(self.sections_dict[section_name], missing)
+        rows = Section.get_catalog_rows(section_names)
+        conflicts = self.has_bit_conflicts(rows)
+        self.merge_catalog(rows)
+        if conflicts:
+            self.reload_catalog()
+        self.version = CatalogState.bump(self.get_declared_fingerprint())
+
+    def merge_catalog(self, rows, declare: bool = False) -> bool:
+        """
+        Adds sections and permissions from `rows` that are not in the index yet, in place.
+        A permission's bit is stored with it, so masks and token claims issued before stay valid
+        and every worker with the same catalog (and fingerprint) agrees on them
+        """
+        added = {}
+        for section_name, section_id, permission_name, permission_id, bit in rows:
+            if declare:
+                self.sections.setdefault(section_name, set())
+                if permission_name is not None:
+                    self.sections[section_name].add(permission_name)
+            if section_name not in self.sections:
+                continue
+            self.sections_dict[section_name] = section_id
+            self.stale_sections.pop(section_name, None)
+            name = f"{section_name} {permission_name}"
+            if permission_id is None or permission_name not in self.sections[section_name] \
+                    or name in self.permission_dict:
+                continue
+            self.stale_permissions.pop(name, None)
+            self.permission_dict[name] = permission_id
+            added[permission_id] = bit
+
+        if len(added) != 0:
+            self.bit_dict.update((permission_id, bit) for permission_id, bit in added.items() if bit is not None)
+            self.compatible_fingerprints.add(self.fingerprint)
+            self.update_fingerprint()
+        return len(added) != 0
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Picks up catalog changes made by other workers: checks the catalog version at most once per
+        `refresh_interval` and loads only the rows added since. Anything else (e.g. pruning) reloads the catalog
+        """
+        if not self.initialized or (not force and monotonic() < self.next_refresh):
+            return False
+        self.next_refresh = monotonic() + self.refresh_interval
+        version = CatalogState.find_version()
+        if version is None or version == self.version:
+            return False
+
+        with self.lock:
+            if version == self.version:
+                return False
+            known_sections = [*self.sections_dict.values(), *self.stale_sections.values()]
+            known_permissions = [*self.permission_dict.values(), *self.stale_permissions.values()]
+            rows = Section.get_catalog_rows(after_section_id=max(known_sections, default=0),
+                                            after_permission_id=max(known_permissions, default=0))
+            conflicts = self.has_bit_conflicts(rows)
+            if not self.merge_catalog(rows, declare=True) or conflicts:
+                self.reload_catalog()
+            self.version = version
+        return True
+
+    def get_declared_fingerprint(self) -> str:
+        catalog = sorted(f"{section} {name}" for section, names in self.sections.items() for name in names)
+        catalog.extend(sorted(f"{section} " for section in self.sections))
+        return sha1("\n".join(catalog).encode("utf-8")).hexdigest()
+
+    def has_bit_conflicts(self, rows) -> bool:
+        """ Whether a known permission's bit now belongs to another one (it was deleted), only a reload can tell """
+        owners = {bit: permission_id for permission_id, bit in self.bit_dict.items()}
+        return any(row[3] is not None and owners.get(row[4], row[3]) != row[3] for row in rows)
+
+    def reload_catalog(self) -> None:
+        self.load_catalog(Section.get_catalog_rows())
+        self.reset_layout()
+        clear_moderator_state()
+
+    def load_catalog(self, rows) -> bool:
         self.permission_dict = {}
+        self.bit_dict = {}
         self.sections_dict = {}
+        self.stale_sections = {}
+        self.stale_permissions = {}
+
+        for section_name, section_id, permission_name, permission_id, bit in rows:
+            declared = self.sections.get(section_name, None)
+            if declared is None:
+                self.stale_sections[section_name] = section_id
+            else:
+                self.sections_dict[section_name] = section_id
+            if permission_id is None:
+                continue
+            if declared is not None and permission_name in declared:
+                self.permission_dict[section_name + " " + permission_name] = permission_id
+                if bit is not None:
+                    self.bit_dict[permission_id] = bit
+            else:
+                self.stale_permissions[section_name + " " + permission_name] = permission_id
+
+        return len(self.sections_dict) == len(self.sections) and len(self.bit_dict) == len(self.permission_dict) \
+            and len(self.permission_dict) == sum(len(names) for names in self.sections.values())
+
+    def reconcile(self) -> None:
+        missing_sections = [name for name in self.sections if name not in self.sections_dict]
+        if len(missing_sections) != 0:
+            Section.bundle_create(missing_sections)
+            self.load_catalog(Section.get_catalog_rows())
 
         for section_name, permissions in self.sections.items():
-            section = Section.find_by_name_or_create(section_name)
-            self.sections_dict[section_name] = section.id
+            missing = [name for name in permissions if section_name + " " + name not in self.permission_dict]
+            if len(missing) != 0:
+                Permission.bundle_create(self.sections_dict[section_name], missing)
+        Permission.assign_bits()  # for rows created before bits were stored
+        self.load_catalog(Section.get_catalog_rows())
+
+    def initialize(self):
+        fingerprint = self.get_declared_fingerprint()
+        state = CatalogState.find_current()
+        complete = self.load_catalog(Section.get_catalog_rows())
 
-            for permission_name in permissions:
-                permission = Permission.find_by_name_or_create(permission_name, section_id=section.id)
-                self.permission_dict[section_name + " " + permission_name] = permission.id
+        if state is None or state.fingerprint != fingerprint or not complete:
+            self.reconcile()
+            self.version = CatalogState.bump(fingerprint)
+        else:
+            self.version = state.version
 
+        self.reset_layout()
         self.initialized = True
-        # TODO check if database has more permissions, than self does
+
+    def prune_stale(self) -> list[str]:
+        pruned = list(self.stale_permissions.keys())
+        if len(pruned) != 0:
+            ModPerm.delete_by_permissions(list(self.stale_permissions.values()))
+            RolePerm.delete_by_permissions(list(self.stale_permissions.values()))
+            Permission.bundle_delete(list(self.stale_permissions.values()))
+        if len(self.stale_sections) != 0:
+            Section.bundle_delete(list(self.stale_sections.values()))
+        if len(pruned) != 0 or len(self.stale_sections) != 0:
+            self.version = CatalogState.bump()
+        self.stale_sections = {}
+        self.stale_permissions = {}
+        return pruned
+
+    def forget_section(self, name: str) -> None:
+        """ Drops a deleted stale section and its permissions from the index """
+        self.stale_sections.pop(name, None)
+        prefix = name + " "
+        self.stale_permissions = {key: value for key, value in self.stale_permissions.items()
+                                  if not key.startswith(prefix)}
+        clear_moderator_state()
+        self.version = CatalogState.bump()
+
+    def reset_layout(self) -> None:
+        """ Forgets fingerprints kept compatible by merge_catalog, after the catalog was reloaded """
+        self.compatible_fingerprints = set()
+        self.update_fingerprint()
+
+    def update_fingerprint(self) -> None:
+        catalog = sorted(f"{name}:{perm_id}:{self.bit_dict.get(perm_id, None)}"
+                         for name, perm_id in self.permission_dict.items())
+        self.fingerprint = sha1("\n".join(catalog).encode("utf-8")).hexdigest()[:16]
+        self.compiled = {expression: expression.compile(self) for expression in self.compiled}
+
+    def accepts_fingerprint(self, fingerprint: str | None) -> bool:
+        return fingerprint == self.fingerprint or fingerprint in self.compatible_fingerprints
+
+    def get_mask(self, permission_ids: frozenset[int] | list[int]) -> int:
+        return sum(1 << self.bit_dict[perm_id] for perm_id in permission_ids if perm_id in self.bit_dict)
+
+    def get_required_mask(self, *permissions: PermissionInt) -> int:
+        return self.get_mask([self.permission_dict[permission] for permission in permissions])
+
+    def get_section_mask(self, section: SectionInt) -> int:
+        prefix = section + " "
+        return self.get_mask([perm_id for name, perm_id in self.permission_dict.items() if name.startswith(prefix)])
+
+    def register_expression(self, expression: PermissionExpression) -> None:
+        for leaf in expression.leaves():
+            if isinstance(leaf, SectionInt):
+                if leaf not in self.sections:
+                    raise KeyError(f"Section {leaf} is not created")
+            elif leaf.partition(" ")[2] not in self.sections.get(leaf.partition(" ")[0], ()):
+                raise KeyError(f"Permission {leaf} is not created")
+        if expression not in self.compiled:
+            self.compiled[expression] = expression.compile(self) if self.initialized else None
+
+    def evaluate(self, expression: PermissionExpression, granted: int) -> bool:
+        if (check := self.compiled.get(expression, None)) is None:
+            check = self.compiled[expression] = expression.compile(self)
+        return check(granted)
+
+    def get_moderator_mask(self, moderator: Moderator | ModeratorClaims) -> int:
+        if isinstance(moderator, ModeratorClaims):
+            return moderator.permissions
+        return self.get_mask(moderator.get_permission_ids())
+
+    def check_mask(self, moderator: Moderator | ModeratorClaims, required: int) -> bool:
+        return moderator.super or self.get_moderator_mask(moderator) & required == required
+
+    async def get_moderator_mask_async(self, moderator: Moderator | ModeratorClaims) -> int:
+        if isinstance(moderator, ModeratorClaims):
+            return moderator.permissions
+        return self.get_mask(await moderator.get_permission_ids_async())
+
+    async def check_mask_async(self, moderator: Moderator | ModeratorClaims, required: int) -> bool:
+        return moderator.super or await self.get_moderator_mask_async(moderator) & required == required
+
+    @staticmethod
+    def record_check(label: str, start: float, permitted: bool) -> None:
+        metrics.observe(permission_check_duration, perf_counter() - start, label)
+        metrics.inc(permission_checks, label, "allow" if permitted else "deny")
+
+    def check_required(self, moderator: Moderator | ModeratorClaims, required: int, label: str) -> bool:
+        if not metrics.enabled:
+            return self.check_mask(moderator, required)
+        start = perf_counter()
+        permitted = self.check_mask(moderator, required)
+        self.record_check(label, start, permitted)
+        return permitted
+
+    async def check_required_async(self, moderator: Moderator | ModeratorClaims, required: int, label: str) -> bool:
+        if not metrics.enabled:
+            return await self.check_mask_async(moderator, required)
+        start = perf_counter()
+        permitted = await self.check_mask_async(moderator, required)
+        self.record_check(label, start, permitted)
+        return permitted
+
+    def check_expression(self, moderator: Moderator | ModeratorClaims, expression: PermissionExpression,
+                         label: str) -> bool:
+        start = perf_counter() if metrics.enabled else None
+        permitted = moderator.super or self.evaluate(expression, self.get_moderator_mask(moderator))
+        if start is not None:
+            self.record_check(label, start, permitted)
+        return permitted
+
+    async def check_expression_async(self, moderator: Moderator | ModeratorClaims, expression: PermissionExpression,
+                                     label: str) -> bool:
+        start = perf_counter() if metrics.enabled else None
+        permitted = moderator.super or self.evaluate(expression, await self.get_moderator_mask_async(moderator))
+        if start is not None:
+            self.record_check(label, start, permitted)
+        return permitted
+
+    def check_many(self, checks: list[tuple[int, str]]) -> list[bool]:
+        """
+        Answers many (moderator id, permission name) questions with at most one query for moderators missing from
+        `grants_cache`, unknown moderators and permissions are answered with False
+        """
+        moderator_ids = {moderator_id for moderator_id, _ in checks}
+        grants = {moderator_id: grants_cache.get(moderator_id) for moderator_id in moderator_ids}
+        missing = [moderator_id for moderator_id, granted in grants.items() if granted is None]
+        if len(missing) != 0:
+            found = Moderator.find_grants(missing)
+            for moderator_id in missing:  # missing moderators are cached as holding nothing
+                is_super, granted, ttl = found.get(moderator_id, (False, frozenset(), None))
+                grants[moderator_id] = grants_cache.put(moderator_id, (is_super, granted), ttl)
+
+        results = []
+        for moderator_id, permission in checks:
+            is_super, granted = grants[moderator_id]
+            permission_id = self.permission_dict.get(permission, None)
+            results.append(permission_id is not None and (is_super or permission_id in granted))
+        return results
+
+    def enable_token_claims(self) -> None:
+        self.token_claims = True
+
+    def issue_claims(self, moderator: Moderator) -> ModeratorClaims:
+        expiry = None if moderator.super else moderator.find_grants_expiry()
+        return ModeratorClaims(moderator.id, moderator.super, self.get_moderator_mask(moderator), self.fingerprint,
+                               moderator.session_epoch, moderator.session_id,
+                               None if expiry is None else expiry.replace(tzinfo=timezone.utc).timestamp(),
+                               moderator.grants_version)
+
+    def _authorizer(self, ns: ResourceController, use_moderator: bool):
+        if use_moderator:
+            return ns.jwt_authorizer(Moderator)
+        return ns.jwt_authorizer(ModeratorClaims, result_field_name="moderator")
+
+    def _authorizer_async(self, ns: ResourceController, use_moderator: bool):
+        if use_moderator:
+            return ns.jwt_authorizer_async(Moderator)
+        return ns.jwt_authorizer_async(ModeratorClaims, result_field_name="moderator")
+
+    @staticmethod
+    def enable_cache(max_size: int = 1024, ttl: float = 60.0, payloads: bool = True) -> None:
+        moderator_cache.configure(max_size, ttl)
+        payload_cache.configure(max_size, ttl, enabled=payloads)
+
+    @staticmethod
+    def enable_grants_cache(max_size: int = 65536, ttl: float = 5.0) -> None:
+        grants_cache.configure(max_size, ttl)
+
+    @staticmethod
+    def disable_grants_cache() -> None:
+        grants_cache.configure(enabled=False)
+
+    @staticmethod
+    def grants_cache_stats() -> dict[str, int | float | None]:
+        return grants_cache.stats()
+
+    @staticmethod
+    def disable_cache() -> None:
+        moderator_cache.configure(enabled=False)
+        payload_cache.configure(enabled=False)
+
+    @staticmethod
+    def cache_stats() -> dict[str, int | float | None]:
+        return moderator_cache.stats()
+
+    @staticmethod
+    def payload_cache_stats() -> dict[str, int | float | None]:
+        return payload_cache.stats()
 
     def require_permission(self, ns: ResourceController, permission: PermissionInt,
                            use_moderator: bool = True, optional: bool = False):
         def require_permission_wrapper(function):
             @ns.doc_abort(403, "Not sufficient permissions")
             @wraps(function)
-            @ns.jwt_authorizer(Moderator)
+            @self._authorizer(ns, use_moderator)
             def require_permission_inner(*args, **kwargs):
                 moderator = get_or_pop(kwargs, "moderator", use_moderator)
-                declined = (not moderator.super
-                            and ModPerm.find_by_ids(moderator.id, self.permission_dict[permission]) is None)
+                declined = not self.check_required(moderator, self.get_required_mask(permission), permission)
 
                 if optional:
                     kwargs["permitted"] = not declined
@@ -84,14 +579,15 @@ class PermissionIndex:
 
     def require_permissions(self, ns: ResourceController, *permissions: PermissionInt,
                             use_moderator: bool = True, optional: bool = False):
+        label = ",".join(sorted(permissions))
+
         def require_permissions_wrapper(function):
             @ns.doc_abort(403, "Not sufficient permissions")
             @wraps(function)
-            @ns.jwt_authorizer(Moderator)
+            @self._authorizer(ns, use_moderator)
             def require_permissions_inner(*args, **kwargs):
                 moderator = get_or_pop(kwargs, "moderator", use_moderator)
-                perms = (self.permission_dict[perm] for perm in permissions)
-                permitted = moderator.super or moderator.check_permissions(list(perms))
+                permitted = self.check_required(moderator, self.get_required_mask(*permissions), label)
 
                 if optional:
                     kwargs["permitted"] = permitted
@@ -103,5 +599,95 @@ class PermissionIndex:
 
         return require_permissions_wrapper
 
+    def require(self, ns: ResourceController, expression: PermissionExpression,
+                use_moderator: bool = True, optional: bool = False):
+        """ Same as :meth:`require_permissions`, but for a whole :class:`PermissionExpression` checked at once """
+        self.register_expression(expression)
+        label = expression.describe()
+
+        def require_wrapper(function):
+            @ns.doc_abort(403, "Not sufficient permissions")
+            @wraps(function)
+            @self._authorizer(ns, use_moderator)
+            def require_inner(*args, **kwargs):
+                moderator = get_or_pop(kwargs, "moderator", use_moderator)
+                permitted = self.check_expression(moderator, expression, label)
+
+                if optional:
+                    kwargs["permitted"] = permitted
+                elif not permitted:
+                    ns.abort(403, "Not sufficient permissions")
+                return function(*args, **kwargs)
+
+            return require_inner
+
+        return require_wrapper
+
+    def require_permission_async(self, ns: ResourceController, permission: PermissionInt,
+                                 use_moderator: bool = True, optional: bool = False):
+        def require_permission_wrapper(function):
+            @ns.doc_abort(403, "Not sufficient permissions")
+            @wraps(function)
+            @self._authorizer_async(ns, use_moderator)
+            async def require_permission_inner(*args, **kwargs):
+                moderator = get_or_pop(kwargs, "moderator", use_moderator)
+                required = self.get_required_mask(permission)
+                declined = not await self.check_required_async(moderator, required, permission)
+
+                if optional:
+                    kwargs["permitted"] = not declined
+                elif declined:
+                    ns.abort(403, "Not sufficient permissions")
+                return await resolve(function(*args, **kwargs))
+
+            return require_permission_inner
+
+        return require_permission_wrapper
+
+    def require_permissions_async(self, ns: ResourceController, *permissions: PermissionInt,
+                                  use_moderator: bool = True, optional: bool = False):
+        label = ",".join(sorted(permissions))
+
+        def require_permissions_wrapper(function):
+            @ns.doc_abort(403, "Not sufficient permissions")
+            @wraps(function)
+            @self._authorizer_async(ns, use_moderator)
+            async def require_permissions_inner(*args, **kwargs):
+                moderator = get_or_pop(kwargs, "moderator", use_moderator)
+                permitted = await self.check_required_async(moderator, self.get_required_mask(*permissions), label)
+
+                if optional:
+                    kwargs["permitted"] = permitted
+                elif not permitted:
+                    ns.abort(403, "Not sufficient permissions")
+                return await resolve(function(*args, **kwargs))
+
+            return require_permissions_inner
+
+        return require_permissions_wrapper
+
+    def require_async(self, ns: ResourceController, expression: PermissionExpression,
+                      use_moderator: bool = True, optional: bool = False):
+        self.register_expression(expression)
+        label = expression.describe()
+
+        def require_wrapper(function):
+            @ns.doc_abort(403, "Not sufficient permissions")
+            @wraps(function)
+            @self._authorizer_async(ns, use_moderator)
+            async def require_inner(*args, **kwargs):
+                moderator = get_or_pop(kwargs, "moderator", use_moderator)
+                permitted = await self.check_expression_async(moderator, expression, label)
+
+                if optional:
+                    kwargs["permitted"] = permitted
+                elif not permitted:
+                    ns.abort(403, "Not sufficient permissions")
+                return await resolve(function(*args, **kwargs))
+
+            return require_inner
+
+        return require_wrapper
+
 
 permission_index: PermissionIndex = PermissionIndex()
@@ -1,13 +1,16 @@
 from __future__ import annotations
 
+from itertools import count
 from typing import Type, TypeVar
 
 from flask_fullstack import PydanticModel, Identifiable
-from sqlalchemy import Column, ForeignKey, select
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, ForeignKey, UniqueConstraint, select, update, func, or_
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import relationship, joinedload
 from sqlalchemy.sql.sqltypes import Integer, String
 
 from common import Base, db
+from ._mub_sql import insert_ignore, delete_cascading
 
 t = TypeVar("t", bound="ModBase")
 
@@ -24,6 +27,10 @@ class LocalBase(Base, Identifiable):
     def find_by_id(cls: Type[t], entity_id: int) -> t | None:
         return db.get_first(select(cls).filter_by(id=entity_id))
 
+    @classmethod
+    def find_existing_ids(cls: Type[t], entity_ids: list[int]) -> set[int]:
+        return set(db.get_all(select(cls.id).filter(cls.id.in_(entity_ids))))
+
     @classmethod
     def find_by_name(cls: Type[t], name: str) -> t | None:
         return db.get_first(select(cls).filter_by(name=name))
@@ -37,7 +44,9 @@ class LocalBase(Base, Identifiable):
 
     @classmethod
     def search(cls: Type[t], offset: int, limit: int, search: str | None = None) -> list[t]:
-        stmt = select(cls) if search is None else select(cls).filter(cls.name.like(f"%{search}%"))
+        stmt = select(cls)
+        if search is not None:
+            stmt = stmt.filter(func.lower(cls.name).contains(search.lower(), autoescape=True))
         return db.get_paginated(stmt.order_by(cls.name), offset, limit)
 
     @classmethod
@@ -47,19 +56,75 @@ class LocalBase(Base, Identifiable):
 
 class Permission(LocalBase):
     __tablename__ = "mub-permissions"
+    __table_args__ = (UniqueConstraint("section_id", "name"),)
 
     section = relationship("Section", back_populates="permissions")
-    section_id = Column(Integer, ForeignKey("mub-sections.id"), nullable=False)
+    section_id = Column(Integer, ForeignKey("mub-sections.id", ondelete="CASCADE"), nullable=False)
+    bit = Column(Integer, nullable=True, unique=True)  # position in permission masks, see assign_bits
 
     @classmethod
     def find_by_section(cls, section_id: int) -> list[Permission]:
         return db.get_first(select(cls).filter_by(section_id=section_id))
 
+    @classmethod
+    def bundle_create(cls, section_id: int, names: list[str]) -> None:
+        insert_ignore(cls, [{"section_id": section_id, "name": name} for name in names])
+        cls.assign_bits()
+
+    @classmethod
+    def assign_bits(cls) -> None:
+        """
+        Gives permissions without a bit the lowest free ones, in id order. Bits are stored so that every worker
+        agrees on them, and stay dense (masks and token claims don't grow with ids): freed bits are handed out again
+        """
+        missing = db.get_all(select(cls.id).filter(cls.bit.is_(None)).order_by(cls.id))
+        if len(missing) == 0:
+            return
+        taken = set(db.get_all(select(cls.bit).filter(cls.bit.is_not(None))))
+        free = (bit for bit in count() if bit not in taken)
+        rows = [{"id": permission_id, "bit": bit} for permission_id, bit in zip(missing, free)]
+        db.session.execute(update(cls), rows)
+
+    @classmethod
+    def bundle_delete(cls, permission_ids: list[int]) -> None:
+        delete_cascading(cls, cls.id.in_(permission_ids))
+
 
 class Section(LocalBase):
     __tablename__ = "mub-sections"
+    __table_args__ = (UniqueConstraint("name"),)
+
+    permissions = relationship("Permission", back_populates="section", cascade="all, delete", passive_deletes=True)
+
+    @classmethod
+    def bundle_create(cls, names: list[str]) -> None:
+        insert_ignore(cls, [{"name": name} for name in names])
+
+    @classmethod
+    def bundle_delete(cls, section_ids: list[int]) -> None:
+        delete_cascading(cls, cls.id.in_(section_ids))
+
+    @classmethod
+    def get_catalog_rows(cls, names: list[str] | None = None, after_section_id: int | None = None,
+                         after_permission_id: int | None = None) -> list[Row]:
+        stmt = select(cls.name, cls.id, Permission.name, Permission.id, Permission.bit)
+        stmt = stmt.outerjoin(Permission, Permission.section_id == cls.id)
+        if names is not None:
+            stmt = stmt.filter(cls.name.in_(names))
+        if after_section_id is not None:
+            stmt = stmt.filter(or_(cls.id > after_section_id, Permission.id > after_permission_id))
+        return db.session.execute(stmt).all()
+
+    @classmethod
+    def get_permission_names(cls) -> dict[int, str]:
+        return {permission_id: section_name + " " + permission_name
+                for section_name, _, permission_name, permission_id, _ in cls.get_catalog_rows()
+                if permission_id is not None}
 
-    permissions = relationship("Permission", back_populates="section", cascade="all, delete")
+    @classmethod
+    def get_all_with_permissions(cls) -> list[Section]:
+        stmt = select(cls).options(joinedload(cls.permissions)).order_by(cls.id)
+        return db.session.execute(stmt).unique().scalars().all()
 
     @PydanticModel.include_context(permissions=list)
     class FullModel(LocalBase.IndexModel):
@@ -75,3 +140,28 @@ class Section(LocalBase):
         @classmethod
         def callback_convert(cls, callback, orm_object: Section, **context) -> None:
             callback(permissions=[Permission.IndexModel.convert(perm, **context) for perm in orm_object.permissions])
+
+
+class CatalogState(Base):
+    __tablename__ = "mub-catalog"
+
+    id = Column(Integer, primary_key=True)
+    fingerprint = Column(String(40), nullable=False)
+    version = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def find_current(cls) -> CatalogState | None:
+        return db.get_first(select(cls).filter_by(id=1))
+
+    @classmethod
+    def find_version(cls) -> int | None:
+        return db.get_first(select(cls.version).filter_by(id=1))
+
+    @classmethod
+    def bump(cls, fingerprint: str | None = None) -> int:
+        insert_ignore(cls, [{"id": 1, "fingerprint": fingerprint or "", "version": 0}])
+        values = {"version": cls.version + 1}
+        if fingerprint is not None:
+            values["fingerprint"] = fingerprint
+        db.session.execute(update(cls).where(cls.id == 1).values(**values))
+        return db.get_first(select(cls.version).filter_by(id=1))
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+from flask_fullstack import PydanticModel, Identifiable
+from sqlalchemy import Column, ForeignKey, select, delete, update, insert, and_, exists, literal, false, true
+from sqlalchemy.orm import relationship, selectinload
+from sqlalchemy.sql.sqltypes import Integer, String
+
+from common import Base, db
+from ._mub_sql import insert_ignore
+from .moderators_db import Moderator, ModPerm, invalidate_moderator_state, clear_moderator_state
+from .moderators_db import bump_grants_version
+from .permissions_db import Permission
+
+
+class RolePerm(Base):
+    __tablename__ = "mub-role-perms"
+
+    role_id = Column(Integer, ForeignKey("mub-roles.id", ondelete="CASCADE"), primary_key=True)
+    permission_id = Column(Integer, ForeignKey("mub-permissions.id", ondelete="CASCADE"), primary_key=True, index=True)
+    permission = relationship("Permission", foreign_keys=[permission_id])
+
+    @classmethod
+    def delete_by_permissions(cls, permission_ids: list[int]) -> None:
+        db.session.execute(delete(cls).where(cls.permission_id.in_(permission_ids)))
+
+
+class ModRoleAssignment(Base):
+    __tablename__ = "mub-mod-roles"
+
+    moderator_id = Column(Integer, ForeignKey("mub-moderators.id", ondelete="CASCADE"), primary_key=True)
+    role_id = Column(Integer, ForeignKey("mub-roles.id", ondelete="CASCADE"), primary_key=True, index=True)
+
+    @classmethod
+    def find_role_ids(cls, moderator_id: int) -> set[int]:
+        return set(db.get_all(select(cls.role_id).filter_by(moderator_id=moderator_id)))
+
+    @classmethod
+    def find_by_moderators(cls, moderator_ids: list[int]) -> dict[int, list[int]]:
+        result: dict[int, list[int]] = {}
+        stmt = select(cls.moderator_id, cls.role_id).filter(cls.moderator_id.in_(moderator_ids))
+        for moderator_id, role_id in db.session.execute(stmt).all():
+            result.setdefault(moderator_id, []).append(role_id)
+        return result
+
+
+def grant_by_role(moderator_ids, permission_ids) -> None:
+    """
+    Adds one role grant for every pair in (moderator_ids x permission_ids), both given as selects:
+    missing effective rows are inserted first, then every row's role_count is incremented
+    """
+    pairs = select(moderator_ids.c[0], permission_ids.c[0], literal(False), literal(0))
+    pairs = pairs.select_from(moderator_ids.join(permission_ids, true())).where(~exists().where(
+        ModPerm.moderator_id == moderator_ids.c[0], ModPerm.permission_id == permission_ids.c[0]))
+    db.session.execute(insert(ModPerm).from_select(
+        [ModPerm.moderator_id, ModPerm.permission_id, ModPerm.direct, ModPerm.role_count], pairs))
+    bump_grants_version(Moderator.id.in_(select(moderator_ids.c[0])))
+    db.session.execute(update(ModPerm).where(ModPerm.moderator_id.in_(select(moderator_ids.c[0])),
+                                             ModPerm.permission_id.in_(select(permission_ids.c[0])))
+                       .values(role_count=ModPerm.role_count + 1))
+
+
+def revoke_by_role(moderator_ids, permission_ids) -> None:
+    """ Reverts :func:`grant_by_role`, dropping effective rows that are neither direct nor granted by another role """
+    condition = and_(ModPerm.moderator_id.in_(select(moderator_ids.c[0])),
+                     ModPerm.permission_id.in_(select(permission_ids.c[0])))
+    bump_grants_version(Moderator.id.in_(select(moderator_ids.c[0])))
+    db.session.execute(update(ModPerm).where(condition).values(role_count=ModPerm.role_count - 1))
+    db.session.execute(delete(ModPerm).where(condition, ModPerm.role_count <= 0, ModPerm.direct == false()))
+
+
+class ModRole(Base, Identifiable):
+    __tablename__ = "mub-roles"
+    not_found_text = "Role does not exist"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(100), nullable=False, unique=True)
+
+    permissions = relationship("RolePerm", cascade="all, delete", passive_deletes=True)
+
+    IndexModel = PydanticModel.column_model(id, name)
+
+    class FullModel(IndexModel):
+        permissions: list[Permission.IndexModel]
+
+        @classmethod
+        def callback_convert(cls, callback, orm_object: ModRole, **context) -> None:
+            callback(permissions=[Permission.IndexModel.convert(role_perm.permission, **context)
+                                  for role_perm in orm_object.permissions])
+
+    @classmethod
+    def find_by_id(cls, entry_id: int) -> ModRole | None:
+        return db.get_first(select(cls).filter_by(id=entry_id))
+
+    @classmethod
+    def find_by_name(cls, name: str) -> ModRole | None:
+        return db.get_first(select(cls).filter_by(name=name))
+
+    @classmethod
+    def find_by_ids(cls, role_ids: list[int]) -> dict[int, ModRole]:
+        stmt = select(cls).filter(cls.id.in_(role_ids)).options(selectinload(cls.permissions))
+        return {role.id: role for role in db.get_all(stmt)}
+
+    @classmethod
+    def get_all(cls) -> list[ModRole]:
+        stmt = select(cls).options(selectinload(cls.permissions).joinedload(RolePerm.permission))
+        return db.get_all(stmt.order_by(cls.name))
+
+    @classmethod
+    def find_permission_ids(cls, role_ids: list[int]) -> set[int]:
+        return set(db.get_all(select(RolePerm.permission_id).filter(RolePerm.role_id.in_(role_ids))))
+
+    def get_permission_ids(self) -> set[int]:
+        return ModRole.find_permission_ids([self.id])
+
+    def select_moderators(self):
+        return select(ModRoleAssignment.moderator_id).filter_by(role_id=self.id).subquery()
+
+    def add_permissions(self, permission_ids: list[int]) -> None:
+        new_ids = set(permission_ids) - self.get_permission_ids()
+        if len(new_ids) == 0:
+            return
+        insert_ignore(RolePerm, [{"role_id": self.id, "permission_id": perm_id} for perm_id in new_ids])
+        grant_by_role(self.select_moderators(), select(Permission.id).filter(Permission.id.in_(new_ids)).subquery())
+        db.session.expire(self, ["permissions"])
+        clear_moderator_state()
+
+    def remove_permissions(self, permission_ids: list[int]) -> None:
+        old_ids = set(permission_ids) & self.get_permission_ids()
+        if len(old_ids) == 0:
+            return
+        revoke_by_role(self.select_moderators(), select(Permission.id).filter(Permission.id.in_(old_ids)).subquery())
+        db.session.execute(delete(RolePerm).where(RolePerm.role_id == self.id, RolePerm.permission_id.in_(old_ids)))
+        db.session.expire(self, ["permissions"])
+        clear_moderator_state()
+
+    @classmethod
+    def bundle_assign(cls, assignments: dict[int, list[int]]) -> None:
+        """ Assigns roles to moderators that have none of them yet (e.g. just created), one grant per role """
+        moderators_by_role: dict[int, set[int]] = {}
+        for moderator_id, role_ids in assignments.items():
+            for role_id in role_ids:
+                moderators_by_role.setdefault(role_id, set()).add(moderator_id)
+        if len(moderators_by_role) == 0:
+            return
+
+        insert_ignore(ModRoleAssignment, [{"moderator_id": moderator_id, "role_id": role_id}
+                                          for role_id, moderator_ids in moderators_by_role.items()
+                                          for moderator_id in moderator_ids])
+        for role_id, moderator_ids in moderators_by_role.items():
+            grant_by_role(select(Moderator.id).filter(Moderator.id.in_(moderator_ids)).subquery(),
+                          select(RolePerm.permission_id).filter_by(role_id=role_id).subquery())
+        for moderator_id in assignments:
+            invalidate_moderator_state(moderator_id)
+
+    def assign(self, moderator_id: int) -> bool:
+        if self.id in ModRoleAssignment.find_role_ids(moderator_id):
+            return False
+        ModRoleAssignment.create(moderator_id=moderator_id, role_id=self.id)
+        grant_by_role(select(literal(moderator_id)).subquery(),
+                      select(RolePerm.permission_id).filter_by(role_id=self.id).subquery())
+        invalidate_moderator_state(moderator_id)
+        return True
+
+    def unassign(self, moderator_id: int) -> bool:
+        if self.id not in ModRoleAssignment.find_role_ids(moderator_id):
+            return False
+        revoke_by_role(select(literal(moderator_id)).subquery(),
+                       select(RolePerm.permission_id).filter_by(role_id=self.id).subquery())
+        db.session.execute(delete(ModRoleAssignment).filter_by(moderator_id=moderator_id, role_id=self.id))
+        invalidate_moderator_state(moderator_id)
+        return True
+
+    def delete(self) -> None:
+        self.remove_permissions(list(self.get_permission_ids()))
+        db.session.execute(delete(ModRoleAssignment).where(ModRoleAssignment.role_id == self.id))
+        super().delete()
@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone, timedelta
+from threading import Lock
+from time import monotonic
+from uuid import uuid4
+
+from flask import current_app
+from flask_jwt_extended import JWTManager
+from sqlalchemy import Column, ForeignKey, select, delete, update, exists, true
+from sqlalchemy.sql.sqltypes import Integer, String, DateTime
+
+from common import db, Base
+from ._mub_async import async_db
+from ._mub_cache import BloomFilter
+from ._mub_replica import on_primary
+from ._mub_sql import insert_ignore
+
+PURGE_BATCH_SIZE: int = 1000
+SWEEP_INTERVAL: float = 600.0
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def get_session_expiry() -> datetime | None:
+    """ Sessions last as long as the access tokens issued for them, see JWT_ACCESS_TOKEN_EXPIRES """
+    lifetime = current_app.config.get("JWT_ACCESS_TOKEN_EXPIRES", None)
+    if isinstance(lifetime, int) and not isinstance(lifetime, bool):
+        lifetime = timedelta(seconds=lifetime)
+    return utcnow() + lifetime if isinstance(lifetime, timedelta) else None
+
+
+class RevocationFilter:
+    """
+    Per-worker Bloom filter of revoked jtis, so that most checks for tokens that were not revoked skip the database.
+    New revocations from other workers are picked up at most every `refresh_interval` seconds, by creation time.
+    Ids and creation times don't follow commit order, so every refresh also re-reads the last `overlap` seconds,
+    which has to cover the longest transaction revoking a token plus the clock skew between workers
+    """
+
+    def __init__(self, refresh_interval: float = 5.0, capacity: int = 100_000, overlap: float = 60.0,
+                 enabled: bool = False):
+        self.refresh_interval: float = refresh_interval
+        self.capacity: int = capacity
+        self.overlap: float = overlap
+        self.enabled: bool = enabled
+        self.bloom: BloomFilter | None = None
+        self.watermark: datetime | None = None
+        self.refreshed: float | None = None
+        self._lock: Lock = Lock()
+
+    def configure(self, refresh_interval: float | None = None, capacity: int | None = None,
+                  overlap: float | None = None, enabled: bool = True) -> None:
+        with self._lock:
+            if refresh_interval is not None:
+                self.refresh_interval = refresh_interval
+            if capacity is not None:
+                self.capacity = capacity
+            if overlap is not None:
+                self.overlap = overlap
+            self.enabled = enabled
+            self.bloom = None
+
+    def refresh(self) -> None:
+        if self.refreshed is not None and self.bloom is not None and not self.bloom.saturated \
+                and monotonic() - self.refreshed < self.refresh_interval:
+            return
+
+        with self._lock:
+            if self.bloom is None or self.bloom.saturated:
+                if self.bloom is not None:
+                    self.capacity = max(self.capacity, 2 * self.bloom.count)
+                self.bloom = BloomFilter(self.capacity)
+                self.watermark = None
+
+            started = utcnow()
+            stmt = select(BlockedModToken.jti)
+            if self.watermark is not None:
+                stmt = stmt.filter(BlockedModToken.created >= self.watermark - timedelta(seconds=self.overlap))
+            for jti in db.get_all(stmt):
+                if jti not in self.bloom:  # the overlap re-reads jtis, they must not count twice
+                    self.bloom.add(jti)
+            self.watermark = started
+            self.refreshed = monotonic()
+
+    def add(self, jti: str) -> None:
+        if self.enabled and self.bloom is not None:
+            self.bloom.add(jti)
+
+    def might_contain(self, jti: str) -> bool:
+        if not self.enabled:
+            return True
+        self.refresh()
+        return jti in self.bloom
+
+
+revocation_filter: RevocationFilter = RevocationFilter()
+
+
+class BlockedModToken(Base):
+    __tablename__ = "blocked-mod-tokens"
+
+    next_sweep = 0.0
+
+    id = Column(Integer, primary_key=True)
+    jti = Column(String(36), nullable=False, unique=True)
+    expires = Column(DateTime, nullable=True, index=True)
+    created = Column(DateTime, nullable=True, default=utcnow, index=True)  # null for rows older than the column
+
+    @classmethod
+    def block(cls, jti: str, exp: int | None = None) -> None:
+        expires = None if exp is None else datetime.fromtimestamp(exp, timezone.utc).replace(tzinfo=None)
+        insert_ignore(cls, [{"jti": jti, "expires": expires, "created": utcnow()}])
+        revocation_filter.add(jti)
+
+        if monotonic() > cls.next_sweep:
+            cls.next_sweep = monotonic() + SWEEP_INTERVAL
+            cls.purge(PURGE_BATCH_SIZE)
+
+    @classmethod
+    def is_blocked(cls, jti: str) -> bool:
+        if not revocation_filter.might_contain(jti):
+            return False
+        return db.get_first(select(cls.id).filter_by(jti=jti)) is not None
+
+    @classmethod
+    def purge(cls, batch_size: int | None = None) -> int:
+        stmt = select(cls.id).filter(cls.expires < utcnow())
+        if batch_size is not None:
+            stmt = stmt.limit(batch_size)
+        expired = db.get_all(stmt)
+        if len(expired) != 0:
+            db.session.execute(delete(cls).where(cls.id.in_(expired)))
+        return len(expired)
+
+
+class ModSession(Base):
+    __tablename__ = "mub-sessions"
+
+    id = Column(String(36), primary_key=True)
+    moderator_id = Column(Integer, ForeignKey("mub-moderators.id", ondelete="CASCADE"), nullable=False, index=True)
+    epoch = Column(Integer, nullable=False)
+    created = Column(DateTime, nullable=False, default=utcnow)
+    expires = Column(DateTime, nullable=True, index=True)  # moved forward by POST /mub/refresh/ only
+
+    @classmethod
+    def start(cls, moderator_id: int, epoch: int) -> ModSession:
+        return cls.create(id=str(uuid4()), moderator_id=moderator_id, epoch=epoch, expires=get_session_expiry())
+
+    @classmethod
+    def find_by_moderator(cls, moderator_id: int) -> list[ModSession]:
+        return db.get_all(select(cls).filter_by(moderator_id=moderator_id).order_by(cls.created))
+
+    @classmethod
+    def extend(cls, session_id: str) -> None:
+        db.session.execute(update(cls).where(cls.id == session_id).values(expires=get_session_expiry()))
+
+    @classmethod
+    def live_column(cls, session_id: str | None):
+        """ Whether the session exists, for selecting along with the moderator's state in one query """
+        if session_id is None:
+            return true().label("live")
+        return exists().where(cls.id == session_id).label("live")
+
+    @classmethod
+    def is_live(cls, session_id: str) -> bool:
+        """ Never cached: a session ended by another process must be rejected by the next request """
+        return db.get_first(on_primary(select(cls.id).filter_by(id=session_id))) is not None
+
+    @classmethod
+    async def is_live_async(cls, session_id: str) -> bool:
+        return await async_db.get_first(on_primary(select(cls.id).filter_by(id=session_id))) is not None
+
+    @classmethod
+    def end(cls, session_id: str) -> None:
+        db.session.execute(delete(cls).where(cls.id == session_id))
+
+    @classmethod
+    def delete_by_moderator(cls, moderator_id: int) -> None:
+        db.session.execute(delete(cls).where(cls.moderator_id == moderator_id))
+
+    @classmethod
+    def purge(cls, batch_size: int | None = None) -> int:
+        stmt = select(cls.id).filter(cls.expires < utcnow())
+        if batch_size is not None:
+            stmt = stmt.limit(batch_size)
+        expired = db.get_all(stmt)
+        if len(expired) != 0:
+            db.session.execute(delete(cls).where(cls.id.in_(expired)))
+        return len(expired)
+
+
+def is_mub_token(jwt_payload: dict) -> bool:
+    identity = jwt_payload.get(current_app.config.get("JWT_IDENTITY_CLAIM", "sub"), None)
+    return isinstance(identity, dict) and "mub" in identity
+
+
+def check_revoked_token(_jwt_header: dict, jwt_payload: dict) -> bool:
+    """
+    Blocklist loader for JWTManager, installed by :func:`init_jwt`. Only mub tokens are looked up,
+    so an application with a loader of its own can call this one from it for every token
+    """
+    return is_mub_token(jwt_payload) and BlockedModToken.is_blocked(jwt_payload["jti"])
+
+
+def init_jwt(jwt_manager: JWTManager) -> None:
+    """ Makes `jwt_manager` reject revoked mub tokens, by setting :func:`check_revoked_token` as its blocklist loader """
+    jwt_manager.token_in_blocklist_loader(check_revoked_token)
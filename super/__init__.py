@@ -1,2 +1,3 @@
 from .super_cli import mub_cli_blueprint
 from .super_rst import controller as mub_super_namespace
+from .super_bench import BENCHMARK_BUDGETS
@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from time import perf_counter
+
+from click import option, echo, ClickException
+from flask import current_app, Response
+from sqlalchemy import Engine, create_engine, select, event
+from sqlalchemy.pool import StaticPool
+from werkzeug.exceptions import HTTPException
+
+from common import db, Base
+from .super_cli import permission_cli_command
+from .super_rst import controller
+from ..base import permission_index, Moderator, ModPerm, Section, Permission
+from ..base._mub_replica import replica_router
+from ..base.moderators_db import drop_moderator_state
+
+BENCH_PREFIX: str = "bench-"
+BENCH_PASSWORD: str = "bench-password"
+
+# maximum number of SQL statements per call with caches disabled, including the token's revocation check
+BENCHMARK_BUDGETS: dict[str, int] = {
+    "require-permission": 3,
+    "require-permissions": 3,
+    "sign-in": 4,
+    "my-settings": 4,
+    "moderators-list": 5,
+    "moderators-search": 4,
+    "moderators-prefix": 4,
+    "moderator-append-perms": 6,  # with the grants version bump, which outdates token claims
+}
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    timings: list[float] = field(default_factory=list)
+    statements: list[int] = field(default_factory=list)
+
+    @property
+    def budget(self) -> int | None:
+        return BENCHMARK_BUDGETS.get(self.name, None)
+
+    @property
+    def exceeded(self) -> bool:
+        return self.budget is not None and max(self.statements) > self.budget
+
+    def format(self) -> str:
+        p50, p95, p99 = (percentile(self.timings, fraction) * 1000 for fraction in (0.5, 0.95, 0.99))
+        statements = f"{min(self.statements)}" if min(self.statements) == max(self.statements) \
+            else f"{min(self.statements)}-{max(self.statements)}"
+        return (f"{self.name:24} p50={p50:8.2f}ms p95={p95:8.2f}ms p99={p99:8.2f}ms "
+                f"statements={statements} budget={self.budget}" + (" EXCEEDED" if self.exceeded else ""))
+
+
+class Benchmark:
+    def __init__(self, iterations: int, warmup: int):
+        self.iterations: int = iterations
+        self.warmup: int = warmup
+        self.statement_count: int = 0
+        self.results: list[BenchmarkResult] = []
+
+    def count_statement(self, *_) -> None:
+        self.statement_count += 1
+
+    def measure(self, name: str, function: Callable[[], object], reset: Callable[[], None] | None = None) -> None:
+        result = BenchmarkResult(name)
+        event.listen(db.engine, "before_cursor_execute", self.count_statement)
+        try:
+            for i in range(self.warmup + self.iterations):
+                db.session.commit()
+                db.session.expunge_all()
+                permission_index.refresh()  # checks the catalog version once per refresh_interval, not per call
+                self.statement_count = 0
+                start = perf_counter()
+                response = function()
+                elapsed, statements = perf_counter() - start, self.statement_count
+                if getattr(response, "status_code", 200) != 200:
+                    raise ClickException(f"Scenario {name} failed with {response.status_code}")
+                if i >= self.warmup:
+                    result.timings.append(elapsed)
+                    result.statements.append(statements)
+                if reset is not None:
+                    reset()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", self.count_statement)
+        self.results.append(result)
+        echo(result.format())
+
+
+def seed(moderators: int, sections: int, permissions: int, grants: int) -> tuple[list[int], list[int]]:
+    Section.bundle_create([f"{BENCH_PREFIX}section-{i}" for i in range(sections)])
+    section_ids = db.get_all(select(Section.id).filter(Section.name.startswith(BENCH_PREFIX)))
+    for section_id in section_ids:
+        Permission.bundle_create(section_id, [f"{BENCH_PREFIX}permission-{i}" for i in range(permissions)])
+    permission_ids = db.get_all(select(Permission.id).filter(Permission.section_id.in_(section_ids)))
+    permission_ids.extend(permission_index.permission_dict.values())
+
+    password = Moderator.generate_hash(BENCH_PASSWORD)
+    db.session.add(Moderator(username=f"{BENCH_PREFIX}super", password=password, super=True))
+    db.session.add_all(Moderator(username=f"{BENCH_PREFIX}{i:06}", password=password) for i in range(moderators))
+    db.session.flush()
+
+    stmt = select(Moderator.id).filter(Moderator.username.startswith(BENCH_PREFIX))
+    moderator_ids = db.get_all(stmt.order_by(Moderator.id))
+    for i, moderator_id in enumerate(moderator_ids):
+        ModPerm.bundle_create(moderator_id, [permission_ids[(i + j) % len(permission_ids)] for j in range(grants)])
+    db.session.commit()
+    return moderator_ids, section_ids
+
+
+@contextmanager
+def throwaway_database() -> Iterator[Engine]:
+    """
+    Points the default bind at a new in-memory SQLite database with the mub tables for the duration,
+    so the seeded data never reaches the application's database. Any replica bind is ignored meanwhile
+    """
+    package = __name__.rpartition(".")[0].rpartition(".")[0]
+    tables = [mapper.local_table for mapper in Base.registry.mappers if mapper.class_.__module__.startswith(package)]
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine, tables=tables)
+
+    engines, index_state, replica_bind = db.engines, dict(vars(permission_index)), replica_router.bind_key
+    primary = engines[None]
+    db.session.remove()
+    engines[None] = engine
+    replica_router.bind_key = None
+    try:
+        permission_index.initialize()
+        yield engine
+    finally:
+        db.session.remove()
+        engines[None] = primary
+        replica_router.bind_key = replica_bind
+        vars(permission_index).update(index_state)
+        drop_moderator_state(None)
+        engine.dispose()
+
+
+def call_view(decorator: Callable[[Callable], Callable], token: str) -> Response:
+    """ Runs an empty view behind `decorator` (authorization included) as a request with the `token` cookie """
+    view = decorator(lambda *_, **__: current_app.response_class(status=200))
+    with current_app.test_request_context(headers={"Cookie": f"access_token_cookie={token}"}):
+        try:
+            return view()
+        except HTTPException as error:
+            return error.get_response()
+
+
+def run_scenarios(bench: Benchmark, prefix: str, moderator_ids: list[int], section_ids: list[int]) -> None:
+    super_client, client = current_app.test_client(), current_app.test_client()
+    super_client.post(f"{prefix}/sign-in/", json={"username": f"{BENCH_PREFIX}super", "password": BENCH_PASSWORD})
+    username = f"{BENCH_PREFIX}{0:06}"
+    client.post(f"{prefix}/sign-in/", json={"username": username, "password": BENCH_PASSWORD})
+
+    permissions = list(permission_index.permission_dict.keys())
+    ModPerm.bundle_create(Moderator.find_by_name(username).id, list(permission_index.permission_dict.values()))
+    token = client.get_cookie("access_token_cookie").value
+    bench.measure("require-permission",
+                  lambda: call_view(permission_index.require_permission(controller, permissions[0]), token))
+    bench.measure("require-permissions",
+                  lambda: call_view(permission_index.require_permissions(controller, *permissions), token))
+
+    bench.measure("sign-in", lambda: current_app.test_client().post(
+        f"{prefix}/sign-in/", json={"username": username, "password": BENCH_PASSWORD}))
+    bench.measure("my-settings", lambda: client.get(f"{prefix}/my-settings/"))
+    bench.measure("moderators-list", lambda: super_client.get(f"{prefix}/moderators/?counter=0"))
+    bench.measure("moderators-search", lambda: super_client.get(f"{prefix}/moderators/?counter=0&search=00"))
+    bench.measure("moderators-prefix",
+                  lambda: super_client.get(f"{prefix}/moderators/?counter=0&search={BENCH_PREFIX}0&prefix=true"))
+
+    target_id = moderator_ids[-1]  # seeded after the super
+    append_perms = db.get_all(select(Permission.id).filter(Permission.section_id.in_(section_ids)))
+    bench.measure("moderator-append-perms",
+                  lambda: super_client.post(f"{prefix}/moderators/{target_id}/", json={"append-perms": append_perms}),
+                  lambda: ModPerm.bundle_delete(target_id, append_perms))
+
+
+@permission_cli_command()
+@option("-m", "--moderators", type=int, default=1000)
+@option("-s", "--sections", type=int, default=10)
+@option("-p", "--permissions", type=int, default=20, help="Permissions per section")
+@option("-g", "--grants", type=int, default=20, help="Permissions granted to every moderator")
+@option("-n", "--iterations", type=int, default=50)
+@option("-w", "--warmup", type=int, default=2)
+@option("--prefix", default="/mub", help="Path, under which the mub namespaces are mounted")
+@option("--cache", is_flag=True, default=False, help="Run with moderator caches enabled")
+@option("--check", is_flag=True, default=False, help="Fail when a statement budget is exceeded")
+def benchmark(moderators: int, sections: int, permissions: int, grants: int, iterations: int, warmup: int,
+              prefix: str, cache: bool, check: bool):
+    bench = Benchmark(iterations, warmup)
+    with throwaway_database():
+        moderator_ids, section_ids = seed(moderators, sections, permissions, grants)
+        if cache:
+            permission_index.enable_cache()
+        try:
+            run_scenarios(bench, prefix, moderator_ids, section_ids)
+        finally:
+            if cache:
+                permission_index.disable_cache()
+
+    exceeded = [result.name for result in bench.results if result.exceeded]
+    if check and len(exceeded) != 0:
+        raise ClickException(f"Statement budget exceeded: {', '.join(exceeded)}")
@@ -1,12 +1,25 @@
+from collections.abc import Iterator
+from concurrent.futures import Executor, ProcessPoolExecutor
+from csv import DictReader, DictWriter
+from datetime import datetime
 from functools import wraps
+from itertools import islice
+from json import loads, dumps
+from os.path import exists
 
-from click import option, echo
+from click import option, echo, prompt, File, Choice, Path, DateTime, ClickException
 from flask import Blueprint
 
 from common import db
-from ..base import Moderator, Permission, ModPerm, permission_index
+from ..base import Moderator, Section, Permission, ModPerm, ModRole, BlockedModToken, ModSession, permission_index
+from ..base import password_hasher, audit_log, grant_sweeper
+from ..base.moderators_db import InterfaceMode
+from ..base.roles_db import ModRoleAssignment
+from ..base.sessions_db import utcnow
+from .super_rst import future_datetime
 
 CLI_PAGE_SIZE: int = 20
+TRANSFER_FIELDS: tuple[str, ...] = ("username", "super", "mode", "permissions", "expires-at", "roles", "password-hash")
 
 mub_cli_blueprint = Blueprint("mub", __name__)
 
@@ -36,6 +49,23 @@ def list_permissions():
         echo(f"{permission.id:4}: {permission.name}")
 
 
+@permission_cli_command()
+def list_stale_permissions():
+    if len(permission_index.stale_permissions) == 0 and len(permission_index.stale_sections) == 0:
+        return echo("<empty>")
+
+    for name, permission_id in permission_index.stale_permissions.items():
+        echo(f"{permission_id:4}: {name}")
+    for name, section_id in permission_index.stale_sections.items():
+        echo(f"{section_id:4}: section {name}")
+
+
+@permission_cli_command()
+def prune_stale_permissions():
+    pruned = permission_index.prune_stale()
+    echo(f"Pruned {len(pruned)} stale permission(s)")
+
+
 @permission_cli_command()
 @option("-u", "--username", prompt=True)
 @option("-p", "--password", prompt=True, hide_input=True, confirmation_prompt=True)
@@ -43,7 +73,8 @@ def create_moderator(username: str, password: str):
     if Moderator.find_by_name(username) is not None:
         echo("ERROR: User with this name already exists")
 
-    Moderator.register(username, password)
+    moderator = Moderator.register(username, password)
+    audit_log.record("create", "moderator", moderator.id, username=username)
 
 
 @permission_cli_command()
@@ -57,6 +88,7 @@ def create_super(username: str, password: str):
 
     moderator = Moderator.register(username, password)
     moderator.super = True
+    audit_log.record("create", "moderator", moderator.id, username=username, super=True)
 
 
 @permission_cli_command()
@@ -66,6 +98,7 @@ def activate_super(username: str):
     if moderator is None:
         return echo("ERROR: Moderator does not exist")
     moderator.super = True
+    audit_log.record("activate-super", "moderator", moderator.id)
 
 
 @permission_cli_command()
@@ -75,6 +108,7 @@ def deactivate_super(username: str):
     if moderator is None:
         return echo("ERROR: Moderator does not exist")
     moderator.super = False
+    audit_log.record("deactivate-super", "moderator", moderator.id)
 
 
 @permission_cli_command()
@@ -83,33 +117,64 @@ def remove_moderator(username: str):
     moderator: Moderator = Moderator.find_by_name(username)
     if moderator is None:
         return echo("ERROR: Moderator does not exist")
+    audit_log.record("delete", "moderator", moderator.id, username=username)
     moderator.delete()
 
 
 @permission_cli_command()
-@option("-p", "--page", prompt=True, type=int)
-def list_moderators(page: int):
-    moderators = Moderator.search(page * CLI_PAGE_SIZE, CLI_PAGE_SIZE)
+@option("-u", "--username", "usernames", multiple=True, required=True)
+def remove_moderators(usernames: tuple[str, ...]):
+    existing = Moderator.find_ids_by_names(list(usernames))
+    for username in usernames:
+        if username not in existing:
+            echo(f"WARNING: Moderator {username!r} does not exist")
+    for username, moderator_id in existing.items():
+        audit_log.record("delete", "moderator", moderator_id, username=username)
+    echo(f"Removed {Moderator.bundle_delete(list(existing.values()))} moderator(s)")
 
-    if len(moderators) == 0:
-        return echo("<empty>")
 
+@permission_cli_command()
+@option("-p", "--page", type=int, default=None)
+@option("-a", "--all", "list_all", is_flag=True, default=False)
+def list_moderators(page: int | None, list_all: bool):
+    if list_all:
+        moderators = Moderator.iterate_all(CLI_PAGE_SIZE)
+    else:
+        if page is None:
+            page = prompt("Page", type=int)
+        moderators = Moderator.search(page * CLI_PAGE_SIZE, CLI_PAGE_SIZE)
+
+    empty = True
     for moderator in moderators:
         echo(f"{moderator.id:4}: {moderator.username}" + (" SUPER" if moderator.super else ""))
+        empty = False
+
+    if empty:
+        echo("<empty>")
+
+
+@permission_cli_command()
+def reindex_moderators():
+    echo(f"Reindexed {Moderator.reindex_all()} moderator(s)")
 
 
 @permission_cli_command()
 @option("-u", "--username", prompt=True)
 @option("-p", "--permission", prompt=True)
-def add_permission(username: str, permission: str):
+@option("-e", "--expires-at", type=DateTime(), default=None, help="UTC time the grant lapses at")
+def add_permission(username: str, permission: str, expires_at: datetime | None):
     perm = Permission.find_by_name(permission)
     moderator = Moderator.find_by_name(username)
     if perm is None:
         return echo("ERROR: Permission does not exist")
     if moderator is None:
         return echo("ERROR: Moderator does not exist")
-    if moderator.super or ModPerm.create_unique(moderator.id, perm.id) is None:
-        echo("WARNING: Permission already granted")
+    if expires_at is not None and expires_at <= utcnow():
+        return echo("ERROR: Expiry must be in the future")
+    if moderator.super or ModPerm.create_unique(moderator.id, perm.id, expires_at) is None:
+        return echo("WARNING: Permission already granted")
+    audit_log.record("update", "moderator", moderator.id, append_perms=[perm.id],
+                     expires_at=None if expires_at is None else expires_at.isoformat())
 
 
 @permission_cli_command()
@@ -125,7 +190,31 @@ def remove_permission(username: str, permission: str):
     if moderator.super:
         echo("ERROR: Moderator is SUPER")
     if not ModPerm.delete_by_ids(moderator.id, perm.id):
-        echo("WARNING: Permission is not granted")
+        return echo("WARNING: Permission is not granted")
+    audit_log.record("update", "moderator", moderator.id, remove_perms=[perm.id])
+
+
+@permission_cli_command()
+@option("-p", "--permission", prompt=True)
+def revoke_permission_from_all(permission: str):
+    perm = Permission.find_by_name(permission)
+    if perm is None:
+        return echo("ERROR: Permission does not exist")
+    ModPerm.bundle_revoke([perm.id])
+    audit_log.record("revoke", "permission", perm.id, name=permission)
+
+
+@permission_cli_command()
+@option("-n", "--name", prompt=True)
+def drop_section(name: str):
+    if name in permission_index.sections:
+        return echo("ERROR: Section is declared by the application, it would be recreated on startup")
+    section = Section.find_by_name(name)
+    if section is None:
+        return echo("ERROR: Section does not exist")
+    Section.bundle_delete([section.id])
+    permission_index.forget_section(name)
+    audit_log.record("delete", "section", section.id, name=name)
 
 
 @permission_cli_command()
@@ -142,3 +231,306 @@ def list_mod_perms(username: str):
 
     for permission in permissions:
         echo(f"{permission.id:4}: {permission.name}")
+
+
+@permission_cli_command()
+def list_roles():
+    roles = ModRole.get_all()
+    if len(roles) == 0:
+        return echo("<empty>")
+
+    for role in roles:
+        echo(f"{role.id:4}: {role.name} ({', '.join(role_perm.permission.name for role_perm in role.permissions)})")
+
+
+@permission_cli_command()
+@option("-n", "--name", prompt=True)
+def create_role(name: str):
+    if ModRole.find_by_name(name) is not None:
+        return echo("ERROR: Role with this name already exists")
+    role = ModRole.create(name=name)
+    audit_log.record("create", "role", role.id, name=name, perms=[])
+
+
+@permission_cli_command()
+@option("-n", "--name", prompt=True)
+def delete_role(name: str):
+    role = ModRole.find_by_name(name)
+    if role is None:
+        return echo("ERROR: Role does not exist")
+    audit_log.record("delete", "role", role.id, name=role.name)
+    role.delete()
+
+
+@permission_cli_command()
+@option("-n", "--name", prompt=True)
+@option("-p", "--permission", prompt=True)
+def add_role_permission(name: str, permission: str):
+    perm = Permission.find_by_name(permission)
+    role = ModRole.find_by_name(name)
+    if perm is None:
+        return echo("ERROR: Permission does not exist")
+    if role is None:
+        return echo("ERROR: Role does not exist")
+    if perm.id in role.get_permission_ids():
+        return echo("WARNING: Permission already in the role")
+    role.add_permissions([perm.id])
+    audit_log.record("update", "role", role.id, append_perms=[perm.id])
+
+
+@permission_cli_command()
+@option("-n", "--name", prompt=True)
+@option("-p", "--permission", prompt=True)
+def remove_role_permission(name: str, permission: str):
+    perm = Permission.find_by_name(permission)
+    role = ModRole.find_by_name(name)
+    if perm is None:
+        return echo("ERROR: Permission does not exist")
+    if role is None:
+        return echo("ERROR: Role does not exist")
+    if perm.id not in role.get_permission_ids():
+        return echo("WARNING: Permission is not in the role")
+    role.remove_permissions([perm.id])
+    audit_log.record("update", "role", role.id, remove_perms=[perm.id])
+
+
+@permission_cli_command()
+@option("-u", "--username", prompt=True)
+@option("-n", "--name", prompt=True)
+def assign_role(username: str, name: str):
+    moderator = Moderator.find_by_name(username)
+    role = ModRole.find_by_name(name)
+    if moderator is None:
+        return echo("ERROR: Moderator does not exist")
+    if role is None:
+        return echo("ERROR: Role does not exist")
+    if not role.assign(moderator.id):
+        return echo("WARNING: Role already assigned")
+    audit_log.record("update", "moderator", moderator.id, append_roles=[role.id])
+
+
+@permission_cli_command()
+@option("-u", "--username", prompt=True)
+@option("-n", "--name", prompt=True)
+def unassign_role(username: str, name: str):
+    moderator = Moderator.find_by_name(username)
+    role = ModRole.find_by_name(name)
+    if moderator is None:
+        return echo("ERROR: Moderator does not exist")
+    if role is None:
+        return echo("ERROR: Role does not exist")
+    if not role.unassign(moderator.id):
+        return echo("WARNING: Role is not assigned")
+    audit_log.record("update", "moderator", moderator.id, remove_roles=[role.id])
+
+
+@permission_cli_command()
+@option("-u", "--username", prompt=True)
+def expire_sessions(username: str):
+    moderator: Moderator = Moderator.find_by_name(username)
+    if moderator is None:
+        return echo("ERROR: Moderator does not exist")
+    moderator.expire_sessions()
+
+
+@permission_cli_command()
+@option("-u", "--username", prompt=True)
+def list_sessions(username: str):
+    moderator: Moderator = Moderator.find_by_name(username)
+    if moderator is None:
+        return echo("ERROR: Moderator does not exist")
+    sessions = ModSession.find_by_moderator(moderator.id)
+    if len(sessions) == 0:
+        return echo("<empty>")
+    for session in sessions:
+        echo(f"{session.id}: started {session.created:%Y-%m-%d %H:%M}, expires {session.expires or 'never'}")
+
+
+@permission_cli_command()
+@option("-s", "--session", "session_id", prompt=True)
+def end_session(session_id: str):
+    ModSession.end(session_id)
+
+
+@permission_cli_command()
+def purge_revoked_tokens():
+    echo(f"Purged {BlockedModToken.purge()} expired token(s) and {ModSession.purge()} expired session(s)")
+
+
+@permission_cli_command()
+@option("-b", "--batch-size", type=int, default=1000)
+def sweep_expired_grants(batch_size: int):
+    grant_sweeper.batch_size = batch_size
+    echo(f"Swept {grant_sweeper.sweep()} expired grant(s)")
+
+
+@permission_cli_command()
+@option("-i", "--input", "fallback_path", type=Path(dir_okay=False), default=None)
+def replay_audit(fallback_path: str | None):
+    if fallback_path is not None:
+        audit_log.fallback_path = fallback_path
+    echo(f"Replayed {audit_log.replay()} audit entries")
+
+
+def read_records(source, file_format: str) -> Iterator[dict]:
+    if file_format == "jsonl":
+        yield from (loads(line) for line in source if line.strip())
+        return
+
+    for record in DictReader(source):
+        record["permissions"] = [name for name in (record.get("permissions") or "").split(";") if name]
+        record["roles"] = [name for name in (record.get("roles") or "").split(";") if name]
+        record["expires-at"] = dict(item.rpartition("=")[::2] for item in (record.get("expires-at") or "").split(";")
+                                    if item)
+        yield record
+
+
+def parse_flag(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes")
+    return bool(value)
+
+
+def parse_expiries(number: int, expiries: dict[str, str]) -> dict[str, datetime]:
+    result: dict[str, datetime] = {}
+    for name, value in expiries.items():
+        try:
+            result[name] = future_datetime(value)
+        except ValueError:
+            echo(f"WARNING: Record {number}: expiry {value!r} of {name!r} is not a future date, not granted")
+    return result
+
+
+def import_batch(records: list[dict], first: int, permission_ids: dict[str, int], role_ids: dict[str, int],
+                 executor: Executor) -> tuple[int, int]:
+    existing = Moderator.find_ids_by_names([record.get("username") or "" for record in records])
+    rows: list[dict] = []
+    passwords: list[tuple[dict, str]] = []
+    grants: dict[str, list[tuple[int, datetime | None]]] = {}
+    roles: dict[str, list[int]] = {}
+
+    for number, record in enumerate(records, first + 1):
+        username = record.get("username")
+        if not username or username in existing or username in grants:
+            echo(f"WARNING: Record {number}: moderator {username!r} already exists or has no name, skipped")
+            continue
+        mode = InterfaceMode.from_string(record.get("mode") or InterfaceMode.DARK)
+        if mode is None:
+            echo(f"WARNING: Record {number}: wrong interface mode {record['mode']!r}, skipped")
+            continue
+        if not record.get("password-hash") and not record.get("password"):
+            echo(f"WARNING: Record {number}: no password for {username!r}, skipped")
+            continue
+        if not all(isinstance(record.get(key) or [], list) for key in ("permissions", "roles")) \
+                or not isinstance(record.get("expires-at") or {}, dict):
+            echo(f"WARNING: Record {number}: permissions and roles must be lists, expires-at a mapping, skipped")
+            continue
+
+        row = {"username": username, "password": record.get("password-hash") or None,
+               "super": parse_flag(record.get("super", False)), "mode": mode}
+        if row["password"] is None:
+            passwords.append((row, record["password"]))
+        rows.append(row)
+
+        grants[username], roles[username] = [], []
+        raw_expiries = record.get("expires-at") or {}
+        expiries = parse_expiries(number, raw_expiries)
+        for name in record.get("permissions") or []:
+            if name not in permission_ids:
+                echo(f"WARNING: Record {number}: permission {name!r} does not exist, not granted")
+            elif name not in raw_expiries or name in expiries:
+                grants[username].append((permission_ids[name], expiries.get(name, None)))
+        for name in record.get("roles") or []:
+            if name in role_ids:
+                roles[username].append(role_ids[name])
+            else:
+                echo(f"WARNING: Record {number}: role {name!r} does not exist, not assigned")
+
+    hashes = password_hasher.hash_many([password for _, password in passwords], executor)
+    for (row, _), hashed in zip(passwords, hashes):
+        row["password"] = hashed
+
+    if (created := Moderator.bundle_register(rows)) is None:
+        raise ClickException(f"Usernames in records {first + 1}-{first + len(records)} were taken meanwhile, "
+                             "run the import again to resume")
+    grants_by_expiry: dict[datetime | None, dict[int, list[int]]] = {}
+    for username, permissions in grants.items():
+        for permission_id, expires_at in permissions:
+            grants_by_expiry.setdefault(expires_at, {}).setdefault(created[username], []).append(permission_id)
+    for expires_at, expiring_grants in grants_by_expiry.items():
+        ModPerm.bundle_grant(expiring_grants, dict.fromkeys(expiring_grants, expires_at))
+    ModRole.bundle_assign({created[username]: role_ids for username, role_ids in roles.items()})
+    return len(rows), len(records) - len(rows)
+
+
+@permission_cli_command()
+@option("-i", "--input", "source", type=File("r"), default="-")
+@option("-f", "--format", "file_format", type=Choice(["jsonl", "csv"]), default="jsonl")
+@option("-b", "--batch-size", type=int, default=500)
+@option("-w", "--workers", type=int, default=None, help="Processes used to hash passwords")
+@option("--progress", "progress_path", type=Path(dir_okay=False), default=None,
+        help="File that records committed progress, an interrupted import resumes from it")
+def import_moderators(source, file_format: str, batch_size: int, workers: int | None, progress_path: str | None):
+    offset = 0
+    if progress_path is not None and exists(progress_path):
+        with open(progress_path) as progress:
+            offset = int(progress.read().strip() or 0)
+        echo(f"Resuming after record {offset}")
+
+    permission_ids = {name: permission_id for permission_id, name in Section.get_permission_names().items()}
+    role_ids = {role.name: role.id for role in ModRole.get_all()}
+    records = islice(read_records(source, file_format), offset, None)
+    created, skipped = 0, 0
+
+    with ProcessPoolExecutor(workers) as executor:
+        while len(batch := list(islice(records, batch_size))) != 0:
+            batch_created, batch_skipped = import_batch(batch, offset, permission_ids, role_ids, executor)
+            audit_log.record("import", "moderator", created=batch_created, skipped=batch_skipped)
+            db.session.commit()
+            offset += len(batch)
+            created += batch_created
+            skipped += batch_skipped
+            if progress_path is not None:
+                with open(progress_path, "w") as progress:
+                    progress.write(str(offset))
+            echo(f"Processed {offset} record(s)")
+
+    echo(f"Created {created} moderator(s), skipped {skipped}")
+
+
+@permission_cli_command()
+@option("-o", "--output", "target", type=File("w"), default="-")
+@option("-f", "--format", "file_format", type=Choice(["jsonl", "csv"]), default="jsonl")
+@option("-b", "--batch-size", type=int, default=1000)
+@option("--with-hashes", is_flag=True, default=False, help="Include password hashes, so that import keeps them")
+def export_moderators(target, file_format: str, batch_size: int, with_hashes: bool):
+    permission_names = Section.get_permission_names()
+    role_names = {role.id: role.name for role in ModRole.get_all()}
+    fields = TRANSFER_FIELDS if with_hashes else TRANSFER_FIELDS[:-1]
+    writer = None
+    if file_format == "csv":
+        writer = DictWriter(target, fields)
+        writer.writeheader()
+
+    moderators = Moderator.iterate_with_direct_grants(batch_size)
+    while len(batch := list(islice(moderators, batch_size))) != 0:
+        assigned = ModRoleAssignment.find_by_moderators([row.id for row, _ in batch])
+        for row, grants in batch:
+            grants = [(permission_names[perm_id], expires_at) for perm_id, expires_at in grants
+                      if perm_id in permission_names]
+            record = {"username": row.username, "super": row.super, "mode": row.mode.name.lower(),
+                      "permissions": [name for name, _ in grants],
+                      "expires-at": {name: expires_at.isoformat() for name, expires_at in grants
+                                     if expires_at is not None},
+                      "roles": [role_names[role_id] for role_id in assigned.get(row.id, [])]}
+            if with_hashes:
+                record["password-hash"] = row.password
+
+            if writer is None:
+                target.write(dumps(record, ensure_ascii=False) + "\n")
+            else:
+                record["permissions"] = ";".join(record["permissions"])
+                record["expires-at"] = ";".join(f"{name}={expiry}" for name, expiry in record["expires-at"].items())
+                record["roles"] = ";".join(record["roles"])
+                record["super"] = "true" if row.super else "false"
+                writer.writerow(record)
@@ -1,68 +1,345 @@
 from __future__ import annotations
 
+from datetime import datetime, timezone
+
+from flask import Response
 from flask_fullstack import counter_parser, RequestParser
 from flask_restx import Resource
+from flask_restx.inputs import boolean, datetime_from_iso8601
+
+from ..base import permission_index, Moderator, Section, Permission, ModPerm, ModRole, MUBController
+from ..base import AuditEntry, audit_log, metrics
+from ..base.moderators_db import InterfaceMode
+from ..base.sessions_db import utcnow
 
-from ..base import permission_index, Moderator, Section, Permission, ModPerm, MUBController
+BATCH_ACTIONS: tuple[str, ...] = ("create", "update", "delete")
+MAX_PERMISSION_CHECKS: int = 10_000
 
 super_section = permission_index.add_section("super")
 manage_mods = permission_index.add_permission(super_section, "manage mods")
+check_perms = permission_index.add_permission(super_section, "check permissions")
+view_metrics = permission_index.add_permission(super_section, "view metrics")
 
-controller = MUBController("super", path="")
+controller = MUBController("super", path="", read_replica=True)
 
 search_counter_parser = counter_parser.copy()
 search_counter_parser.add_argument("search", required=False)
+search_counter_parser.add_argument("prefix", type=boolean, required=False, default=False)
+
+audit_counter_parser = counter_parser.copy()
+audit_counter_parser.add_argument("target-type", required=False, dest="target_type")
+audit_counter_parser.add_argument("target-id", type=int, required=False, dest="target_id")
+
+search_cursor_parser = RequestParser()
+search_cursor_parser.add_argument("cursor", required=False)
+search_cursor_parser.add_argument("search", required=False)
+search_cursor_parser.add_argument("prefix", type=boolean, required=False, default=False)
+
+
+def future_datetime(value: str) -> datetime:
+    """ Parses an ISO 8601 expiry into naive UTC (naive input is taken as UTC), it must be in the future """
+    result = datetime_from_iso8601(value)
+    if result.tzinfo is not None:
+        result = result.astimezone(timezone.utc).replace(tzinfo=None)
+    if result <= utcnow():
+        raise ValueError("Expiry must be in the future")
+    return result
+
+
+def validate_permission_ids(moderator: Moderator, permission_ids: list[int]) -> None:
+    if len(permission_ids) == 0:
+        return
+
+    existing = Permission.find_existing_ids(permission_ids)
+    granted = None if moderator.super else ModPerm.find_granted_ids(moderator.id, permission_ids)
+    for permission_id in permission_ids:
+        if permission_id not in existing:
+            controller.abort(404, f"Permission {permission_id} does not exit")
+        if granted is not None and permission_id not in granted:
+            controller.abort(403, f"You can't grant or remove permission #{permission_id}")
+
+
+def validate_role_ids(moderator: Moderator, role_ids: list[int]) -> list[ModRole]:
+    if len(role_ids) == 0:
+        return []
+
+    roles = ModRole.find_by_ids(role_ids)
+    for role_id in role_ids:
+        if role_id not in roles:
+            controller.abort(404, f"Role {role_id} does not exist")
+    validate_permission_ids(moderator, list({role_perm.permission_id for role in roles.values()
+                                             for role_perm in role.permissions}))
+    return [roles[role_id] for role_id in role_ids]
+
+
+def update_moderator(moderator: Moderator, target: Moderator, username: str | None, password: str | None,
+                     append_perms: list[int], remove_perms: list[int],
+                     append_roles: list[ModRole], remove_roles: list[ModRole],
+                     expires_at: datetime | None = None) -> None:
+    if username is not None:
+        target.username = username
+    if password is not None:
+        target.password = Moderator.generate_hash(password)
+    if username is not None or password is not None:
+        target.expire_sessions()
+
+    ModPerm.bundle_create(target.id, append_perms, expires_at)
+    if len(remove_perms) != 0:
+        ModPerm.bundle_delete(target.id, remove_perms)
+
+    for role in append_roles:
+        role.assign(target.id)
+    for role in remove_roles:
+        role.unassign(target.id)
+
+    audit_log.record("update", "moderator", target.id, moderator.id, username=username,
+                     password=password is not None, append_perms=append_perms, remove_perms=remove_perms,
+                     expires_at=None if expires_at is None else expires_at.isoformat(),
+                     append_roles=[role.id for role in append_roles], remove_roles=[role.id for role in remove_roles])
+
+
+def get_batch_ids(operation: dict, key: str) -> list[int] | None:
+    ids = operation.get(key, None) or []
+    if not isinstance(ids, list) or not all(isinstance(entry_id, int) for entry_id in ids):
+        return None
+    return ids
+
+
+def get_batch_expiry(operation: dict) -> datetime | None:
+    if (expires_at := operation.get("expires-at", None)) is None:
+        return None
+    if not isinstance(expires_at, str):
+        raise ValueError("Expiry must be a string")
+    return future_datetime(expires_at)
+
+
+def validate_batch(moderator: Moderator, operations: list) -> tuple[list[dict], dict[int, Moderator],
+                                                                    dict[int, ModRole]]:
+    """
+    Checks every operation of a batch with one query per kind of reference
+    (targets, usernames, permissions, roles, grantor's permissions), results hold a status for each of them
+    """
+    results: list[dict] = [{"status": 200} for _ in operations]
+
+    def fail(index: int, status: int, message: str) -> None:
+        if results[index]["status"] == 200:
+            results[index] = {"status": status, "message": message}
+
+    target_ids, usernames, permission_ids, role_ids = [], [], set(), set()
+    for i, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get("action", None) not in BATCH_ACTIONS:
+            fail(i, 400, f"Action must be one of: {', '.join(BATCH_ACTIONS)}")
+            continue
+        if operation["action"] != "create":
+            if not isinstance(operation.get("id", None), int):
+                fail(i, 400, "Target id is required")
+            else:
+                target_ids.append(operation["id"])
+        if isinstance(operation.get("username", None), str):
+            usernames.append(operation["username"])
+        for key, ids in (("append-perms", permission_ids), ("remove-perms", permission_ids),
+                         ("append-roles", role_ids), ("remove-roles", role_ids)):
+            if (entry_ids := get_batch_ids(operation, key)) is None:
+                fail(i, 400, f"Field {key} must be a list of ids")
+            else:
+                ids.update(entry_ids)
+        try:
+            get_batch_expiry(operation)
+        except ValueError:
+            fail(i, 400, "Field expires-at must be a future ISO 8601 datetime")
+
+    targets = Moderator.find_by_ids(target_ids) if len(target_ids) != 0 else {}
+    taken = Moderator.find_ids_by_names(usernames) if len(usernames) != 0 else {}
+    roles = ModRole.find_by_ids(list(role_ids)) if len(role_ids) != 0 else {}
+    role_permission_ids = {role_perm.permission_id for role in roles.values() for role_perm in role.permissions}
+    existing = Permission.find_existing_ids(list(permission_ids)) if len(permission_ids) != 0 else set()
+    checked_ids = list(permission_ids | role_permission_ids)
+    granted = None if moderator.super or len(checked_ids) == 0 \
+        else ModPerm.find_granted_ids(moderator.id, checked_ids)
+
+    seen_targets, seen_usernames = set(), set()
+    for i, operation in enumerate(operations):
+        if results[i]["status"] != 200:
+            continue
+        action = operation["action"]
+
+        if action == "create":
+            if not operation.get("username", None) or not operation.get("password", None):
+                fail(i, 400, "Username and password are required")
+            elif operation.get("remove-perms", None) or operation.get("remove-roles", None):
+                fail(i, 400, "Can't remove permissions or roles of a new moderator")
+        elif (target := targets.get(operation["id"], None)) is None:
+            fail(i, 404, "Moderator does not exist")
+        elif target.id == moderator.id:
+            fail(i, 400, "Target is the source")
+        elif target.super:
+            fail(i, 403 if action == "delete" else 400, "Can't edit or delete a super via web api")
+        elif target.id in seen_targets:
+            fail(i, 400, "Target is repeated in the batch")
+        else:
+            seen_targets.add(target.id)
+
+        if not isinstance(operation.get("password", ""), str):
+            fail(i, 400, "Password must be a string")
+        if (username := operation.get("username", None)) is not None:
+            if not isinstance(username, str) or username in seen_usernames \
+                    or taken.get(username, operation.get("id", None)) != operation.get("id", None):
+                fail(i, 400, "Moderator with is username already exists")
+            seen_usernames.add(username)
+
+        for role_id in get_batch_ids(operation, "append-roles") + get_batch_ids(operation, "remove-roles"):
+            if role_id not in roles:
+                fail(i, 404, f"Role {role_id} does not exist")
+                continue
+            for role_perm in roles[role_id].permissions:
+                if granted is not None and role_perm.permission_id not in granted:
+                    fail(i, 403, f"You can't grant or remove permission #{role_perm.permission_id}")
+        for permission_id in get_batch_ids(operation, "append-perms") + get_batch_ids(operation, "remove-perms"):
+            if permission_id not in existing:
+                fail(i, 404, f"Permission {permission_id} does not exit")
+            elif granted is not None and permission_id not in granted:
+                fail(i, 403, f"You can't grant or remove permission #{permission_id}")
+
+    return results, targets, roles
+
+
+def apply_batch(moderator: Moderator, operations: list[dict], results: list[dict],
+                targets: dict[int, Moderator], roles: dict[int, ModRole]) -> bool:
+    """ Creates go first, if one of their usernames got taken meanwhile nothing is applied and False is returned """
+    creates = [(i, operation) for i, operation in enumerate(operations) if operation["action"] == "create"]
+    if len(creates) != 0:
+        created = Moderator.bundle_register([
+            {"username": operation["username"], "password": Moderator.generate_hash(operation["password"]),
+             "super": False, "mode": InterfaceMode.DARK} for _, operation in creates])
+        if created is None:
+            taken = Moderator.find_ids_by_names([operation["username"] for _, operation in creates])
+            for i, operation in creates:
+                if operation["username"] in taken:
+                    results[i] = {"status": 400, "message": "Moderator with is username already exists"}
+            return False
+
+        expiries = {created[operation["username"]]: get_batch_expiry(operation) for _, operation in creates}
+        ModPerm.bundle_grant({created[operation["username"]]: get_batch_ids(operation, "append-perms")
+                              for _, operation in creates if operation.get("append-perms", None)}, expiries)
+        ModRole.bundle_assign({created[operation["username"]]: get_batch_ids(operation, "append-roles")
+                               for _, operation in creates})
+        for i, operation in creates:
+            results[i]["id"] = created[operation["username"]]
+            expires_at = expiries[results[i]["id"]]
+            audit_log.record("create", "moderator", results[i]["id"], moderator.id, username=operation["username"],
+                             perms=get_batch_ids(operation, "append-perms"),
+                             roles=get_batch_ids(operation, "append-roles"),
+                             expires_at=None if expires_at is None else expires_at.isoformat())
+
+    deleted_ids = []
+    for i, operation in enumerate(operations):
+        if operation["action"] == "create":
+            continue
+        target = targets[operation["id"]]
+        results[i]["id"] = target.id
+        if operation["action"] == "update":
+            update_moderator(moderator, target, operation.get("username", None), operation.get("password", None),
+                             get_batch_ids(operation, "append-perms"), get_batch_ids(operation, "remove-perms"),
+                             [roles[role_id] for role_id in get_batch_ids(operation, "append-roles")],
+                             [roles[role_id] for role_id in get_batch_ids(operation, "remove-roles")],
+                             get_batch_expiry(operation))
+        else:
+            audit_log.record("delete", "moderator", target.id, moderator.id, username=target.username)
+            deleted_ids.append(target.id)
+    Moderator.bundle_delete(deleted_ids)
+    return True
 
 
 @controller.route("/sections/")
 class SectionIndex(Resource):
     @permission_index.require_permission(controller, manage_mods, use_moderator=False)
-    @controller.marshal_list_with(Section.SelfModel)
+    @controller.catalog_cached(Section.SelfModel, as_list=True)
     def get(self):
-        return Section.get_all()
+        return Section.get_all_with_permissions()
 
 
 @controller.route("/permissions/")
 class PermissionIndex(Resource):
     @permission_index.require_permission(controller, manage_mods, use_moderator=False)
-    @controller.marshal_list_with(Permission.IndexModel)
+    @controller.catalog_cached(Permission.IndexModel, as_list=True)
     def get(self):
         return Permission.get_all()
 
 
+@controller.route("/permissions/check/")
+class PermissionCheck(Resource):
+    parser = RequestParser()
+    parser.add_argument("checks", type=list, location="json", required=True)
+
+    @controller.doc_abort(400, "Checks must be a list of {moderator-id, permission} objects")
+    @controller.doc_abort(" 400", f"No more than {MAX_PERMISSION_CHECKS} checks are allowed")
+    @permission_index.require_permission(controller, check_perms, use_moderator=False)
+    @controller.argument_parser(parser)
+    def post(self, checks: list):
+        """ Answers whether moderators hold permissions ("section name" strings), results keep the order of checks """
+        if len(checks) > MAX_PERMISSION_CHECKS:
+            controller.abort(400, f"No more than {MAX_PERMISSION_CHECKS} checks are allowed")
+        if not all(isinstance(check, dict) and isinstance(check.get("moderator-id", None), int)
+                   and isinstance(check.get("permission", None), str) for check in checks):
+            controller.abort(400, "Checks must be a list of {moderator-id, permission} objects")
+
+        return {"results": permission_index.check_many([(check["moderator-id"], check["permission"])
+                                                        for check in checks])}
+
+
+@controller.route("/metrics/")
+class MetricsResource(Resource):
+    @controller.doc_abort(404, "Metrics are disabled")
+    @permission_index.require_permission(controller, view_metrics, use_moderator=False)
+    def get(self):
+        if not metrics.enabled:
+            controller.abort(404, "Metrics are disabled")
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @controller.route("/moderators/")
 class ModeratorIndex(Resource):
     @permission_index.require_permission(controller, manage_mods)
     @controller.argument_parser(search_counter_parser)
     @controller.lister(100, Moderator.IndexModel)
-    def get(self, moderator: Moderator, start: int, finish: int, search: str | None = None):
-        return Moderator.search(start, finish - start, search, moderator.id)
+    def get(self, moderator: Moderator, start: int, finish: int, search: str | None = None, prefix: bool = False):
+        return Moderator.search(start, finish - start, search, moderator.id, prefix)
 
     parser = RequestParser()
     parser.add_argument("username", required=True)
     parser.add_argument("password", required=True)
     parser.add_argument("append-perms", type=int, required=False, dest="append_perms", action="append")
+    parser.add_argument("expires-at", type=future_datetime, required=False, dest="expires_at")
 
     @controller.doc_abort(400, "Moderator with is username already exists")
+    @controller.doc_abort(503, "Server is busy, try again later")
     @permission_index.require_permission(controller, manage_mods)
     @controller.argument_parser(parser)
     @controller.marshal_with(Moderator.IndexModel)
-    def post(self, moderator: Moderator, username: str, password: str, append_perms: list[int]):
+    def post(self, moderator: Moderator, username: str, password: str, append_perms: list[int],
+             expires_at: datetime | None = None):
         append_perms = append_perms or []
-        for permission_id in append_perms:
-            if Permission.find_by_id(permission_id) is None:
-                controller.abort(404, f"Permission {permission_id} does not exit")
-            if not moderator.super and ModPerm.find_by_ids(moderator.id, permission_id) is None:
-                controller.abort(403, f"You can't grant or remove permission #{permission_id}")
+        validate_permission_ids(moderator, append_perms)
 
         if Moderator.find_by_name(username) is not None:
             controller.abort(400, "Moderator with is username already exists")
         target = Moderator.register(username, password)
-        for permission_id in append_perms:
-            ModPerm.create_unique(target.id, permission_id)
+        ModPerm.bundle_create(target.id, append_perms, expires_at)
+        audit_log.record("create", "moderator", target.id, moderator.id, username=username, perms=append_perms,
+                         expires_at=None if expires_at is None else expires_at.isoformat())
         return target
 
 
+@controller.route("/moderators/cursor/")
+class ModeratorCursorIndex(Resource):
+    @permission_index.require_permission(controller, manage_mods)
+    @controller.argument_parser(search_cursor_parser)
+    @controller.cursor_lister(100, Moderator.IndexModel, Moderator.get_cursor)
+    def get(self, moderator: Moderator, cursor: tuple[str, int] | None, limit: int,
+            search: str | None = None, prefix: bool = False):
+        return Moderator.search_after(cursor, limit, search, moderator.id, prefix)
+
+
 @controller.route("/moderators/<int:moderator_id>/")
 class ModeratorManager(Resource):
     parser = RequestParser()
@@ -70,39 +347,34 @@ class ModeratorManager(Resource):
     parser.add_argument("password", required=False)
     parser.add_argument("append-perms", type=int, required=False, dest="append_perms", action="append")
     parser.add_argument("remove-perms", type=int, required=False, dest="remove_perms", action="append")
+    parser.add_argument("append-roles", type=int, required=False, dest="append_roles", action="append")
+    parser.add_argument("remove-roles", type=int, required=False, dest="remove_roles", action="append")
+    parser.add_argument("expires-at", type=future_datetime, required=False, dest="expires_at")
 
     @controller.doc_abort(400, "Target is the source")
     @controller.doc_abort(400, "Can't edit super's permissions")
     @controller.doc_abort(403, "Insufficient permissions")
     @controller.doc_abort(404, "Permission not found")
+    @controller.doc_abort(" 404", "Role not found")
+    @controller.doc_abort(503, "Server is busy, try again later")
     @permission_index.require_permission(controller, manage_mods)
     @controller.database_searcher(Moderator, result_field_name="target")
     @controller.argument_parser(parser)
     def post(self, moderator: Moderator, target: Moderator, username: str | None, password: str | None,
-             append_perms: list[int] | None, remove_perms: list[int] | None):  # TODO replace mode?
+             append_perms: list[int] | None, remove_perms: list[int] | None,
+             append_roles: list[int] | None, remove_roles: list[int] | None,
+             expires_at: datetime | None = None):  # TODO replace mode?
         if moderator.id == target.id:
             controller.abort(400, "Target is the source")
         if target.super:
             controller.abort(400, "Can't edit super's permissions")
 
-        if username is not None:
-            target.username = username
-            # TODO expire all current sessions
-        if password is not None:
-            target.password = Moderator.generate_hash(password)
-            # TODO expire all current sessions
-
         append_perms = append_perms or []
         remove_perms = remove_perms or []
-        for permission_id in (append_perms + remove_perms):
-            if Permission.find_by_id(permission_id) is None:
-                controller.abort(404, f"Permission {permission_id} does not exit")
-            if not moderator.super and ModPerm.find_by_ids(moderator.id, permission_id) is None:
-                controller.abort(403, f"You can't grant or remove permission #{permission_id}")
-
-        for permission_id in append_perms:
-            ModPerm.create_unique(target.id, permission_id)
-        ModPerm.bundle_delete(target.id, remove_perms)
+        validate_permission_ids(moderator, append_perms + remove_perms)
+        update_moderator(moderator, target, username, password, append_perms, remove_perms,
+                         validate_role_ids(moderator, append_roles or []),
+                         validate_role_ids(moderator, remove_roles or []), expires_at)
 
     @controller.doc_abort(400, "Target is the source")
     @controller.doc_abort(403, "Can't delete a super via web api")
@@ -113,4 +385,100 @@ class ModeratorManager(Resource):
             controller.abort(400, "Target is the source")
         if target.super:
             controller.abort(403, "Can't delete a super via web api")
+        audit_log.record("delete", "moderator", target.id, moderator.id, username=target.username)
         target.delete()
+
+
+@controller.route("/moderators/batch/")
+class ModeratorBatch(Resource):
+    parser = RequestParser()
+    parser.add_argument("operations", type=list, location="json", required=True)
+
+    @controller.doc_abort(400, "Batch was not applied")
+    @controller.doc_abort(503, "Server is busy, try again later")
+    @permission_index.require_permission(controller, manage_mods)
+    @controller.argument_parser(parser)
+    def post(self, moderator: Moderator, operations: list):
+        """ Applies all create/update/delete operations in one transaction, or none of them if any is invalid """
+        results, targets, roles = validate_batch(moderator, operations)
+        if any(result["status"] != 200 for result in results):
+            return {"applied": False, "results": results}, 400
+        if not apply_batch(moderator, operations, results, targets, roles):
+            return {"applied": False, "results": results}, 400
+        return {"applied": True, "results": results}
+
+
+@controller.route("/roles/")
+class RoleIndex(Resource):
+    @permission_index.require_permission(controller, manage_mods, use_moderator=False)
+    @controller.marshal_with(ModRole.FullModel, as_list=True)
+    def get(self):
+        return ModRole.get_all()
+
+    parser = RequestParser()
+    parser.add_argument("name", required=True)
+    parser.add_argument("append-perms", type=int, required=False, dest="append_perms", action="append")
+
+    @controller.doc_abort(400, "Role with this name already exists")
+    @controller.doc_abort(403, "Insufficient permissions")
+    @controller.doc_abort(404, "Permission not found")
+    @permission_index.require_permission(controller, manage_mods)
+    @controller.argument_parser(parser)
+    @controller.marshal_with(ModRole.FullModel)
+    def post(self, moderator: Moderator, name: str, append_perms: list[int] | None):
+        append_perms = append_perms or []
+        validate_permission_ids(moderator, append_perms)
+
+        if ModRole.find_by_name(name) is not None:
+            controller.abort(400, "Role with this name already exists")
+        role = ModRole.create(name=name)
+        role.add_permissions(append_perms)
+        audit_log.record("create", "role", role.id, moderator.id, name=name, perms=append_perms)
+        return role
+
+
+@controller.route("/roles/<int:role_id>/")
+class RoleManager(Resource):
+    parser = RequestParser()
+    parser.add_argument("name", required=False)
+    parser.add_argument("append-perms", type=int, required=False, dest="append_perms", action="append")
+    parser.add_argument("remove-perms", type=int, required=False, dest="remove_perms", action="append")
+
+    @controller.doc_abort(400, "Role with this name already exists")
+    @controller.doc_abort(403, "Insufficient permissions")
+    @controller.doc_abort(404, "Permission not found")
+    @permission_index.require_permission(controller, manage_mods)
+    @controller.database_searcher(ModRole, input_field_name="role_id", result_field_name="role")
+    @controller.argument_parser(parser)
+    def post(self, moderator: Moderator, role: ModRole, name: str | None,
+             append_perms: list[int] | None, remove_perms: list[int] | None):
+        if name is not None and name != role.name:
+            if ModRole.find_by_name(name) is not None:
+                controller.abort(400, "Role with this name already exists")
+            role.name = name
+
+        append_perms = append_perms or []
+        remove_perms = remove_perms or []
+        validate_permission_ids(moderator, append_perms + remove_perms)
+
+        role.add_permissions(append_perms)
+        role.remove_permissions(remove_perms)
+        audit_log.record("update", "role", role.id, moderator.id, name=name,
+                         append_perms=append_perms, remove_perms=remove_perms)
+
+    @controller.doc_abort(403, "Insufficient permissions")
+    @permission_index.require_permission(controller, manage_mods)
+    @controller.database_searcher(ModRole, input_field_name="role_id", result_field_name="role")
+    def delete(self, moderator: Moderator, role: ModRole):
+        validate_permission_ids(moderator, list(role.get_permission_ids()))
+        audit_log.record("delete", "role", role.id, moderator.id, name=role.name)
+        role.delete()
+
+
+@controller.route("/audit/")
+class AuditIndex(Resource):
+    @permission_index.require_permission(controller, manage_mods, use_moderator=False)
+    @controller.argument_parser(audit_counter_parser)
+    @controller.lister(100, AuditEntry.IndexModel)
+    def get(self, start: int, finish: int, target_type: str | None = None, target_id: int | None = None):
+        return AuditEntry.search(start, finish - start, target_type, target_id)
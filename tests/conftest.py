@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import sys
+from datetime import timedelta
+from importlib.util import spec_from_file_location, module_from_spec
+from pathlib import Path
+from tempfile import mkdtemp
+from types import ModuleType
+
+from flask.testing import FlaskClient
+from flask_fullstack import Flask, SQLAlchemy, ResourceController
+from pytest import fixture
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# the package is a submodule of a host application, which provides the `common` module
+app = Flask("mub-tests")
+app.test_client_class = FlaskClient
+app.config["TESTING"] = True
+app.config["JWT_SECRET_KEY"] = "mub-tests-secret-key-long-enough-for-hs256"
+db = SQLAlchemy(app, f"sqlite:///{mkdtemp()}/mub.db")
+
+common = ModuleType("common")
+common.app, common.db, common.Base, common.ResourceController = app, db, db.Model, ResourceController
+sys.modules["common"] = common
+
+# loaded under the directory's name, which is also what pytest imports the package's __init__ as
+spec = spec_from_file_location(ROOT.name, ROOT / "__init__.py", submodule_search_locations=[str(ROOT)])
+mub = module_from_spec(spec)
+sys.modules[ROOT.name] = mub
+spec.loader.exec_module(mub)
+
+api = app.configure_restx()
+api.add_namespace(mub.mub_base_namespace)
+api.add_namespace(mub.mub_super_namespace)
+mub.init_jwt(app.configure_jwt_manager(["cookies"], timedelta(hours=72), csrf_protect=False))
+app.register_blueprint(mub.mub_cli_blueprint)
+
+
+@app.after_request
+def commit(response):
+    db.session.commit()
+    return response
+
+
+@app.teardown_appcontext
+def commit_cli(exception):
+    if exception is None:
+        db.session.commit()
+
+
+@fixture(autouse=True)
+def database():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        mub.permission_index.initialize()
+        admin = mub.Moderator.register("admin", "pass")
+        admin.super = True
+        mub.Moderator.register("mod", "pass")
+        db.session.commit()
+    yield
+    mub.permission_index.disable_cache()
+    mub.permission_index.disable_grants_cache()
+    mub.permission_index.token_claims = False
+
+
+def sign_in(username: str, password: str = "pass") -> FlaskClient:
+    client = app.test_client()
+    assert client.post("/mub/sign-in/", json={"username": username, "password": password}).status_code == 200
+    return client
@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+import sys
+from subprocess import run
+
+from conftest import ROOT
+
+# mirrors conftest.py, with greenlet made unimportable before anything else is imported
+IMPORT_WITHOUT_GREENLET = f"""
+import sys
+sys.modules["greenlet"] = None
+from importlib.util import spec_from_file_location, module_from_spec
+from types import ModuleType
+from flask_fullstack import Flask, SQLAlchemy, ResourceController
+
+app = Flask("mub-no-greenlet")
+db = SQLAlchemy(app, "sqlite://")
+common = ModuleType("common")
+common.app, common.db, common.Base, common.ResourceController = app, db, db.Model, ResourceController
+sys.modules["common"] = common
+
+spec = spec_from_file_location({ROOT.name!r}, {str(ROOT / "__init__.py")!r}, submodule_search_locations=[{str(ROOT)!r}])
+mub = module_from_spec(spec)
+sys.modules[{ROOT.name!r}] = mub
+spec.loader.exec_module(mub)
+assert "sqlalchemy.ext.asyncio" not in sys.modules
+"""
+
+
+def test_package_imports_without_greenlet():
+    result = run([sys.executable, "-c", IMPORT_WITHOUT_GREENLET], capture_output=True, text=True, cwd=ROOT.parent)
+    assert result.returncode == 0, result.stderr
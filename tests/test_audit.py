@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+from json import dumps
+from pathlib import Path
+
+from pytest import raises
+from sqlalchemy import select
+
+from conftest import app, db, mub
+
+
+def write_fallback(path: Path, **entry) -> None:
+    entry = {"created": "2026-01-01T00:00:00", "actor_id": None, "target_type": "moderator",
+             "target_id": None, "action": "create", "details": None, **entry}
+    path.write_text(dumps(entry) + "\n", encoding="utf-8")
+
+
+def test_replay_commits_before_emptying_the_fallback(tmp_path, monkeypatch):
+    monkeypatch.setattr(mub.audit_log, "fallback_path", str(fallback := tmp_path / "fallback.jsonl"))
+    write_fallback(fallback, target_id=1)
+    with app.app_context():
+        assert mub.audit_log.replay() == 1
+        db.session.rollback()
+        assert db.get_all(select(mub.base.AuditEntry.target_id)) == [1]
+    assert fallback.read_text() == ""
+
+
+def test_failed_replay_keeps_the_fallback(tmp_path, monkeypatch):
+    monkeypatch.setattr(mub.audit_log, "fallback_path", str(fallback := tmp_path / "fallback.jsonl"))
+    write_fallback(fallback, action=None)
+    with app.app_context(), raises(Exception):
+        mub.audit_log.replay()
+    assert fallback.read_text() != ""
+
+
+def capture_audit(monkeypatch) -> list[dict]:
+    published = []
+    monkeypatch.setattr(mub.audit_log, "enabled", True)
+    monkeypatch.setattr(mub.audit_log, "enqueue", published.extend)
+    return published
+
+
+def test_savepoint_rollback_discards_only_its_entries(monkeypatch):
+    published = capture_audit(monkeypatch)
+    with app.app_context():
+        mub.audit_log.record("create", "moderator", 1)
+        savepoint = db.session.begin_nested()
+        mub.audit_log.record("create", "moderator", 2)
+        db.session.begin_nested()
+        mub.audit_log.record("create", "moderator", 3)
+        savepoint.rollback()
+        mub.audit_log.record("create", "moderator", 4)
+        db.session.commit()
+    assert [entry["target_id"] for entry in published] == [1, 4]
+
+
+def test_cli_role_commands_are_audited(monkeypatch):
+    published = capture_audit(monkeypatch)
+    runner = app.test_cli_runner()
+    runner.invoke(args=["mub", "create-role", "-n", "editors"])
+    runner.invoke(args=["mub", "add-role-permission", "-n", "editors", "-p", "manage mods"])
+    runner.invoke(args=["mub", "remove-role-permission", "-n", "editors", "-p", "manage mods"])
+    runner.invoke(args=["mub", "delete-role", "-n", "editors"])
+    assert [(entry["target_type"], entry["action"]) for entry in published] == [("role", "create")] \
+        + [("role", "update")] * 2 + [("role", "delete")]
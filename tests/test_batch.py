@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from conftest import app, db, mub, sign_in
+
+MANAGE_MODS = "super manage mods"
+
+
+def create_role() -> int:
+    with app.app_context():
+        role = mub.ModRole.create(name="managers")
+        role.add_permissions([mub.permission_index.permission_dict[MANAGE_MODS]])
+        db.session.commit()
+        return role.id
+
+
+def test_created_moderators_get_their_roles():
+    role_id = create_role()
+    response = sign_in("admin").post("/mub/moderators/batch/", json={"operations": [
+        {"action": "create", "username": "new", "password": "pass", "append-roles": [role_id]}]})
+    assert response.status_code == 200
+
+    with app.app_context():
+        moderator_id = mub.Moderator.find_by_name("new").id
+        assert mub.ModPerm.find_by_ids(moderator_id, mub.permission_index.permission_dict[MANAGE_MODS]).role_count == 1
+    assert sign_in("new").get("/mub/sections/").status_code == 200
+
+
+def test_creates_cannot_remove():
+    role_id = create_role()
+    response = sign_in("admin").post("/mub/moderators/batch/", json={"operations": [
+        {"action": "create", "username": "new", "password": "pass", "remove-roles": [role_id]}]})
+    assert response.status_code == 400
+    assert response.json["results"][0]["status"] == 400
+
+
+def test_username_taken_after_validation_fails_the_batch(monkeypatch):
+    with app.app_context():
+        mub.Moderator.register("taken", "pass")
+        db.session.commit()
+    find_ids_by_names = mub.Moderator.find_ids_by_names
+    calls = []
+
+    def find_nothing_first(usernames):  # as if "taken" was created between validation and insertion
+        calls.append(usernames)
+        return {} if len(calls) == 1 else find_ids_by_names(usernames)
+
+    monkeypatch.setattr(mub.Moderator, "find_ids_by_names", find_nothing_first)
+    response = sign_in("admin").post("/mub/moderators/batch/", json={"operations": [
+        {"action": "create", "username": "fresh", "password": "pass"},
+        {"action": "create", "username": "taken", "password": "pass"}]})
+    assert response.status_code == 400
+    assert not response.json["applied"]
+    assert [result["status"] for result in response.json["results"]] == [200, 400]
+
+    with app.app_context():
+        assert mub.Moderator.find_by_name("fresh") is None
@@ -0,0 +1,16 @@
+from __future__ import annotations
+
+from sqlalchemy import select
+from sqlalchemy.sql.functions import count
+
+from conftest import app, db, mub, sign_in
+
+
+def test_benchmark_stays_within_budgets_and_leaves_the_database_alone():
+    result = app.test_cli_runner().invoke(args=["mub", "benchmark", "-m", "20", "-n", "2", "-w", "0", "--check"])
+    assert result.exit_code == 0, result.output
+    assert "moderator-append-perms" in result.output
+    with app.app_context():
+        assert db.session.execute(select(count(mub.Moderator.id))).scalar() == 2
+        assert mub.Moderator.find_by_name("admin").super
+    assert sign_in("admin").get("/mub/sections/").status_code == 200
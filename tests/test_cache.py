@@ -0,0 +1,20 @@
+from __future__ import annotations
+
+from importlib import import_module
+
+from conftest import app, db, mub
+
+moderators_db = import_module(f"{mub.__name__}.base.moderators_db")
+
+MANAGE_MODS = "super manage mods"
+
+
+def test_state_cached_before_the_commit_is_dropped_by_it():
+    mub.permission_index.enable_cache()
+    with app.app_context():
+        moderator_id = mub.Moderator.find_by_name("mod").id
+        mub.ModPerm.bundle_create(moderator_id, [mub.permission_index.permission_dict[MANAGE_MODS]])
+        # as done by a concurrent request, which still sees the state from before the commit
+        moderators_db.moderator_cache.put(moderator_id, moderators_db.ModeratorSnapshot({}, frozenset()))
+        db.session.commit()
+        assert moderators_db.moderator_cache.get(moderator_id) is None
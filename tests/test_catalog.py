@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+from sqlalchemy import insert
+
+from conftest import app, db, mub
+
+permissions = mub.base.permissions
+
+
+def start_worker() -> permissions.PermissionIndex:
+    index = permissions.PermissionIndex()
+    index.add_section("extra")
+    index.initialize()
+    db.session.commit()
+    return index
+
+
+def test_workers_agree_on_bits_of_permissions_added_concurrently():
+    with app.app_context():
+        first, second = start_worker(), start_worker()
+        x = first.add_permission(permissions.SectionInt("extra"), "x")
+        db.session.commit()
+        y = second.add_permission(permissions.SectionInt("extra"), "y")
+        db.session.commit()
+        first.refresh(force=True)
+
+        x_id, y_id = first.permission_dict[x], first.permission_dict[y]
+        assert second.permission_dict[y] == y_id
+        assert first.get_mask([y_id]) == second.get_mask([y_id])
+
+        third = permissions.PermissionIndex()
+        extra = third.add_section("extra")
+        third.add_permission(extra, "x")
+        third.add_permission(extra, "y")
+        third.initialize()
+        assert third.get_mask([x_id, y_id]) == first.get_mask([x_id, y_id])
+        assert third.fingerprint == first.fingerprint
+
+
+def test_bits_stay_dense_with_large_ids():
+    with app.app_context():
+        first = start_worker()
+        extra_id = first.sections_dict["extra"]
+        db.session.execute(insert(mub.Permission).values(id=20_000, section_id=extra_id, name="far"))
+        far = first.add_permission(permissions.SectionInt("extra"), "far")
+        db.session.commit()
+        assert first.permission_dict[far] == 20_000
+        assert first.get_mask([20_000]).bit_length() <= len(mub.Permission.get_all())
+
+
+def test_bits_of_deleted_permissions_are_reused():
+    with app.app_context():
+        first = start_worker()
+        x = first.add_permission(permissions.SectionInt("extra"), "x")
+        first.add_permission(permissions.SectionInt("extra"), "w")  # so that SQLite doesn't reuse the id of x
+        db.session.commit()
+        x_id = first.permission_dict[x]
+        mub.Permission.bundle_delete([x_id])  # as pruned by another worker
+        db.session.commit()
+
+        second = start_worker()
+        y = second.add_permission(permissions.SectionInt("extra"), "y")
+        db.session.commit()
+        y_id = second.permission_dict[y]
+        assert second.bit_dict[y_id] == first.bit_dict[x_id]
+
+        first.refresh(force=True)
+        assert x not in first.permission_dict
+        assert first.get_mask([y_id]) == second.get_mask([y_id])
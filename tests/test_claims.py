@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+from conftest import app, db, mub, sign_in
+
+MANAGE_MODS = "super manage mods"
+
+
+def grant(username: str, *permissions: str) -> int:
+    with app.app_context():
+        moderator = mub.Moderator.find_by_name(username)
+        mub.ModPerm.bundle_create(moderator.id, [mub.permission_index.permission_dict[name] for name in permissions])
+        db.session.commit()
+        return moderator.id
+
+
+def test_claims_are_rejected_after_revocation():
+    mub.permission_index.enable_token_claims()
+    moderator_id = grant("mod", MANAGE_MODS)
+    client = sign_in("mod")
+    assert client.get("/mub/sections/").status_code == 200
+
+    admin = sign_in("admin")
+    permission_id = mub.permission_index.permission_dict[MANAGE_MODS]
+    assert admin.post(f"/mub/moderators/{moderator_id}/", json={"remove-perms": [permission_id]}).status_code == 200
+    assert client.get("/mub/sections/").status_code != 200
+
+    relogged = sign_in("mod")
+    assert relogged.get("/mub/sections/").status_code == 403
+
+
+def test_claims_are_rejected_after_super_is_deactivated():
+    mub.permission_index.enable_token_claims()
+    with app.app_context():
+        mub.Moderator.find_by_name("mod").super = True
+        db.session.commit()
+    client = sign_in("mod")
+    assert client.get("/mub/sections/").status_code == 200
+
+    result = app.test_cli_runner().invoke(args=["mub", "deactivate-super", "-u", "mod"])
+    assert result.exit_code == 0
+    assert client.get("/mub/sections/").status_code != 200
+
+
+def test_claims_are_rejected_after_role_is_unassigned():
+    mub.permission_index.enable_token_claims()
+    with app.app_context():
+        role = mub.ModRole.create(name="managers")
+        role.add_permissions([mub.permission_index.permission_dict[MANAGE_MODS]])
+        role.assign(mub.Moderator.find_by_name("mod").id)
+        db.session.commit()
+    client = sign_in("mod")
+    assert client.get("/mub/sections/").status_code == 200
+
+    with app.app_context():
+        mub.ModRole.find_by_name("managers").unassign(mub.Moderator.find_by_name("mod").id)
+        db.session.commit()
+    assert client.get("/mub/sections/").status_code != 200
+
+
+def test_unrelated_changes_keep_claims_valid():
+    mub.permission_index.enable_token_claims()
+    grant("mod", MANAGE_MODS)
+    client = sign_in("mod")
+    grant("admin", MANAGE_MODS)
+    assert client.get("/mub/sections/").status_code == 200
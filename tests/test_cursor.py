@@ -0,0 +1,29 @@
+from __future__ import annotations
+
+from importlib import import_module
+
+from pytest import mark
+
+from conftest import mub, sign_in
+
+mub_sql = import_module(f"{mub.__name__}.base._mub_sql")
+
+
+def test_cursor_round_trip():
+    assert mub_sql.decode_cursor(mub_sql.encode_cursor(("mod", 2))) == ("mod", 2)
+
+
+@mark.parametrize("key", [["mod", True], ["mod", 2.5], ["mod", None], [2, "mod"], [["mod"], 2], {"a": 1}, ["mod"]])
+def test_cursor_with_wrong_types_is_rejected(key):
+    assert mub_sql.decode_cursor(mub_sql.encode_cursor(key)) is None
+
+
+def test_invalid_cursor_is_a_bad_request():
+    admin = sign_in("admin")
+    cursor = mub_sql.encode_cursor(("mod", True))
+    assert admin.get("/mub/moderators/cursor/", query_string={"cursor": cursor}).status_code == 400
+    assert admin.get("/mub/moderators/cursor/", query_string={"cursor": "not a cursor"}).status_code == 400
+
+    response = admin.get("/mub/moderators/cursor/", query_string={"cursor": mub_sql.encode_cursor(("", 0))})
+    assert response.status_code == 200
+    assert [result["username"] for result in response.json["results"]] == ["mod"]
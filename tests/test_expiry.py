@@ -0,0 +1,37 @@
+from __future__ import annotations
+
+from datetime import timedelta
+from importlib import import_module
+from time import sleep
+
+from conftest import app, db, mub, sign_in
+from test_payloads import get_permission_ids
+
+utcnow = import_module(f"{mub.__name__}.base.sessions_db").utcnow
+
+
+def test_cached_settings_drop_expired_grants():
+    mub.permission_index.enable_cache()
+    permission_id = mub.permission_index.permission_dict["super manage mods"]
+    with app.app_context():
+        moderator_id = mub.Moderator.find_by_name("mod").id
+        mub.ModPerm.bundle_create(moderator_id, [permission_id], utcnow() + timedelta(seconds=1))
+        db.session.commit()
+
+    client = sign_in("mod")
+    assert get_permission_ids(client) == [permission_id]
+    sleep(1.1)
+    assert get_permission_ids(client) == []
+
+
+def test_expired_grants_stop_working():
+    permission_id = mub.permission_index.permission_dict["super manage mods"]
+    with app.app_context():
+        moderator_id = mub.Moderator.find_by_name("mod").id
+        mub.ModPerm.bundle_create(moderator_id, [permission_id], utcnow() + timedelta(seconds=1))
+        db.session.commit()
+
+    client = sign_in("mod")
+    assert client.get("/mub/sections/").status_code == 200
+    sleep(1.1)
+    assert client.get("/mub/sections/").status_code == 403
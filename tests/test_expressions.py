@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+from pytest import raises
+
+from conftest import mub
+
+permissions = mub.base.permissions
+
+
+def test_expressions_must_describe_and_compile():
+    class Described(permissions.PermissionExpression):
+        def describe(self) -> str:
+            return "described"
+
+    with raises(TypeError):
+        permissions.PermissionExpression()
+    with raises(TypeError):
+        Described()
+
+
+def test_expressions_combine():
+    manage, check = permissions.PermissionInt("super manage mods"), permissions.PermissionInt("super check permissions")
+    assert (manage & ~check | permissions.SectionInt("super")).describe()
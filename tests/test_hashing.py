@@ -0,0 +1,21 @@
+from __future__ import annotations
+
+from importlib import import_module
+
+from pytest import raises
+
+from conftest import mub
+
+mub_hashing = import_module(f"{mub.__name__}.base._mub_hashing")
+
+
+def test_timed_out_hash_is_saturated_and_keeps_its_slot():
+    hasher = mub_hashing.PasswordHasher()
+    hasher.configure(rounds=5_000_000, max_workers=1, max_pending=1, timeout=0.01)
+    try:
+        with raises(mub_hashing.HashingSaturated):
+            hasher.hash("pass")
+        with raises(mub_hashing.HashingSaturated):
+            hasher.verify("pass", "$pbkdf2-sha256$1$$")
+    finally:
+        hasher._executor.shutdown(wait=False, cancel_futures=True)
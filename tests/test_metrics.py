@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+from importlib import import_module
+
+from pytest import raises
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from conftest import app, db, mub, sign_in
+
+mub_metrics = import_module(f"{mub.__name__}.base._mub_metrics")
+
+
+def test_failed_statements_leave_no_timing_state():
+    mub_metrics.metrics.enable()
+    try:
+        with app.test_request_context():
+            mub_metrics.start_request()
+            with raises(OperationalError):
+                db.session.execute(text("SELECT * FROM missing"))
+            db.session.rollback()
+            db.session.execute(text("SELECT 1"))
+            statements, duration = mub_metrics.g.mub_sql
+            assert not db.session.connection().info.get("mub_statement_start", None)
+    finally:
+        mub_metrics.metrics.disable()
+    assert statements == 1
+    assert duration >= 0
+
+
+def test_requests_are_recorded_with_the_returned_status():
+    mub_metrics.metrics.enable()
+    try:
+        with app.test_request_context("/mub/created/"):
+            response = mub.MUBController.instrument(lambda: ({"created": True}, 201))()
+        assert response.status_code == 201
+        assert 'status="201"' in mub_metrics.metrics.render()
+    finally:
+        mub_metrics.metrics.disable()
+        mub_metrics.metrics.reset()
+
+
+def test_metrics_require_a_permission():
+    mub_metrics.metrics.enable()
+    try:
+        assert sign_in("mod").get("/mub/metrics/").status_code == 403
+        response = sign_in("admin").get("/mub/metrics/")
+        assert response.status_code == 200
+        assert "mub_request_duration_seconds" in response.get_data(as_text=True)
+    finally:
+        mub_metrics.metrics.disable()
+        mub_metrics.metrics.reset()
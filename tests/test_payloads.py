@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+from importlib import import_module
+
+from flask.testing import FlaskClient
+from sqlalchemy import insert
+
+from conftest import app, db, mub, sign_in
+
+moderators_db = import_module(f"{mub.__name__}.base.moderators_db")
+
+MANAGE_MODS = "super manage mods"
+
+
+def get_permission_ids(client: FlaskClient) -> list[int]:
+    sections = client.get("/mub/my-settings/").json["sections"]
+    return [permission["id"] for section in sections for permission in section["permissions"]]
+
+
+def test_cached_settings_follow_grants_changed_elsewhere():
+    mub.permission_index.enable_cache()
+    client = sign_in("mod")
+    assert get_permission_ids(client) == []
+
+    # as done by another worker: this worker's payload cache is not invalidated
+    with app.app_context():
+        moderator_id = mub.Moderator.find_by_name("mod").id
+        permission_id = mub.permission_index.permission_dict[MANAGE_MODS]
+        db.session.execute(insert(mub.ModPerm).values(moderator_id=moderator_id, permission_id=permission_id))
+        moderators_db.bump_grants_version(mub.Moderator.id == moderator_id)
+        db.session.commit()
+    moderators_db.moderator_cache.clear()
+
+    assert get_permission_ids(client) == [permission_id]
@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+from datetime import timedelta
+
+from sqlalchemy import insert
+
+from conftest import app, db, mub, sign_in
+
+sessions_db = mub.base.sessions_db
+
+
+def test_revocations_committed_out_of_order_are_picked_up():
+    mub.revocation_filter.configure(refresh_interval=0.0)
+    try:
+        with app.app_context():
+            db.session.execute(insert(mub.BlockedModToken).values(id=2, jti="later", created=sessions_db.utcnow()))
+            db.session.commit()
+            mub.revocation_filter.refresh()
+
+            # inserted (and given its id) before "later", but committed after the filter was refreshed
+            created = sessions_db.utcnow() - timedelta(seconds=5)
+            db.session.execute(insert(mub.BlockedModToken).values(id=1, jti="earlier", created=created))
+            db.session.commit()
+            assert mub.BlockedModToken.is_blocked("earlier")
+            assert not mub.BlockedModToken.is_blocked("unknown")
+    finally:
+        mub.revocation_filter.configure(enabled=False)
+
+
+def test_signed_out_tokens_are_revoked():
+    client = sign_in("mod")
+    token = client.get_cookie("access_token_cookie").value
+    assert client.post("/mub/sign-out/").status_code == 200
+
+    client.set_cookie("access_token_cookie", token)
+    assert client.get("/mub/my-settings/").status_code == 401
+
+
+def test_only_mub_tokens_are_checked():
+    with app.app_context():
+        mub.BlockedModToken.block("host-token")
+        db.session.commit()
+        assert mub.check_revoked_token({}, {"jti": "host-token", "sub": {"mub": {"id": 1}}})
+        assert not mub.check_revoked_token({}, {"jti": "host-token", "sub": {"user": {"id": 1}}})
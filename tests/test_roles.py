@@ -0,0 +1,37 @@
+from __future__ import annotations
+
+from conftest import app, db, mub, sign_in
+
+MANAGE_MODS = "super manage mods"
+
+
+def test_roles_are_validated_together():
+    with app.app_context():
+        role = mub.ModRole.create(name="managers")
+        role.add_permissions([mub.permission_index.permission_dict[MANAGE_MODS]])
+        db.session.commit()
+        role_id, moderator_id = role.id, mub.Moderator.find_by_name("mod").id
+
+    admin = sign_in("admin")
+    response = admin.post(f"/mub/moderators/{moderator_id}/", json={"append-roles": [role_id, role_id + 1]})
+    assert response.status_code == 404
+    assert admin.post(f"/mub/moderators/{moderator_id}/", json={"append-roles": [role_id]}).status_code == 200
+    with app.app_context():
+        assert mub.ModPerm.find_by_ids(moderator_id, mub.permission_index.permission_dict[MANAGE_MODS]).role_count == 1
+
+
+def test_deleting_a_moderator_deletes_their_rows():
+    with app.app_context():
+        role = mub.ModRole.create(name="managers")
+        role.add_permissions([mub.permission_index.permission_dict[MANAGE_MODS]])
+        moderator_id = mub.Moderator.find_by_name("mod").id
+        role.assign(moderator_id)
+        db.session.commit()
+    sign_in("mod")
+
+    with app.app_context():
+        assert mub.Moderator.bundle_delete([moderator_id]) == 1
+        db.session.commit()
+        assert mub.ModPerm.find_by_ids(moderator_id, mub.permission_index.permission_dict[MANAGE_MODS]) is None
+        assert mub.ModSession.find_by_moderator(moderator_id) == []
+        assert mub.base.roles_db.ModRoleAssignment.find_role_ids(moderator_id) == set()
@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+from datetime import datetime
+
+from flask.testing import FlaskClient
+from flask_jwt_extended import decode_token
+from sqlalchemy import delete, update
+
+from conftest import app, db, mub, sign_in
+
+
+def get_session_id(client: FlaskClient) -> str:
+    with app.app_context():
+        return decode_token(client.get_cookie("access_token_cookie").value)["sub"]["mub"]["session"]
+
+
+def test_ending_a_session_signs_out_only_its_tokens():
+    first, second = sign_in("mod"), sign_in("mod")
+    result = app.test_cli_runner().invoke(args=["mub", "end-session", "-s", get_session_id(first)])
+    assert result.exit_code == 0
+
+    assert first.get("/mub/my-settings/").status_code == 403
+    assert second.get("/mub/my-settings/").status_code == 200
+
+
+def test_ended_session_rejects_claims():
+    mub.permission_index.enable_token_claims()
+    admin = sign_in("admin")
+    assert admin.get("/mub/sections/").status_code == 200
+    app.test_cli_runner().invoke(args=["mub", "end-session", "-s", get_session_id(admin)])
+    assert admin.get("/mub/sections/").status_code == 403
+
+
+def test_session_ended_by_another_process_is_rejected_with_cache():
+    mub.permission_index.enable_cache()
+    client = sign_in("mod")
+    assert client.get("/mub/my-settings/").status_code == 200
+    with app.app_context():  # as done by another worker, which can't reach this one's caches
+        db.session.execute(delete(mub.ModSession).where(mub.ModSession.id == get_session_id(client)))
+        db.session.commit()
+    assert client.get("/mub/my-settings/").status_code == 403
+
+
+def test_only_refresh_extends_the_session():
+    client = sign_in("mod")
+    session_id = get_session_id(client)
+    with app.app_context():
+        db.session.execute(update(mub.ModSession).values(expires=datetime(2000, 1, 1)))
+        db.session.commit()
+
+    assert client.get("/mub/my-settings/").status_code == 200
+    with app.app_context():
+        assert db.session.get(mub.ModSession, session_id).expires == datetime(2000, 1, 1)
+
+    assert client.post("/mub/refresh/").status_code == 200
+    assert get_session_id(client) == session_id
+    with app.app_context():
+        assert db.session.get(mub.ModSession, session_id).expires > datetime(2000, 1, 1)
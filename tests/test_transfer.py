@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+from datetime import timedelta
+from importlib import import_module
+from json import loads, dumps
+
+from conftest import app, db, mub
+
+utcnow = import_module(f"{mub.__name__}.base.sessions_db").utcnow
+
+CHECK_PERMS, MANAGE_MODS = "super check permissions", "super manage mods"
+
+
+def invoke(*args: str, **kwargs):
+    result = app.test_cli_runner().invoke(args=["mub", *args], **kwargs)
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_export_keeps_direct_grants_expiries_and_roles_apart():
+    expires_at = utcnow().replace(microsecond=0) + timedelta(days=1)
+    with app.app_context():
+        moderator_id = mub.Moderator.find_by_name("mod").id
+        role = mub.ModRole.create(name="managers")
+        role.add_permissions([mub.permission_index.permission_dict[MANAGE_MODS]])
+        role.assign(moderator_id)
+        mub.ModPerm.bundle_create(moderator_id, [mub.permission_index.permission_dict[CHECK_PERMS]], expires_at)
+        db.session.commit()
+
+    records = {record["username"]: record for record in map(loads, invoke("export-moderators", "--with-hashes").splitlines())}
+    assert records["mod"]["permissions"] == [CHECK_PERMS]
+    assert records["mod"]["expires-at"] == {CHECK_PERMS: expires_at.isoformat()}
+    assert records["mod"]["roles"] == ["managers"]
+
+    with app.app_context():
+        mub.Moderator.find_by_name("mod").delete()
+        db.session.commit()
+    invoke("import-moderators", input=dumps(records["mod"]) + "\n")
+
+    with app.app_context():
+        moderator_id = mub.Moderator.find_by_name("mod").id
+        direct = mub.ModPerm.find_by_ids(moderator_id, mub.permission_index.permission_dict[CHECK_PERMS])
+        assert direct.direct and direct.expires_at == expires_at
+        by_role = mub.ModPerm.find_by_ids(moderator_id, mub.permission_index.permission_dict[MANAGE_MODS])
+        assert not by_role.direct and by_role.role_count == 1
+
+
+def test_import_skips_records_with_malformed_permissions():
+    record = {"username": "other", "password": "pass", "permissions": CHECK_PERMS}
+    assert "must be lists" in invoke("import-moderators", input=dumps(record) + "\n")
+    with app.app_context():
+        assert mub.Moderator.find_by_name("other") is None